@@ -0,0 +1,199 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+文章投票的异步接口
+每个函数都在一个新的协程中执行article_voted中对应的函数，立即返回gevent.Greenlet，调用get()等待结果。
+连接使用redis_gevent.asyncRedis创建时，等待redis回复的协程会让出CPU，一个进程可以同时处理几千个请求；
+互相独立的命令（几批投票、几页文章）同时发送，而不是一个接一个地等待。
+
+用法：
+    conn = redis_gevent.asyncRedis(db=15)
+    article_id = article_async.postArticle(conn, 'username', 'A title', 'http://www.example.com').get()
+    first, second = redis_gevent.gather(
+        article_async.getArticles(conn, 1), article_async.getArticles(conn, 2))
+"""
+
+import os
+import sys
+import unittest
+
+import gevent
+
+# redis_gevent和redis_standin在仓库根目录
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import article_voted
+from redis_gevent import gather
+
+"""
+发布文章
+
+@param {object}
+@param {string} 用户
+@param {string} 文章title
+@param {string} 文章链接
+
+@return {object} gevent.Greenlet，结果为文章ID
+"""
+def postArticle(conn, user, title, link):
+    return gevent.spawn(article_voted.postArticle, conn, user, title, link)
+
+"""
+对文章进行投票
+
+@param {object}
+@param {string} 用户
+@param {string} 文章，article:<id>
+
+@return {object} gevent.Greenlet，结果为投票是否成功
+"""
+def voteArticle(conn, user, article):
+    return gevent.spawn(article_voted.voteArticle, conn, user, article)
+
+"""
+批量投票
+每VOTE_BATCH_SIZE张投票使用一个流水线，所有流水线同时发送，结果的顺序和投票的顺序一致
+
+@param {object}
+@param {array}  投票列表，每个元素为(用户, 文章)
+
+@return {object} gevent.Greenlet，结果为每张投票是否成功
+"""
+def voteArticles(conn, votes):
+    votes = list(votes)
+
+    def voteBatch(batch):
+        pipe = conn.pipeline(False)
+        for user, article in batch:
+            article_voted.voteArticle(conn, user, article, pipe)
+        return [bool(result) for result in pipe.execute()]
+
+    def run():
+        batches = gather(*[
+            gevent.spawn(voteBatch, votes[offset:offset + article_voted.VOTE_BATCH_SIZE])
+            for offset in xrange(0, len(votes), article_voted.VOTE_BATCH_SIZE)])
+        results = [result for batch in batches for result in batch]
+        if any(results):
+            article_voted.invalidateArticleCache()
+        return results
+
+    return gevent.spawn(run)
+
+"""
+取出一页文章
+
+@param {object}
+@param {int}    页码
+@param {string} 有序集合名称，可以是score:,time:
+@param {array}  需要取出的文章字段，默认取出全部字段
+
+@return {object} gevent.Greenlet，结果为文章列表
+"""
+def getArticles(conn, page, order = 'score:', fields = None):
+    return gevent.spawn(article_voted.getArticles, conn, page, order, fields)
+
+"""
+同时取出多页文章
+
+@param {object}
+@param {array}  页码列表
+@param {string} 有序集合名称，可以是score:,time:
+@param {array}  需要取出的文章字段，默认取出全部字段
+
+@return {object} gevent.Greenlet，结果为每一页的文章列表
+"""
+def getArticlePages(conn, pages, order = 'score:', fields = None):
+    return gevent.spawn(lambda: gather(*[getArticles(conn, page, order, fields) for page in pages]))
+
+"""
+添加移除文章到指定的群组中，所有SADD和SREM使用一个流水线发送
+
+@param {object}
+@param {int}   文章ID
+@param {array} 添加的群组
+@param {array} 移除的群组
+
+@return {object} gevent.Greenlet
+"""
+def addRemoveGroups(conn, article_id, to_add = [], to_remove = []):
+    def run():
+        article = 'article:' + article_id
+        pipe = conn.pipeline(False)
+        for group in to_add:
+            pipe.sadd('group:' + group, article)
+        for group in to_remove:
+            pipe.srem('group:' + group, article)
+        pipe.execute()
+
+    return gevent.spawn(run)
+
+"""
+根据评分或者发布时间对群组文章进行排序和分页，等待其他客户端生成群组有序集合时只让出当前协程
+
+@param {object}
+@param {string} 群组
+@param {int}    页码
+@param {string} 有序集合名称，可以是score:,time:
+@param {array}  需要取出的文章字段，默认取出全部字段
+@param {float}  第一次生成群组有序集合时，最多等待的秒数
+
+@return {object} gevent.Greenlet，结果为文章列表
+"""
+def getGroupArticles(conn, group, page, order = 'score:', fields = None, timeout = 1):
+    def run():
+        key = article_voted.refreshGroupArticles(conn, group, order, timeout, gevent.sleep)
+        return article_voted.getArticles(conn, page, key, fields)
+
+    return gevent.spawn(run)
+
+"""
+测试
+"""
+class TestArticleAsync(unittest.TestCase):
+    def setUp(self):
+        import redis_standin
+        self.conn = redis_standin.connect(db=15, modules=[article_voted])
+        self.addCleanup(redis_standin.restoreTime)
+
+    def tearDown(self):
+        self.conn.flushdb()
+        del self.conn
+        print
+        print
+
+    def testAsyncArticles(self):
+        conn = self.conn
+
+        # 同时发布几篇文章
+        ids = gather(*[postArticle(conn, 'user%s' % i, 'title %s' % i, 'http://www.example.com/%s' % i) for i in xrange(30)])
+        print "We posted articles:", ids
+        self.assertEquals(len(set(ids)), 30)
+
+        # 同时发送几批投票，结果的顺序和投票的顺序一致
+        article_voted.VOTE_BATCH_SIZE, batch_size = 4, article_voted.VOTE_BATCH_SIZE
+        try:
+            votes = [('voter%s' % i, 'article:' + str(ids[0])) for i in xrange(10)] + [('voter0', 'article:' + str(ids[0]))]
+            results = voteArticles(conn, votes).get()
+        finally:
+            article_voted.VOTE_BATCH_SIZE = batch_size
+        print "Vote results:", results
+        self.assertEquals(results, [True] * 10 + [False])
+        self.assertTrue(voteArticle(conn, 'voter10', 'article:' + str(ids[1])).get())
+
+        # 同时取出两页文章
+        first, second = getArticlePages(conn, [1, 2]).get()
+        self.assertEquals(first[0]['id'], 'article:' + str(ids[0]))
+        self.assertEquals(first[1]['id'], 'article:' + str(ids[1]))
+        self.assertEquals(len(first), 25)
+        self.assertEquals(len(second), 5)
+
+        addRemoveGroups(conn, str(ids[1]), ['new-group', 'old-group']).get()
+        addRemoveGroups(conn, str(ids[1]), [], ['old-group']).get()
+        articles = getGroupArticles(conn, 'new-group', 1).get()
+        print "Group articles:", articles
+        self.assertEquals([article['id'] for article in articles], ['article:' + str(ids[1])])
+        self.assertFalse(conn.exists('group:old-group'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,256 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import bisect
+import binascii
+import heapq
+import itertools
+import os
+import sys
+import threading
+import time
+import unittest
+
+from article_voted import (
+    ONE_WEEK_IN_SECONDS, VOTE_SCORE, ARTICLES_PER_PAGE,
+    markVoted, voteArticle, addRemoveGroups, refreshGroupArticles, invalidateArticleCache
+)
+
+"""
+将文章分片存储到多个redis节点
+文章的散列article:<id>和已投票用户集合voted:<id>根据文章ID通过一致性哈希分配到某一个节点上，
+同一篇文章的所有键都在同一个节点上，所以投票、群组等单篇文章的操作可以直接在这个节点上执行。
+全局的score:和time:变为每个节点各自的有序集合，只记录这个节点上的文章，取出文章列表时对各个节点的结果进行多路归并。
+文章ID的计数器保存在第一个节点上，每次预留ID_BLOCK_SIZE个ID，减少访问计数器的次数。
+
+@param {array} redis连接列表
+@param {array} 节点名称列表，默认为host:port/db，所有进程必须使用相同的名称才能得到相同的分片结果
+"""
+# 每个节点在哈希环上的虚拟节点数
+VIRTUAL_NODES = 160
+# 每次预留的文章ID数
+ID_BLOCK_SIZE = 100
+
+class ShardRing(object):
+    def __init__(self, conns, names = None):
+        self.conns = list(conns)
+        if names is None:
+            names = []
+            for conn in self.conns:
+                kwargs = conn.connection_pool.connection_kwargs
+                # unix socket连接没有host和port，使用socket路径
+                names.append('%s:%s/%s' % (
+                    kwargs.get('host', kwargs.get('path')), kwargs.get('port'), kwargs.get('db', 0)))
+
+        # 每个节点在哈希环上放置VIRTUAL_NODES个点，让文章尽量均匀地分布到各个节点
+        ring = []
+        for index, name in enumerate(names):
+            for i in xrange(VIRTUAL_NODES):
+                ring.append((binascii.crc32('%s-%s' % (name, i)) & 0xffffffff, index))
+        ring.sort()
+        self._points = [point for point, index in ring]
+        self._nodes = [index for point, index in ring]
+
+        self._lock = threading.Lock()
+        self._next_id = self._last_id = 0
+
+    def getShard(self, article_id):
+        # 顺时针找到哈希环上的第一个点
+        point = binascii.crc32(str(article_id)) & 0xffffffff
+        i = bisect.bisect(self._points, point) % len(self._points)
+        return self.conns[self._nodes[i]]
+
+    def nextArticleId(self):
+        with self._lock:
+            if self._next_id >= self._last_id:
+                self._last_id = self.conns[0].incr('article:', ID_BLOCK_SIZE) + 1
+                self._next_id = self._last_id - ID_BLOCK_SIZE
+            article_id = self._next_id
+            self._next_id += 1
+            return str(article_id)
+
+"""
+发布文章到文章ID所在的节点上，所有命令使用一个事务流水线发送，只需要一次通信往返
+
+@param {object} ShardRing
+@param {string} 用户
+@param {string} 文章title
+@param {string} 文章链接
+
+@return {string} 文章id
+"""
+def postShardedArticle(ring, user, title, link):
+    article_id = ring.nextArticleId()
+    now = time.time()
+
+    pipe = ring.getShard(article_id).pipeline()
+    voted = 'voted:' + article_id
+    markVoted(pipe, voted, user)
+    pipe.expire(voted, ONE_WEEK_IN_SECONDS)
+
+    article = 'article:' + article_id
+    pipe.hmset(article, {
+        'title': title,
+        'link': link,
+        'poster': user,
+        'time': now,
+        'votes': 1
+    })
+    pipe.zadd('time:', article, now)
+    pipe.zadd('score:', article, now + VOTE_SCORE)
+    pipe.execute()
+
+    invalidateArticleCache()
+    return article_id
+
+"""
+对文章投票，文章的所有键都在同一个节点上，直接在这个节点上执行voteArticle
+
+@param {object} ShardRing
+@param {string} 用户
+@param {string} 文章
+
+@return {boolean} 是否投票成功
+"""
+def voteShardedArticle(ring, user, article):
+    return voteArticle(ring.getShard(article.partition(':')[-1]), user, article)
+
+"""
+添加移除文章到指定的群组中，群组集合也保存在文章所在的节点上，每个节点只记录自己的群组文章
+
+@param {object} ShardRing
+@param {string} 文章ID
+@param {array}  添加的群组
+@param {array}  移除的群组
+"""
+def addRemoveShardedGroups(ring, article_id, to_add = [], to_remove = []):
+    addRemoveGroups(ring.getShard(article_id), article_id, to_add, to_remove)
+
+"""
+取出评分最高的文章，或者最新发布的文章
+（1）每个节点取出自己有序集合的前page * ARTICLES_PER_PAGE篇文章和分值
+（2）将各个节点的结果按照分值从大到小进行多路归并，取出指定页的文章
+（3）每个节点用一个流水线取出属于自己的文章的详细信息
+
+@param {object} ShardRing
+@param {int}    页码
+@param {string} 有序集合名称，可以是score:,time:
+@param {array}  需要取出的文章字段，默认取出全部字段
+
+@return array
+"""
+def getShardedArticles(ring, page, order = 'score:', fields = None):
+    start = (page - 1) * ARTICLES_PER_PAGE
+    end   = start + ARTICLES_PER_PAGE
+
+    # 每个节点都可能包含这一页的全部文章，需要取出到这一页为止的所有文章
+    # 分值相同时按照节点内的排名排序，保持每个节点原有的顺序
+    ranked = []
+    for index, conn in enumerate(ring.conns):
+        items = conn.zrevrange(order, 0, end - 1, withscores = True)
+        ranked.append([(-score, rank, index, id) for rank, (id, score) in enumerate(items)])
+    page_items = list(itertools.islice(heapq.merge(*ranked), start, end))
+
+    # 按照节点分组，每个节点用一个流水线取出文章信息
+    pipes = {}
+    for score, rank, index, id in page_items:
+        if index not in pipes:
+            pipes[index] = ring.conns[index].pipeline(False)
+        if fields:
+            pipes[index].hmget(id, fields)
+        else:
+            pipes[index].hgetall(id)
+    results = dict((index, iter(pipe.execute())) for index, pipe in pipes.items())
+
+    articles = []
+    for score, rank, index, id in page_items:
+        article_data = next(results[index])
+        if fields:
+            article_data = dict(zip(fields, article_data))
+        article_data['id'] = id
+
+        articles.append(article_data)
+
+    return articles
+
+"""
+根据评分或者发布时间对群组文章进行排序和分页，每个节点各自重建群组有序集合，再进行多路归并
+
+@param {object} ShardRing
+@param {string} 群组
+@param {int}    页码
+@param {string} 有序集合名称，可以是score:,time:
+@param {array}  需要取出的文章字段，默认取出全部字段
+
+@return array
+"""
+def getShardedGroupArticles(ring, group, page, order = 'score:', fields = None):
+    for conn in ring.conns:
+        key = refreshGroupArticles(conn, group, order)
+    return getShardedArticles(ring, page, key, fields)
+
+# 测试通过仓库根目录的redis_standin连接redis，设置环境变量REDIS_STANDIN=1时使用进程内的替身服务器和虚拟时间
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+"""
+测试
+"""
+class TestShardedArticle(unittest.TestCase):
+    """
+    使用3个数据库模拟3个redis节点
+    """
+    def setUp(self):
+        import redis_standin
+        modules = [sys.modules[__name__], sys.modules['article_voted']]
+        self.conns = [redis_standin.connect(db=db, modules=modules) for db in (12, 13, 14)]
+        self.addCleanup(redis_standin.restoreTime)
+        self.ring = ShardRing(self.conns)
+
+    def tearDown(self):
+        for conn in self.conns:
+            to_del = (
+                conn.keys('time:*') + conn.keys('voted:*') + conn.keys('score:*') +
+                conn.keys('article:*') + conn.keys('group:*')
+            )
+            if to_del:
+                conn.delete(*to_del)
+        del self.conns
+        print
+        print
+
+    def testShardedArticles(self):
+        ring = self.ring
+
+        article_ids = [postShardedArticle(ring, 'username', 'title %s' % i, 'http://www.baidu.com/%s' % i) for i in xrange(60)]
+        sizes = [conn.zcard('score:') for conn in self.conns]
+        print "Articles on each shard:", sizes
+        self.assertEquals(sum(sizes), 60)
+        self.assertTrue(all(sizes))
+
+        # 同一篇文章的所有键都在同一个节点上
+        shard = ring.getShard(article_ids[0])
+        self.assertTrue(shard.exists('article:' + article_ids[0]))
+        self.assertTrue(shard.exists('voted:' + article_ids[0]))
+
+        for i, article_id in enumerate(article_ids[:3]):
+            for voter in xrange(3 - i):
+                self.assertTrue(voteShardedArticle(ring, 'user%s' % voter, 'article:' + article_id))
+        self.assertFalse(voteShardedArticle(ring, 'user0', 'article:' + article_ids[0]))
+
+        articles = getShardedArticles(ring, 1, fields = ['title', 'votes'])
+        print "Top articles:", articles[:3]
+        self.assertEquals(len(articles), ARTICLES_PER_PAGE)
+        self.assertEquals([a['title'] for a in articles[:3]], ['title 0', 'title 1', 'title 2'])
+        self.assertEquals(articles[0]['votes'], '4')
+
+        pages = getShardedArticles(ring, 1, 'time:') + getShardedArticles(ring, 2, 'time:') + getShardedArticles(ring, 3, 'time:')
+        self.assertEquals(sorted(a['id'] for a in pages), sorted('article:' + i for i in article_ids))
+
+        for article_id in article_ids[:5]:
+            addRemoveShardedGroups(ring, article_id, ['shard-group'])
+        articles = getShardedGroupArticles(ring, 'shard-group', 1)
+        self.assertEquals(len(articles), 5)
+        self.assertEquals(articles[0]['title'], 'title 0')
+
+if __name__ == '__main__':
+    unittest.main()
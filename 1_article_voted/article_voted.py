@@ -2,52 +2,214 @@
 # -*- coding: utf-8 -*-
 
 import time
+import math
+import threading
+import os
+import sys
 import unittest
+from collections import OrderedDict
 
 # 截止时间，一周
 ONE_WEEK_IN_SECONDS = 7 * (24 * 60 * 60)
 # 计分常量
 VOTE_SCORE = 432
 
+"""
+记录已投票用户的方式，voted:<id>可以使用以下三种结构：
+set    集合，保存用户名，精确，但每个用户名都要占用内存
+bitmap 位图，以整数用户ID作为偏移量，精确，用户ID必须为整数，内存占用取决于最大的用户ID
+bloom  投票数不超过BLOOM_SET_LIMIT时仍然使用集合，超过之后在Lua脚本中转换为布隆过滤器，
+       每个用户设置BLOOM_HASHES个位，内存不再随投票数增长，但有很小的概率把没有投过票的用户当作已投票
+切换为bitmap或bloom之后，已经存在的集合仍然按集合使用（bloom会在超过BLOOM_SET_LIMIT时转换）；
+切换回set，或者在bitmap和bloom之间切换时，需要等旧的voted:键在一周后过期。
+"""
+VOTE_DEDUP = 'set'
+# 布隆过滤器按每篇文章的预期投票数和误判率计算大小：位数 m = -n * ln(p) / (ln2)^2，每个用户设置 k = m / n * ln2 个位
+BLOOM_EXPECTED_VOTES = 10000
+BLOOM_ERROR_RATE = .01
+BLOOM_BITS = int(math.ceil(-BLOOM_EXPECTED_VOTES * math.log(BLOOM_ERROR_RATE) / math.log(2) ** 2))
+BLOOM_HASHES = int(round(float(BLOOM_BITS) / BLOOM_EXPECTED_VOTES * math.log(2)))
+# 集合中的用户数超过这个值之后才转换为布隆过滤器，按vote_memory.py测得的大小，此时集合与布隆过滤器占用的内存相当
+BLOOM_SET_LIMIT = 200
+
+"""
+取得记录已投票用户时传给Lua脚本的参数：方式、用户以及布隆过滤器的参数
+
+@param {string} 用户
+
+@return {array}
+"""
+def dedupArgs(user):
+    if VOTE_DEDUP == 'bitmap':
+        # 位图的偏移量必须为整数用户ID
+        user = int(user)
+    return [VOTE_DEDUP, user, BLOOM_BITS, BLOOM_HASHES, BLOOM_SET_LIMIT]
+
+# Lua脚本中记录已投票用户的函数，从ARGV[first]开始为dedupArgs的结果，新投票时返回1
+MARK_VOTED_LUA = '''
+-- 用SHA1的前两段组合出hashes个位置
+local function bloomAdd(key, member, bits, hashes)
+    local digest = redis.sha1hex(member)
+    local h1 = tonumber(string.sub(digest, 1, 8), 16)
+    local h2 = tonumber(string.sub(digest, 9, 16), 16)
+    local new = 0
+    for i = 0, hashes - 1 do
+        if redis.call('setbit', key, (h1 + i * h2) % bits, 1) == 0 then
+            new = 1
+        end
+    end
+    return new
+end
+
+local function markVoted(key, first)
+    local mode, user = ARGV[first], ARGV[first + 1]
+    local bits, hashes, limit = tonumber(ARGV[first + 2]), tonumber(ARGV[first + 3]), tonumber(ARGV[first + 4])
+    local kind = redis.call('type', key)['ok']
+    -- 切换方式之前创建的集合，以及还没有超过limit的布隆过滤器，都按集合使用
+    if mode == 'set' or kind == 'set' or (mode == 'bloom' and kind == 'none') then
+        if mode ~= 'bloom' or redis.call('sismember', key, user) == 1 or redis.call('scard', key) < limit then
+            return redis.call('sadd', key, user)
+        end
+
+        -- 集合超过limit，转换为布隆过滤器，保留原来的过期时间
+        -- 一次创建全部的位，避免SETBIT逐步扩展字符串时按两倍预留内存
+        local members = redis.call('smembers', key)
+        local ttl = redis.call('pttl', key)
+        redis.call('set', key, string.rep('\\0', math.ceil(bits / 8)))
+        for _, member in ipairs(members) do
+            bloomAdd(key, member, bits, hashes)
+        end
+        if ttl > 0 then
+            redis.call('pexpire', key, ttl)
+        end
+    end
+
+    if mode == 'bitmap' then
+        return 1 - redis.call('setbit', key, user, 1)
+    end
+    return bloomAdd(key, user, bits, hashes)
+end
+'''
+
+"""
+将用户记录到已投票用户的集合、位图或者布隆过滤器中
+位图和布隆过滤器使用与发布、投票相同的Lua函数
+
+@param {object} 连接或者流水线
+@param {string} voted:<id>
+@param {string} 用户
+"""
+MARK_VOTED_SCRIPT = MARK_VOTED_LUA + '''
+return markVoted(KEYS[1], 1)
+'''
+
+def markVoted(conn, voted, user):
+    if VOTE_DEDUP == 'set':
+        conn.sadd(voted, user)
+        return
+
+    mark = conn.register_script(MARK_VOTED_SCRIPT)
+    mark(keys = [voted], args = dedupArgs(user))
+
 """
 发布文章
 （1）通过计数器INCR创建一个新的文章ID
 （2）将文章发布者ID添加到记录文章已投票用户名单的集合中，并用EXPIRE为这个集合设置过期时间，让redis在过期后自动删除这个集合
 （3）用HMSET存储文章的相关信息，并执行两个ZADD，将文章的初始评分与发布时间添加到两个相应的有序集合中
 
+以上6个命令都放在一个Lua脚本中由服务器执行，发布一篇文章只需要一次通信往返，
+并且键的布局（article:、voted:、time:、score:）与原来保持一致。
+
 @param {object}
 @param {string} 用户
 @param {string} 文章title
-@param
+@param {string} 文章链接
 
 @return {string} 文章id
 """
-def postArticle(conn, user, title, link):
-    # 创建一个新的文章ID
-    article_id = str(conn.incr('article:'))
+POST_ARTICLE_LUA = MARK_VOTED_LUA + '''
+local article_id = string.format('%d', redis.call('incr', KEYS[1]))
 
-    # 将文章发布者ID添加到记录文章已投票用户名单的集合中，并用EXPIRE为这个集合设置过期时间
-    voted = 'voted:' + article_id
-    conn.sadd(voted, user)
-    conn.expire(voted, ONE_WEEK_IN_SECONDS)
-    
+local voted = 'voted:' .. article_id
+markVoted(voted, 7)
+redis.call('expire', voted, ARGV[5])
+
+local article = 'article:' .. article_id
+redis.call('hmset', article,
+    'title', ARGV[2], 'link', ARGV[3], 'poster', ARGV[1], 'time', ARGV[4], 'votes', 1)
+
+redis.call('zadd', KEYS[2], ARGV[4], article)
+redis.call('zadd', KEYS[3], tonumber(ARGV[4]) + tonumber(ARGV[6]), article)
+
+return article_id
+'''
+
+def postArticle(conn, user, title, link):
     now = time.time()
-    
-    # 用HMSET存储文章的相关信息
-    article = 'article:' + article_id
-    conn.hmset(article, {
-        'title': title,
-        'link': link,
-        'poster': user,
-        'time': now,
-        'votes': 1
-    })
-    
-    # 执行两个ZADD，将文章的初始评分与发布时间添加到两个相应的有序集合中
-    conn.zadd('time:', article, now)
-    conn.zadd('score:', article, now + VOTE_SCORE)
-    
-    return article_id
+    # 将发布文章的所有命令交给Lua脚本执行，只需要一次通信往返
+    post = conn.register_script(POST_ARTICLE_LUA)
+    article_id = post(
+        keys = ['article:', 'time:', 'score:'],
+        args = [user, title, link, now, ONE_WEEK_IN_SECONDS, VOTE_SCORE] + dedupArgs(user))
+
+    # 文章列表发生了变化，清空本进程的文章列表缓存
+    invalidateArticleCache()
+    return str(article_id)
+
+"""
+批量发布文章
+（1）通过一次INCRBY为这一批文章预留连续的文章ID
+（2）每POST_BATCH_SIZE篇文章使用一个事务流水线写入，两个有序集合各只需要一次ZADD
+
+@param {object}
+@param {array}  文章列表，每个元素为(用户, 文章title, 文章链接)
+
+@return {array} 文章id列表
+"""
+# 每个流水线写入的文章数
+POST_BATCH_SIZE = 1000
+
+def postArticles(conn, articles):
+    articles = list(articles)
+    if not articles:
+        return []
+
+    # 一次预留全部文章ID
+    last_id = conn.incr('article:', len(articles))
+    first_id = last_id - len(articles) + 1
+
+    article_ids = []
+    for offset in xrange(0, len(articles), POST_BATCH_SIZE):
+        pipe = conn.pipeline()
+        times = []
+        scores = []
+        now = time.time()
+        for i, (user, title, link) in enumerate(articles[offset:offset + POST_BATCH_SIZE]):
+            article_id = str(first_id + offset + i)
+            article_ids.append(article_id)
+
+            voted = 'voted:' + article_id
+            markVoted(pipe, voted, user)
+            pipe.expire(voted, ONE_WEEK_IN_SECONDS)
+
+            article = 'article:' + article_id
+            pipe.hmset(article, {
+                'title': title,
+                'link': link,
+                'poster': user,
+                'time': now,
+                'votes': 1
+            })
+            times.extend([article, now])
+            scores.extend([article, now + VOTE_SCORE])
+
+        # 整批文章的发布时间与评分各用一个ZADD写入
+        pipe.zadd('time:', *times)
+        pipe.zadd('score:', *scores)
+        pipe.execute()
+
+    invalidateArticleCache()
+    return article_ids
 
 
 """
@@ -56,53 +218,207 @@ def postArticle(conn, user, title, link):
 （2）从artcle:id标识符里面取出文章的ID
 （3）如果用户是第一次为这篇文章投票，那么增加这篇文章的投票数量和评分
 
+截止时间检查、已投票用户去重以及两个自增操作都放在一个Lua脚本中执行，
+这样在检查截止时间和更新评分之间不会有其他客户端插入，投票只需要一次通信往返。
+
 @param {object}
 @param {string} 用户
 @param {string} 文章
+@param {object} pipe 可选的流水线，传入时只将投票放入流水线
 
+@return {boolean} 是否投票成功
 """
-def voteArticle(conn, user, article):
-	# 判断文章是否超过了投票截止时间，如果超过，则不允许投票
-    outoff = time.time() - ONE_WEEK_IN_SECONDS
-    if conn.zscore('time:', article) < outoff:
-        return
-    
+VOTE_ARTICLE_LUA = MARK_VOTED_LUA + '''
+local posted = redis.call('zscore', KEYS[1], KEYS[4])
+if not posted or tonumber(posted) < tonumber(ARGV[1]) then
+    return 0
+end
+
+if markVoted(KEYS[2], 3) == 1 then
+    redis.call('zincrby', KEYS[3], ARGV[2], KEYS[4])
+    redis.call('hincrby', KEYS[4], 'votes', 1)
+    return 1
+end
+
+return 0
+'''
+
+def voteArticle(conn, user, article, pipe=None):
+    # 投票截止时间
+    cutoff = time.time() - ONE_WEEK_IN_SECONDS
     article_id = article.partition(':')[-1]
-    # 将用户添加到记录已投票用户名单的集合中
-    if conn.sadd('voted:' + article_id, user):
-    	# 增加该文章的评分和投票数量
-    	conn.zincrby('score:', article, VOTE_SCORE)
-    	conn.hincrby(article, 'votes', 1)
+
+    vote = conn.register_script(VOTE_ARTICLE_LUA)
+    result = vote(
+        keys = ['time:', 'voted:' + article_id, 'score:', article],
+        args = [cutoff, VOTE_SCORE] + dedupArgs(user),
+        client = pipe)
+
+    # 在流水线中执行时，结果要等到流水线执行之后才能取得
+    if pipe is None:
+        if result:
+            invalidateArticleCache()
+        return bool(result)
+
+"""
+批量投票
+每VOTE_BATCH_SIZE张投票使用一个非事务流水线发送，每张投票本身由Lua脚本保证原子性，
+一批投票只需要一次通信往返。
+
+@param {object}
+@param {array}  投票列表，每个元素为(用户, 文章)
+
+@return {array} 每张投票是否成功
+"""
+# 每个流水线发送的投票数
+VOTE_BATCH_SIZE = 1000
+
+def voteArticles(conn, votes):
+    votes = list(votes)
+
+    results = []
+    for offset in xrange(0, len(votes), VOTE_BATCH_SIZE):
+        pipe = conn.pipeline(False)
+        for user, article in votes[offset:offset + VOTE_BATCH_SIZE]:
+            voteArticle(conn, user, article, pipe)
+        results.extend(bool(result) for result in pipe.execute())
+
+    if any(results):
+        invalidateArticleCache()
+    return results
+
+"""
+文章列表的本地缓存
+前几页的文章列表每秒会被读取成千上万次，但变化得比较慢，可以在进程内缓存getArticles的结果，
+以(有序集合名称, 页码, 字段)作为键，缓存的结果在ttl秒之后过期，最多保存max_size页，超过时淘汰最近最少使用的页。
+本进程中执行postArticle或者voteArticle时，缓存会被提前清空。
+
+@param {float} 缓存的最长时间(秒)，也就是可以容忍的最大延迟
+@param {int}   最多缓存的页数
+"""
+class ArticleCache(object):
+    def __init__(self, ttl = 1, max_size = 100):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        # 每次清空缓存都会增加版本号，避免把清空之前读取的结果写入缓存
+        self.generation = 0
+        self._pages = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._pages.pop(key, None)
+            if entry is None or entry[0] < time.time():
+                self.misses += 1
+                return None
+
+            # 重新插入到末尾，标记为最近使用
+            self._pages[key] = entry
+            self.hits += 1
+            return [dict(article) for article in entry[1]]
+
+    def set(self, key, articles, generation):
+        with self._lock:
+            if generation != self.generation:
+                return
+
+            self._pages.pop(key, None)
+            self._pages[key] = (time.time() + self.ttl, articles)
+            # 淘汰最近最少使用的页
+            while len(self._pages) > self.max_size:
+                self._pages.popitem(last = False)
+
+    def invalidate(self):
+        with self._lock:
+            self._pages.clear()
+            self.generation += 1
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self._pages),
+                'hit_rate': float(self.hits) / total if total else 0.0,
+            }
+
+# 设置为ArticleCache实例时，getArticles会先查询本地缓存
+ARTICLE_CACHE = None
+
+"""
+清空本进程的文章列表缓存
+"""
+def invalidateArticleCache():
+    if ARTICLE_CACHE is not None:
+        ARTICLE_CACHE.invalidate()
 
 """
 取出评分最高的文章，或者最新发布的文章
 （1）我们需要使用ZREVRANGE命令取出多个文章ID。（由于有序集合会根据成员的分值从小到大地排列元素，使用ZREVRANGE以分值从大到小的排序取出文章ID）
 （2）对每个文章ID执行一次HGETALL命令来取出文章的详细信息。
 
+以上两步放在一个Lua脚本中执行，取出一页文章只需要一次通信往返，而不是每篇文章一次。
+列表页面可以通过fields只取出需要的字段，例如title、link、votes。
+
 @param {object}
 @param {int}    页码
 @param {string} 有序集合名称，可以是score:,time:
+@param {array}  需要取出的文章字段，默认取出全部字段
 
 @return array
 """
 # 每页的文章数
 ARTICLES_PER_PAGE = 25
 
-def getArticles(conn, page, order = 'score:'):
+GET_ARTICLES_LUA = '''
+local ids = redis.call('zrevrange', KEYS[1], ARGV[1], ARGV[2])
+local articles = {}
+for i, id in ipairs(ids) do
+    local data
+    if #ARGV > 2 then
+        data = {}
+        for j = 3, #ARGV do
+            data[#data + 1] = ARGV[j]
+            data[#data + 1] = redis.call('hget', id, ARGV[j])
+        end
+    else
+        data = redis.call('hgetall', id)
+    end
+    articles[i] = {id, data}
+end
+return articles
+'''
+
+def getArticles(conn, page, order = 'score:', fields = None):
+    # 先查询本地缓存
+    cache = ARTICLE_CACHE
+    if cache is not None:
+        cache_key = (order, page, tuple(fields or ()))
+        generation = cache.generation
+        articles = cache.get(cache_key)
+        if articles is not None:
+            return articles
+
     # 获取指定页码文章的起始索引和结束索引
     start = (page - 1) * ARTICLES_PER_PAGE
     end   = start + ARTICLES_PER_PAGE - 1
 
-    # 取出指定位置的文章id
-    article_ids = conn.zrevrange(order, start, end)
+    # 在服务器上取出指定位置的文章id以及文章的详细信息
+    fetch = conn.register_script(GET_ARTICLES_LUA)
+    rows = fetch(keys = [order], args = [start, end] + list(fields or []))
 
     articles = []
-    for id in article_ids:
-        article_data = conn.hgetall(id)
+    for id, data in rows:
+        article_data = dict(zip(data[::2], data[1::2]))
         article_data['id'] = id
 
         articles.append(article_data)
 
+    if cache is not None:
+        cache.set(cache_key, [dict(article) for article in articles], generation)
     return articles
 
 """
@@ -134,20 +450,144 @@ def addRemoveGroups(conn, article_id, to_add = [], to_remove = []):
 （3）使用上一步的getArticles函数来分页并获取群组文章。
 
 @param {object}
-@param {int}   文章ID
-@param {array} 添加的群组
-@param {array} 移除的群组
+@param {string} 群组
+@param {int}    页码
+@param {string} 有序集合名称，可以是score:,time:
+@param {array}  需要取出的文章字段，默认取出全部字段
+@param {float}  第一次生成群组有序集合时，最多等待的秒数
+
+@return array
+"""
+def getGroupArticles(conn, group, page, order = 'score:', fields = None, timeout = 1):
+    key = refreshGroupArticles(conn, group, order, timeout)
+    return getArticles(conn, page, key, fields)
 
 """
-def getGroupArticles(conn, group, page, order = 'score:'):
+在需要时重建群组有序集合
+为了避免缓存过期时多个客户端同时执行ZINTERSTORE，使用一个60秒过期的标记键来判断群组有序集合是否需要重建：
+只有通过SET NX成功设置标记键的客户端才会重建，其他客户端继续读取上一次生成的群组有序集合；
+只有在群组有序集合第一次生成时，其他客户端才需要等待重建完成。
+
+@param {object}
+@param {string} 群组
+@param {string} 有序集合名称，可以是score:,time:
+@param {float}  第一次生成群组有序集合时，最多等待的秒数
+@param {function} 等待时使用的休眠函数，默认为time.sleep
+
+@return {string} 群组有序集合名
+"""
+# 群组有序集合的缓存时间
+GROUP_CACHE_SECONDS = 60
+
+def refreshGroupArticles(conn, group, order = 'score:', timeout = 1, sleep = None):
     # 群组有序集合名
     key = order + group
+    # 标记群组有序集合是否需要重建的键
+    fresh_key = key + ':fresh'
+
+    pipe = conn.pipeline(False)
+    pipe.set(fresh_key, 'building', ex = GROUP_CACHE_SECONDS, nx = True)
+    pipe.get(fresh_key)
+    pipe.exists(key)
+    rebuild, state, exists = pipe.execute()
+
+    if rebuild:
+        # 只有设置了标记键的客户端才重建群组有序集合，上一次生成的结果保留到重建完成为止
+        pipe = conn.pipeline(False)
+        pipe.zinterstore(key, ['group:' + group, order], aggregate = 'max')
+        pipe.expire(key, GROUP_CACHE_SECONDS * 10)
+        pipe.set(fresh_key, 'ready', ex = GROUP_CACHE_SECONDS, xx = True)
+        pipe.execute()
+    elif state == 'building' and not exists:
+        # 群组有序集合正在第一次生成，等待重建完成
+        end = time.time() + timeout
+        while conn.get(fresh_key) == 'building' and time.time() < end:
+            (sleep or time.sleep)(.01)
+
+    return key
+
+"""
+归档已经截止投票的文章
+发布超过一周的文章不能再投票，但仍然留在score:和time:中，有序集合会随着文章总数不断增长。
+每次从time:中取出最多batch_size篇截止投票的文章，将它们的评分保存到归档散列中，并从score:和time:中移除，
+这样两个有序集合只保留投票期内的文章。
+
+归档散列按照文章ID分片，每个分片最多保存ARCHIVE_SHARD_SIZE篇文章，让redis可以使用压缩列表来存储散列，节约内存。
+
+@param {object}
+@param {int}    每批最多归档的文章数
 
-    if not conn.exists(key):
-        conn.zinterstore(key, ['group:' + group, order], aggregate = 'max')
-        conn.expire(key, 60)
+@return {int}   本次归档的文章数
+"""
+# 每个归档散列保存的文章数
+ARCHIVE_SHARD_SIZE = 128
+
+ARCHIVE_ARTICLES_LUA = '''
+local articles = redis.call('zrangebyscore', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+for i, article in ipairs(articles) do
+    local score = redis.call('zscore', KEYS[2], article)
+    if score then
+        local article_id = tonumber(string.match(article, '%d+$'))
+        local shard = string.format('%d', math.floor(article_id / tonumber(ARGV[3])))
+        redis.call('hset', 'archive:score:' .. shard, article, score)
+    end
+    redis.call('zrem', KEYS[2], article)
+    redis.call('zrem', KEYS[1], article)
+end
+return #articles
+'''
+
+def archiveClosedArticles(conn, batch_size = 1000):
+    cutoff = time.time() - ONE_WEEK_IN_SECONDS
+    archive = conn.register_script(ARCHIVE_ARTICLES_LUA)
+    count = archive(keys = ['time:', 'score:'], args = [cutoff, batch_size, ARCHIVE_SHARD_SIZE])
+
+    if count:
+        invalidateArticleCache()
+    return count
+
+"""
+取得文章的归档评分
 
-    return getArticles(conn, page, key)
+@param {object}
+@param {string} 文章
+
+@return {float} 文章评分，没有归档时返回None
+"""
+def getArchivedScore(conn, article):
+    article_id = int(article.partition(':')[-1])
+    score = conn.hget('archive:score:%d' % (article_id // ARCHIVE_SHARD_SIZE), article)
+    return float(score) if score is not None else None
+
+"""
+守护进程，分批归档已经截止投票的文章，没有需要归档的文章时休眠interval秒
+每批归档的文章数受batch_size限制，避免长时间阻塞redis，归档的文章数和耗时记录在SWEEP_STATS中
+
+@param {object}
+@param {int}    每批最多归档的文章数
+@param {float}  没有文章需要归档时的休眠时间
+"""
+# 循环判断，如果是cron job可以不用循环
+QUIT = False
+# 归档的文章数、耗时以及每秒归档的文章数
+SWEEP_STATS = {'archived': 0, 'seconds': 0.0, 'rate': 0.0}
+
+def sweepClosedArticles(conn, batch_size = 1000, interval = 60):
+    while not QUIT:
+        start = time.time()
+        count = archiveClosedArticles(conn, batch_size)
+
+        SWEEP_STATS['archived'] += count
+        SWEEP_STATS['seconds'] += time.time() - start
+        if SWEEP_STATS['seconds']:
+            SWEEP_STATS['rate'] = SWEEP_STATS['archived'] / SWEEP_STATS['seconds']
+
+        # 这一批没有取满，说明已经没有需要归档的文章了
+        if count < batch_size:
+            time.sleep(interval)
+
+# 测试通过仓库根目录的redis_standin连接redis，设置环境变量REDIS_STANDIN=1时使用进程内的替身服务器和虚拟时间
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
 
 """
 测试
@@ -157,8 +597,9 @@ class TestArticle(unittest.TestCase):
     初始化redis连接
     """
     def setUp(self):
-        import redis
-        self.conn = redis.Redis(db=15)
+        import redis_standin
+        self.conn = redis_standin.connect(db=15, modules=[sys.modules[__name__]])
+        self.addCleanup(redis_standin.restoreTime)
 
     """
     删除redis连接
@@ -211,7 +652,7 @@ class TestArticle(unittest.TestCase):
         print
         self.assertTrue(len(articles) >= 1)
 
-        测试结束，删除所有的数据结构
+        # 测试结束，删除所有的数据结构
         to_del = (
             conn.keys('time:*') + conn.keys('voted:*') + conn.keys('score:*') + 
             conn.keys('articles:*') + conn.keys('group:*')
@@ -220,6 +661,247 @@ class TestArticle(unittest.TestCase):
         if to_del:
             conn.delete(*to_del)
 
+    """
+    测试批量发布文章
+    """
+    def testPostArticles(self):
+        conn = self.conn
+
+        articles = [('user%s' % i, 'title %s' % i, 'http://www.baidu.com/%s' % i) for i in xrange(10)]
+        article_ids = postArticles(conn, articles)
+        print "我们批量发布了10篇文章，id为：", article_ids
+        print
+        self.assertEquals(len(article_ids), 10)
+
+        for article_id, (user, title, link) in zip(article_ids, articles):
+            article = 'article:' + article_id
+            self.assertEquals(conn.hget(article, 'title'), title)
+            self.assertEquals(conn.hget(article, 'votes'), '1')
+            self.assertTrue(conn.sismember('voted:' + article_id, user))
+            self.assertTrue(conn.ttl('voted:' + article_id) > 0)
+            self.assertTrue(conn.zscore('time:', article))
+            self.assertEquals(conn.zscore('score:', article) - conn.zscore('time:', article), VOTE_SCORE)
+
+        to_del = (
+            conn.keys('time:*') + conn.keys('voted:*') + conn.keys('score:*') +
+            conn.keys('article:*')
+        )
+        if to_del:
+            conn.delete(*to_del)
+
+    """
+    测试批量投票
+    """
+    def testVoteArticles(self):
+        conn = self.conn
+
+        article = 'article:' + postArticle(conn, 'username', 'A titile', 'http://www.baidu.com')
+        results = voteArticles(conn, [('user1', article), ('user2', article), ('user1', article), ('username', article)])
+        print "批量投票的结果：", results
+        print
+        self.assertEquals(results, [True, True, False, False])
+        self.assertEquals(conn.hget(article, 'votes'), '3')
+        self.assertEquals(conn.zscore('score:', article) - conn.zscore('time:', article), 3 * VOTE_SCORE)
+
+        # 超过投票截止时间的文章不能再投票
+        conn.zadd('time:', article, time.time() - ONE_WEEK_IN_SECONDS - 1)
+        self.assertFalse(voteArticle(conn, 'user3', article))
+        self.assertEquals(conn.hget(article, 'votes'), '3')
+
+        to_del = (
+            conn.keys('time:*') + conn.keys('voted:*') + conn.keys('score:*') +
+            conn.keys('article:*')
+        )
+        if to_del:
+            conn.delete(*to_del)
+
+    """
+    测试只取出文章的部分字段
+    """
+    def testGetArticlesFields(self):
+        conn = self.conn
+
+        article_ids = postArticles(conn, [('username', 'title %s' % i, 'http://www.baidu.com/%s' % i) for i in xrange(30)])
+        voteArticle(conn, 'other_user', 'article:' + article_ids[0])
+
+        articles = getArticles(conn, 1, fields = ['title', 'votes'])
+        print "只取出title和votes字段的文章："
+        print articles[:3]
+        print
+        self.assertEquals(len(articles), ARTICLES_PER_PAGE)
+        self.assertEquals(articles[0], {'id': 'article:' + article_ids[0], 'title': 'title 0', 'votes': '2'})
+
+        articles = getArticles(conn, 2, 'time:')
+        self.assertEquals(len(articles), 5)
+        self.assertEquals(set(articles[0]), set(['id', 'title', 'link', 'poster', 'time', 'votes']))
+
+        to_del = (
+            conn.keys('time:*') + conn.keys('voted:*') + conn.keys('score:*') +
+            conn.keys('article:*')
+        )
+        if to_del:
+            conn.delete(*to_del)
+
+    """
+    测试文章列表的本地缓存
+    """
+    def testArticleCache(self):
+        conn = self.conn
+        global ARTICLE_CACHE
+
+        article_ids = postArticles(conn, [('username', 'title %s' % i, 'http://www.baidu.com/%s' % i) for i in xrange(30)])
+        article = 'article:' + article_ids[0]
+        voteArticle(conn, 'other_user', article)
+
+        ARTICLE_CACHE = ArticleCache(ttl = 60, max_size = 2)
+        try:
+            getArticles(conn, 1)
+            conn.hset(article, 'title', 'changed behind the cache')
+            self.assertEquals(getArticles(conn, 1)[0]['title'], 'title 0')
+            print "缓存命中情况：", ARTICLE_CACHE.stats()
+            print
+            self.assertEquals(ARTICLE_CACHE.hits, 1)
+            self.assertEquals(ARTICLE_CACHE.misses, 1)
+
+            # 投票之后缓存被清空，重新从redis读取
+            voteArticle(conn, 'another_user', article)
+            articles = getArticles(conn, 1)
+            self.assertEquals(articles[0]['votes'], '3')
+            self.assertEquals(articles[0]['title'], 'changed behind the cache')
+
+            # 超过max_size时淘汰最近最少使用的页
+            getArticles(conn, 2)
+            getArticles(conn, 1, 'time:')
+            self.assertEquals(ARTICLE_CACHE.stats()['size'], 2)
+            getArticles(conn, 1)
+            self.assertEquals(ARTICLE_CACHE.misses, 5)
+        finally:
+            ARTICLE_CACHE = None
+
+        to_del = (
+            conn.keys('time:*') + conn.keys('voted:*') + conn.keys('score:*') +
+            conn.keys('article:*')
+        )
+        if to_del:
+            conn.delete(*to_del)
+
+    """
+    测试群组有序集合只由一个客户端重建
+    """
+    def testGroupArticlesRebuild(self):
+        conn = self.conn
+
+        article_ids = postArticles(conn, [('username', 'title %s' % i, 'http://www.baidu.com/%s' % i) for i in xrange(3)])
+        addRemoveGroups(conn, article_ids[0], ['rebuild-group'])
+
+        self.assertEquals(len(getGroupArticles(conn, 'rebuild-group', 1)), 1)
+        self.assertEquals(conn.get('score:rebuild-group:fresh'), 'ready')
+
+        # 标记键没有过期之前，继续使用上一次生成的群组有序集合
+        addRemoveGroups(conn, article_ids[1], ['rebuild-group'])
+        self.assertEquals(len(getGroupArticles(conn, 'rebuild-group', 1)), 1)
+
+        # 标记键过期之后，下一个客户端会重建群组有序集合
+        conn.delete('score:rebuild-group:fresh')
+        articles = getGroupArticles(conn, 'rebuild-group', 1)
+        print "重建之后的群组文章："
+        print articles
+        print
+        self.assertEquals(len(articles), 2)
+
+        to_del = (
+            conn.keys('time:*') + conn.keys('voted:*') + conn.keys('score:*') +
+            conn.keys('article:*') + conn.keys('group:*')
+        )
+        if to_del:
+            conn.delete(*to_del)
+
+    """
+    测试归档截止投票的文章
+    """
+    def testArchiveClosedArticles(self):
+        conn = self.conn
+        global QUIT
+
+        article_ids = postArticles(conn, [('username', 'title %s' % i, 'http://www.baidu.com/%s' % i) for i in xrange(5)])
+        closed = ['article:' + article_id for article_id in article_ids[:3]]
+        old = time.time() - ONE_WEEK_IN_SECONDS - 1
+        for article in closed:
+            conn.zadd('time:', article, old)
+            conn.zadd('score:', article, old + VOTE_SCORE)
+
+        print "Let's start a sweeper thread to archive the closed articles"
+        t = threading.Thread(target = sweepClosedArticles, args = (conn, 2, .1))
+        t.setDaemon(1)
+        t.start()
+        time.sleep(.5)
+        QUIT = True
+        time.sleep(.5)
+        QUIT = False
+        if t.isAlive():
+            raise Exception("The sweeper thread is still alive?!?")
+
+        print "Sweep stats:", SWEEP_STATS
+        print
+        self.assertEquals(conn.zcard('time:'), 2)
+        self.assertEquals(conn.zcard('score:'), 2)
+        self.assertEquals(getArchivedScore(conn, closed[0]), old + VOTE_SCORE)
+        self.assertEquals(getArchivedScore(conn, 'article:' + article_ids[3]), None)
+        self.assertFalse(voteArticle(conn, 'other_user', closed[0]))
+
+        to_del = (
+            conn.keys('time:*') + conn.keys('voted:*') + conn.keys('score:*') +
+            conn.keys('article:*') + conn.keys('archive:*')
+        )
+        if to_del:
+            conn.delete(*to_del)
+
+    """
+    测试使用位图和布隆过滤器记录已投票用户
+    """
+    def testVoteDedupBackends(self):
+        conn = self.conn
+        global VOTE_DEDUP, BLOOM_SET_LIMIT
+
+        # 切换方式之前发布的文章
+        old_article = 'article:' + postArticle(conn, '1', 'A titile', 'http://www.baidu.com')
+        limit = BLOOM_SET_LIMIT
+        try:
+            BLOOM_SET_LIMIT = 3
+            for backend, kind in (('bitmap', 'string'), ('bloom', 'set')):
+                VOTE_DEDUP = backend
+                article = 'article:' + postArticle(conn, '1', 'A titile', 'http://www.baidu.com')
+                postArticles(conn, [('1', 'A titile', 'http://www.baidu.com')])
+
+                results = voteArticles(conn, [('2', article), ('3', article), ('2', article), ('1', article)])
+                print "使用%s记录已投票用户，投票结果：" % backend, results
+                self.assertEquals(results, [True, True, False, False])
+                self.assertEquals(conn.hget(article, 'votes'), '3')
+                self.assertEquals(conn.type('voted:' + article.partition(':')[-1]), kind)
+                self.assertTrue(conn.ttl('voted:' + article.partition(':')[-1]) > 0)
+
+            print "布隆过滤器在超过BLOOM_SET_LIMIT个用户之后才创建"
+            results = voteArticles(conn, [('4', article), ('5', article), ('2', article), ('4', article)])
+            self.assertEquals(results, [True, True, False, False])
+            self.assertEquals(conn.type('voted:' + article.partition(':')[-1]), 'string')
+            self.assertTrue(conn.ttl('voted:' + article.partition(':')[-1]) > 0)
+
+            print "切换之前的集合仍然可以使用"
+            VOTE_DEDUP = 'bitmap'
+            self.assertEquals(voteArticles(conn, [('2', old_article), ('1', old_article)]), [True, False])
+            self.assertEquals(conn.type('voted:' + old_article.partition(':')[-1]), 'set')
+        finally:
+            VOTE_DEDUP = 'set'
+            BLOOM_SET_LIMIT = limit
+        print
+
+        to_del = (
+            conn.keys('time:*') + conn.keys('voted:*') + conn.keys('score:*') +
+            conn.keys('article:*')
+        )
+        if to_del:
+            conn.delete(*to_del)
+
 if __name__ == '__main__':
 	unittest.main()
 
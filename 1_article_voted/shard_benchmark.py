@@ -0,0 +1,111 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+文章分片的吞吐量测试
+在本机启动1、2、4...个redis-server进程作为分片节点，使用多个客户端进程同时发布文章、投票和读取文章列表，
+比较不同节点数下每秒完成的操作数。
+
+用法：python shard_benchmark.py --nodes 1 2 4 --clients 8 --seconds 10
+"""
+
+import argparse
+import multiprocessing
+import random
+import subprocess
+import time
+
+import redis
+
+from article_shard import ShardRing, postShardedArticle, voteShardedArticle, getShardedArticles
+
+"""
+启动一个不做持久化的redis-server进程，并等待它可以接受连接
+
+@param {int} 端口
+
+@return {object} 进程
+"""
+def startServer(port):
+    process = subprocess.Popen(
+        ['redis-server', '--port', str(port), '--save', '', '--appendonly', 'no'],
+        stdout = open('/dev/null', 'w'))
+
+    conn = redis.Redis(port=port)
+    for i in xrange(100):
+        try:
+            conn.ping()
+            return process
+        except redis.exceptions.ConnectionError:
+            time.sleep(.05)
+
+    process.kill()
+    raise Exception("redis-server on port %s did not start" % port)
+
+"""
+客户端进程，在指定时间内不断执行操作：10%发布文章，80%投票，10%读取第一页文章
+
+@param {array} 节点端口
+@param {float} 运行秒数
+@param {object} 保存操作数的队列
+"""
+def runClient(ports, seconds, results):
+    ring = ShardRing([redis.Redis(port=port) for port in ports])
+    article_ids = [postShardedArticle(ring, 'poster', 'title', 'http://www.baidu.com') for i in xrange(10)]
+
+    ops = 0
+    end = time.time() + seconds
+    while time.time() < end:
+        action = random.random()
+        if action < .1:
+            article_ids.append(postShardedArticle(ring, 'poster', 'title', 'http://www.baidu.com'))
+        elif action < .9:
+            user = 'user%s' % random.randint(0, 1000000)
+            voteShardedArticle(ring, user, 'article:' + random.choice(article_ids))
+        else:
+            getShardedArticles(ring, 1, fields = ['title', 'link', 'votes'])
+        ops += 1
+
+    results.put(ops)
+
+"""
+使用指定的节点数运行一次测试
+
+@param {int}   节点数
+@param {int}   客户端进程数
+@param {float} 运行秒数
+@param {int}   第一个节点的端口
+
+@return {float} 每秒操作数
+"""
+def benchmark(nodes, clients, seconds, base_port):
+    ports = [base_port + i for i in xrange(nodes)]
+    servers = [startServer(port) for port in ports]
+    try:
+        results = multiprocessing.Queue()
+        workers = [
+            multiprocessing.Process(target=runClient, args=(ports, seconds, results))
+            for i in xrange(clients)
+        ]
+        for worker in workers:
+            worker.start()
+        total = sum(results.get() for worker in workers)
+        for worker in workers:
+            worker.join()
+        return total / float(seconds)
+    finally:
+        for server in servers:
+            server.terminate()
+            server.wait()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='article sharding throughput benchmark')
+    parser.add_argument('--nodes', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--port', type=int, default=7000)
+    args = parser.parse_args()
+
+    for nodes in args.nodes:
+        rate = benchmark(nodes, args.clients, args.seconds, args.port)
+        print "%s node(s), %s clients: %.0f ops/sec" % (nodes, args.clients, rate)
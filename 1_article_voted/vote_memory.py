@@ -0,0 +1,68 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+比较三种记录已投票用户方式的内存占用
+对不同的投票数，分别使用集合、位图和布隆过滤器记录同一批用户，并通过MEMORY USAGE取得每个键占用的字节数。
+布隆过滤器在投票数超过BLOOM_SET_LIMIT之前仍然是集合，所以在这之前与集合的结果相同。
+需要redis 4.0以上版本。
+
+用法：python vote_memory.py --votes 100 1000 10000 --max-user-id 1000000
+"""
+
+import argparse
+import random
+
+import redis
+
+import article_voted
+from article_voted import markVoted
+
+"""
+使用指定的方式记录一批用户，返回键占用的字节数
+
+@param {object}
+@param {string} set, bitmap或者bloom
+@param {array}  用户ID列表
+
+@return {int}
+"""
+def measure(conn, backend, users):
+    key = 'memtest:voted:' + backend
+    conn.delete(key)
+
+    article_voted.VOTE_DEDUP = backend
+    pipe = conn.pipeline(False)
+    for user in users:
+        # 集合（以及还没有转换的布隆过滤器）中保存的是用户名，而不是整数ID（整数集合会使用更紧凑的intset编码）
+        markVoted(pipe, key, user if backend == 'bitmap' else 'user:' + user)
+    pipe.execute()
+
+    # 集合扩容时渐进式rehash，新旧两个哈希表都会被统计，结果取决于最后一次扩容之后执行了多少次操作；
+    # 每次查找都会推进一步rehash，旧哈希表的大小不超过元素数，查找同样次数之后rehash一定已经完成
+    if conn.type(key) == 'set':
+        for user in users:
+            pipe.sismember(key, '')
+        pipe.execute()
+
+    # SAMPLES 0统计所有元素，默认只抽样5个元素估算集合的大小
+    size = conn.execute_command('MEMORY', 'USAGE', key, 'SAMPLES', 0)
+    conn.delete(key)
+    return size
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='voted: memory comparison')
+    parser.add_argument('--votes', type=int, nargs='+', default=[10, 100, 1000, 10000])
+    parser.add_argument('--max-user-id', type=int, default=1000000)
+    parser.add_argument('--db', type=int, default=15)
+    args = parser.parse_args()
+
+    conn = redis.Redis(db=args.db)
+    print 'bloom: %s bits, %s hashes, set until %s votes' % (
+        article_voted.BLOOM_BITS, article_voted.BLOOM_HASHES, article_voted.BLOOM_SET_LIMIT)
+    print '%8s %12s %12s %12s' % ('votes', 'set', 'bitmap', 'bloom')
+    for votes in args.votes:
+        users = [str(user) for user in random.sample(xrange(args.max_user_id), votes)]
+        sizes = [measure(conn, backend, users) for backend in ('set', 'bitmap', 'bloom')]
+        print '%8s %12s %12s %12s' % tuple([votes] + sizes)
+    article_voted.VOTE_DEDUP = 'set'
@@ -0,0 +1,78 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+数据行缓存的吞吐量测试
+调度rows个数据行，每个数据行每隔delay秒缓存一次，使用不同数量的工作者进程同时领取和缓存到期的数据行，
+比较每秒缓存的数据行数。
+
+用法：python cache_row_benchmark.py --workers 1 2 4 8 --rows 100000 --delay 1 --seconds 10
+"""
+
+import argparse
+import multiprocessing
+import time
+
+import redis
+
+from shopping_website import scheduleRowCache, cacheDueRows
+
+"""
+工作者进程，在指定时间内不断领取和缓存到期的数据行
+
+@param {int}    数据库
+@param {int}    每次最多领取的数据行数
+@param {float}  运行秒数
+@param {object} 保存缓存行数的队列
+"""
+def runWorker(db, batch_size, seconds, results):
+    conn = redis.Redis(db=db)
+    rows = 0
+    end = time.time() + seconds
+    while time.time() < end:
+        count, next_due = cacheDueRows(conn, batch_size)
+        rows += count
+        if not count and next_due is not None:
+            time.sleep(max(0, min(.05, next_due - time.time())))
+    results.put(rows)
+
+"""
+使用指定的工作者数运行一次测试
+
+@return {float} 每秒缓存的数据行数
+"""
+def benchmark(conn, db, workers, rows, delay, batch_size, seconds):
+    conn.delete('schedule:', 'delay:')
+    pipe = conn.pipeline(False)
+    for i in xrange(rows):
+        scheduleRowCache(pipe, 'row%s' % i, delay)
+    pipe.execute()
+
+    results = multiprocessing.Queue()
+    processes = [
+        multiprocessing.Process(target=runWorker, args=(db, batch_size, seconds, results))
+        for i in xrange(workers)
+    ]
+    for process in processes:
+        process.start()
+    total = sum(results.get() for process in processes)
+    for process in processes:
+        process.join()
+
+    conn.delete(*(['schedule:', 'delay:'] + conn.keys('inv:*')))
+    return total / float(seconds)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='cacheRow throughput benchmark')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--delay', type=float, default=1)
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--db', type=int, default=15)
+    args = parser.parse_args()
+
+    conn = redis.Redis(db=args.db)
+    for workers in args.workers:
+        rate = benchmark(conn, args.db, workers, args.rows, args.delay, args.batch_size, args.seconds)
+        print "%s worker(s): %.0f rows/sec" % (workers, rate)
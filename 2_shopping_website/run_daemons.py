@@ -0,0 +1,57 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+在多个进程中运行购物网站的守护进程，并定期打印运行状态
+每个守护进程可以指定工作者进程数，0表示不运行；按Ctrl-C或者收到SIGTERM时，
+所有工作者完成当前一批之后退出。
+
+用法：python run_daemons.py --clean-workers 4 --cache-workers 2 --rescale-workers 1 --report 5
+"""
+
+import argparse
+import signal
+import time
+import json
+
+import redis
+
+from shopping_website import cleanFullSessionDaemon, cacheRowDaemon, rescaleViewedDaemon
+# shopping_website已经把仓库根目录加入了sys.path
+import redis_daemon
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='run the shopping website daemons')
+    parser.add_argument('--clean-workers', type=int, default=1)
+    parser.add_argument('--cache-workers', type=int, default=1)
+    parser.add_argument('--rescale-workers', type=int, default=1)
+    parser.add_argument('--batch-size', type=int, default=100, help='rows claimed by each cacheRow run')
+    parser.add_argument('--report', type=float, default=10, help='seconds between health reports')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=6379)
+    parser.add_argument('--db', type=int, default=0)
+    args = parser.parse_args()
+
+    connect = lambda: redis.Redis(host=args.host, port=args.port, db=args.db)
+    runner = redis_daemon.DaemonRunner(connect)
+    for daemon, workers in ((cleanFullSessionDaemon(), args.clean_workers),
+                            (cacheRowDaemon(args.batch_size), args.cache_workers),
+                            (rescaleViewedDaemon(), args.rescale_workers)):
+        if workers:
+            runner.start(daemon, workers)
+
+    # SIGTERM和Ctrl-C一样结束主循环，只在finally中停止一次所有工作者，报告是否都正常退出
+    def terminate(signum, frame):
+        raise KeyboardInterrupt()
+    signal.signal(signal.SIGTERM, terminate)
+    conn = connect()
+    try:
+        while runner.daemons:
+            time.sleep(args.report)
+            for name, health in sorted(runner.health(conn).items()):
+                health.pop('reports')
+                print name, json.dumps(health, sort_keys=True)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print "stopped cleanly" if runner.stop() else "some workers had to be killed"
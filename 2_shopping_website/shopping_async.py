@@ -0,0 +1,270 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+购物网站的异步接口
+每个函数都在一个新的协程中执行shopping_website中对应的函数，立即返回gevent.Greenlet，调用get()等待结果。
+连接使用redis_gevent.asyncRedis创建时，一个进程可以同时处理几千个请求。
+
+守护进程cleanFullSession、cacheRow和rescaleViewed也作为协程运行，不再使用全局的QUIT标志：
+每一次执行和退避都使用shopping_website中的redis_daemon.Daemon，由redis_daemon.runDaemon在协程中运行。
+startDaemons返回一个gevent.event.Event，设置这个事件之后，守护协程在当前一批完成后退出，
+休眠中的守护协程会立即被唤醒；stopDaemons等待它们退出，超时之后直接结束协程。
+
+用法：
+    conn = redis_gevent.asyncRedis(db=15)
+    stop, daemons = shopping_async.startDaemons(conn)
+    page = shopping_async.cacheRequest(conn, request, callback).get()
+    shopping_async.stopDaemons(stop, daemons)
+"""
+
+import os
+import sys
+import unittest
+
+import gevent
+import gevent.event
+
+# redis_gevent和redis_standin在仓库根目录
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import shopping_website
+import redis_daemon
+from redis_gevent import gather
+
+"""
+检查用户是否登录
+
+@param {object}
+@param {string} token
+
+@return {object} gevent.Greenlet，结果为用户id
+"""
+def checkToken(conn, token):
+    return gevent.spawn(shopping_website.checkToken, conn, token)
+
+"""
+更新令牌
+
+@param {object}
+@param {string} token
+@param {string} user
+@param {string} item
+
+@return {object} gevent.Greenlet
+"""
+def updateToken(conn, token, user, item = None):
+    return gevent.spawn(shopping_website.updateToken, conn, token, user, item)
+
+"""
+更新购物车
+
+@param {object}
+@param {string} session
+@param {string} item
+@param {float}  count
+
+@return {object} gevent.Greenlet
+"""
+def addToCart(conn, session, item, count):
+    return gevent.spawn(shopping_website.addToCart, conn, session, item, count)
+
+"""
+缓存请求
+没有一级缓存时，判断页面能否被缓存的ZRANK和取出缓存页面的MGET同时发送；
+有一级缓存时先判断页面能否被缓存，只有能被缓存的页面才会查询和写入一级缓存。
+等待其他调用者生成页面时只让出当前协程。
+
+@param {object} conn
+@param {string} request
+@param {callback}
+@param {int}    页面的缓存时间，默认CACHE_TTL
+@param {int}    页面过期之后仍然可以返回旧页面的时间，默认CACHE_STALE
+
+@return {object} gevent.Greenlet，结果为页面
+"""
+def cacheRequest(conn, request, callback, ttl = None, stale = None):
+    page_key = 'cache:' + shopping_website.hashRequest(request)
+    fresh_key = page_key + ':fresh'
+    ttl = shopping_website.CACHE_TTL if ttl is None else ttl
+    stale = shopping_website.CACHE_STALE if stale is None else stale
+
+    def load(checked = False):
+        if checked:
+            cacheable, cached = True, conn.mget(page_key, fresh_key)
+        else:
+            cacheable, cached = gather(
+                gevent.spawn(shopping_website.canCache, conn, request),
+                gevent.spawn(conn.mget, page_key, fresh_key))
+        if not cacheable:
+            return callback(request)
+        return shopping_website.loadCachedPage(
+            conn, page_key, request, callback, ttl, stale, cached = cached, sleep = gevent.sleep)
+
+    def run():
+        cache = shopping_website.PAGE_CACHE
+        if cache is None:
+            return load()
+        # 一级缓存会保存load的结果，所以必须先判断页面能否被缓存
+        if not shopping_website.canCache(conn, request):
+            return callback(request)
+        return cache.load(page_key, lambda: load(True))
+
+    return gevent.spawn(run)
+
+"""
+守护协程的休眠，停止事件被设置时立即唤醒；有工作时也让出一次CPU
+
+@param {object} gevent.event.Event
+@param {float}  秒数
+"""
+def waitEvent(stop, seconds):
+    if seconds > 0:
+        stop.wait(seconds)
+    else:
+        gevent.sleep(0)
+
+"""
+守护协程，清理超过限制的会话，直到stop被设置
+
+@param {object} conn
+@param {object} gevent.event.Event
+@param {float}  每次调用的耗时上限(秒)
+@param {int}    每批最多删除的令牌数
+"""
+def cleanFullSession(conn, stop, latency_budget = .01, max_batch = 10000):
+    daemon = shopping_website.cleanFullSessionDaemon(latency_budget, max_batch)
+    redis_daemon.runDaemon(conn, daemon, stop, wait_stop = waitEvent)
+
+"""
+守护协程，缓存到期的数据行，直到stop被设置
+
+@param {object} conn
+@param {object} gevent.event.Event
+@param {int}    每次最多领取的数据行数
+@param {float}  最长休眠时间(秒)
+"""
+def cacheRow(conn, stop, batch_size = 100, max_sleep = .5):
+    daemon = shopping_website.cacheRowDaemon(batch_size, max_sleep)
+    redis_daemon.runDaemon(conn, daemon, stop, wait_stop = waitEvent)
+
+"""
+守护协程，删除排名在VIEWED_KEEP之后的商品，并将剩余商品的浏览次数减半，每隔interval秒执行一次，直到stop被设置
+
+@param {object} conn
+@param {object} gevent.event.Event
+@param {int}    每批处理的商品数
+@param {float}  执行间隔(秒)
+"""
+def rescaleViewed(conn, stop, chunk_size = 1000, interval = 300):
+    daemon = shopping_website.rescaleViewedDaemon(chunk_size, interval)
+    redis_daemon.runDaemon(conn, daemon, stop, wait_stop = waitEvent)
+
+"""
+启动所有守护协程
+
+@param {object} conn
+
+@return {tuple} (停止事件, 守护协程列表)
+"""
+def startDaemons(conn):
+    stop = gevent.event.Event()
+    daemons = [gevent.spawn(daemon, conn, stop) for daemon in (cleanFullSession, cacheRow, rescaleViewed)]
+    return stop, daemons
+
+"""
+停止守护协程，等待它们完成当前一批，超时之后直接结束
+
+@param {object} gevent.event.Event
+@param {array}  守护协程列表
+@param {float}  最长等待时间(秒)
+"""
+def stopDaemons(stop, daemons, timeout = 5):
+    stop.set()
+    gevent.joinall(daemons, timeout = timeout)
+    gevent.killall([daemon for daemon in daemons if not daemon.ready()])
+
+"""
+测试
+"""
+class TestShoppingAsync(unittest.TestCase):
+    def setUp(self):
+        import redis_standin
+        self.conn = redis_standin.connect(db=15, modules=[shopping_website])
+        self.addCleanup(redis_standin.restoreTime)
+
+    def tearDown(self):
+        self.conn.flushdb()
+        del self.conn
+        shopping_website.LIMIT = 10000000
+        print
+        print
+
+    def testSessions(self):
+        conn = self.conn
+
+        gather(*[updateToken(conn, 'token%s' % i, 'user%s' % i, 'item%s' % i) for i in xrange(20)])
+        addToCart(conn, 'token0', 'item0', 3).get()
+        users = gather(*[checkToken(conn, 'token%s' % i) for i in xrange(20)])
+        print "Users:", users
+        self.assertEquals(users, ['user%s' % i for i in xrange(20)])
+        self.assertEquals(conn.hget('cart:token0', 'item0'), '3')
+
+        # 守护协程清理超过限制的会话，设置停止事件之后立即退出
+        shopping_website.LIMIT = 5
+        stop, daemons = startDaemons(conn)
+        gevent.sleep(.05)
+        stopDaemons(stop, daemons, 1)
+        print "Sessions left:", conn.zcard('recent:')
+        self.assertEquals(conn.zcard('recent:'), 5)
+        self.assertFalse(conn.exists('cart:token0'))
+        self.assertTrue(all(daemon.successful() for daemon in daemons))
+
+    def testCacheRequest(self):
+        conn = self.conn
+        calls = []
+        def callback(request):
+            calls.append(request)
+            gevent.sleep(.01)
+            return 'content for ' + request
+
+        conn.zadd('viewed:', 'itemX', -1)
+        request = 'http://test.com/?item=itemX'
+        pages = gather(*[cacheRequest(conn, request, callback) for i in xrange(10)])
+        print "Pages:", pages[0], len(calls)
+        self.assertEquals(pages, ['content for ' + request] * 10)
+        # 同时请求同一个页面时只生成一次
+        self.assertEquals(len(calls), 1)
+
+        # 不能被缓存的页面每次都生成
+        request = 'http://test.com/?item=itemY'
+        gather(cacheRequest(conn, request, callback), cacheRequest(conn, request, callback))
+        self.assertEquals(len(calls), 3)
+
+    def testCacheRequestWithPageCache(self):
+        conn = self.conn
+        calls = []
+        def callback(request):
+            calls.append(request)
+            return 'content %s for %s' % (len(calls), request)
+
+        conn.zadd('viewed:', 'itemX', -1)
+        shopping_website.PAGE_CACHE = shopping_website.PageCache(ttl = 60)
+        try:
+            # 动态页面不会写入一级缓存，每次都重新生成
+            request = 'http://test.com/?item=itemX&_=123'
+            pages = [cacheRequest(conn, request, callback).get() for i in xrange(2)]
+            print "Dynamic pages:", pages
+            self.assertEquals(pages, ['content 1 for ' + request, 'content 2 for ' + request])
+            self.assertEquals(shopping_website.PAGE_CACHE.stats()['size'], 0)
+
+            # 能被缓存的页面第二次直接从一级缓存返回
+            request = 'http://test.com/?item=itemX'
+            pages = [cacheRequest(conn, request, callback).get() for i in xrange(2)]
+            self.assertEquals(pages, ['content 3 for ' + request] * 2)
+            self.assertEquals(shopping_website.PAGE_CACHE.hits, 1)
+        finally:
+            shopping_website.PAGE_CACHE = None
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,11 +2,20 @@
 # -*- coding: utf-8 -*-
 
 import time
+import hashlib
 import urlparse
 import uuid
 import threading
+import os
+import sys
 import unittest
 import json
+from collections import OrderedDict
+
+# 守护进程运行框架redis_daemon以及测试使用的redis_standin在仓库根目录
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import redis_daemon
 
 """
 获取并返回令牌对应的用户
@@ -23,6 +32,8 @@ def checkToken(conn, token):
 更新令牌时，需要更改用户令牌信息，将用户记录到最近登录用户的有序集合中，
 如果用户浏览的是商品，则需要将浏览商品写入该用户浏览过商品的有序集合中，并保证该集合不超过25个
 
+所有命令使用一个非事务流水线发送，每次浏览页面只需要一次通信往返
+
 @param {object}
 @param {string} token
 @param {string} user
@@ -31,57 +42,217 @@ def checkToken(conn, token):
 """
 def updateToken(conn, token, user, item = None):
     timestamp = time.time()
+    pipe = conn.pipeline(False)
     # 更新用户令牌登录对应的用户信息
-    conn.hset('login:', token, user)
+    pipe.hset('login:', token, user)
     # 增加最近访问的用户到有序集合
-    conn.zadd('recent:', token, timestamp)
+    pipe.zadd('recent:', token, timestamp)
 
-	# 如果浏览产品，记录该用户最近访问的25个产品
+    # 如果浏览产品，记录该用户最近访问的25个产品
     if item:
-        conn.zadd('viewed:' + token, item, timestamp)
-        conn.zremrangebyrank('viewed:' + token, 0, -26)
+        pipe.zadd('viewed:' + token, item, timestamp)
+        pipe.zremrangebyrank('viewed:' + token, 0, -26)
         # 记录每个商品的浏览量
-        conn.zincrby('viewed:', item, -1)
+        pipe.zincrby('viewed:', item, -1)
+    pipe.execute()
+
+"""
+会话更新缓冲区
+在一个很短的时间窗口内合并对同一个令牌的多次更新，再用一个流水线批量写入：
+（1）每个令牌只写入最后一次的用户和时间戳，所有令牌使用一个HMSET和一个ZADD
+（2）每个令牌浏览过的商品使用一个ZADD写入，并只执行一次ZREMRANGEBYRANK
+（3）同一个商品的多次浏览合并为一个ZINCRBY
+
+缓冲区中的更新在写入之前对其他进程不可见，最多延迟window秒，或者缓冲的令牌数达到max_tokens时立即写入。
+
+@param {object} conn
+@param {float}  合并更新的时间窗口(秒)
+@param {int}    最多缓冲的令牌数
+"""
+class SessionBuffer(object):
+    def __init__(self, conn, window = .1, max_tokens = 1000):
+        self.conn = conn
+        self.window = window
+        self.max_tokens = max_tokens
+        # 每次写入的令牌数和命令数
+        self.flushed_tokens = 0
+        self.flushed_batches = 0
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        # token => [user, timestamp, {item: timestamp}]
+        self._sessions = {}
+        # item => 浏览次数
+        self._views = {}
+        self._started = None
+
+    def update(self, token, user, item = None):
+        timestamp = time.time()
+        with self._lock:
+            session = self._sessions.get(token)
+            if session is None:
+                session = self._sessions[token] = [user, timestamp, {}]
+            session[0] = user
+            session[1] = timestamp
+            if item:
+                session[2][item] = timestamp
+                self._views[item] = self._views.get(item, 0) + 1
+
+            if self._started is None:
+                self._started = timestamp
+            full = len(self._sessions) >= self.max_tokens
+
+        if full:
+            self.flush()
+
+    def due(self):
+        started = self._started
+        return started is not None and time.time() - started >= self.window
+
+    def flush(self):
+        with self._lock:
+            sessions, views = self._sessions, self._views
+            self._reset()
+        if not sessions:
+            return 0
+
+        pipe = self.conn.pipeline(False)
+        pipe.hmset('login:', dict((token, session[0]) for token, session in sessions.iteritems()))
+        recent = []
+        for token, session in sessions.iteritems():
+            recent.extend([token, session[1]])
+        pipe.zadd('recent:', *recent)
+
+        for token, (user, timestamp, items) in sessions.iteritems():
+            if not items:
+                continue
+            viewed = []
+            for item, viewed_at in items.iteritems():
+                viewed.extend([item, viewed_at])
+            pipe.zadd('viewed:' + token, *viewed)
+            pipe.zremrangebyrank('viewed:' + token, 0, -26)
+
+        # 同一个商品的多次浏览合并为一次ZINCRBY
+        for item, count in views.iteritems():
+            pipe.zincrby('viewed:', item, -count)
+        pipe.execute()
+
+        self.flushed_tokens += len(sessions)
+        self.flushed_batches += 1
+        return len(sessions)
+
+"""
+守护进程，定期将会话更新缓冲区写入redis，退出之前写入剩余的更新
+
+@param {object} SessionBuffer
+"""
+def flushSessionBuffer(buffer):
+    while not QUIT:
+        if buffer.due():
+            buffer.flush()
+        time.sleep(buffer.window / 10.0)
+    buffer.flush()
 
 """
 定期清理会话数据，只保留最新的1000万个会话。
 
 使用 *守护进程的方式来运行或者定义一个cron job每隔一段时间运行* ，
-检查最近 “记录最近登录用户的有序集合” 大小是否超过了限制，超过限制每秒从集合中删除最旧的100个令牌，
+检查最近 “记录最近登录用户的有序集合” 大小是否超过了限制，超过限制时从集合中删除最旧的令牌，
 并且移除相应的“登录令牌与用户映射关系的散列”的信息和对应的“记录各个用户最近浏览商品的有序集合”。
 
+每批删除的令牌数会根据积压的令牌数和每次调用的耗时自动调整：
+（1）一批全部删满，说明还有积压，下一批的大小加倍，最多为max_batch
+（2）一次调用的耗时超过latency_budget秒，下一批的大小减半，保证每次调用不会长时间阻塞redis
+（3）查询、删除令牌和相应的键在一个Lua脚本中完成，多个清理进程同时运行时不会重复删除
+（4）有积压时不休眠，没有积压时由redis_daemon退避，最多休眠max_sleep秒
+
+清理的令牌数、耗时、每秒清理的令牌数以及当前的批大小记录在CLEAN_STATS中。
+cleanFullSession(conn)在当前线程中运行，直到QUIT为True；
+cleanFullSessionDaemon()返回redis_daemon.Daemon，由redis_daemon.DaemonRunner在多个线程或进程中运行，
+积压量是超过限制的会话数，由DaemonRunner.health()报告。
+
 @param {object}
+@param {float}  每次调用的耗时上限(秒)
+@param {int}    每批最多删除的令牌数
+@param {float}  没有积压时的最长休眠时间(秒)
 """
 
-# 循环判断，如果是cron job可以不用循环
+# 循环判断，守护进程函数和flushSessionBuffer在QUIT为True时退出
 QUIT = False
 # 限制保留的最大会话数据
 LIMIT = 10000000
+# 清理的令牌数、耗时、每秒清理的令牌数以及当前的批大小
+CLEAN_STATS = {'reclaimed': 0, 'seconds': 0.0, 'rate': 0.0, 'batch_size': 0}
+CLEAN_STATS_LOCK = threading.Lock()
+
+CLEAN_SESSIONS_LUA = '''
+local size = redis.call('zcard', KEYS[1])
+local count = math.min(size - tonumber(ARGV[1]), tonumber(ARGV[2]))
+if count <= 0 then
+    return 0
+end
+
+local tokens = redis.call('zrange', KEYS[1], 0, count - 1)
+for i, token in ipairs(tokens) do
+    redis.call('del', 'viewed:' .. token, 'cart:' .. token)
+    redis.call('hdel', KEYS[2], token)
+end
+redis.call('zremrangebyrank', KEYS[1], 0, count - 1)
+return count
+'''
+
+def cleanFullSession(conn, latency_budget = .01, max_batch = 10000, max_sleep = 1):
+    redis_daemon.runDaemon(conn, cleanFullSessionDaemon(latency_budget, max_batch, max_sleep), QuitFlag())
+
+def cleanFullSessionDaemon(latency_budget = .01, max_batch = 10000, max_sleep = 1):
+    def step(conn, state):
+        # 每个工作者单独调整自己的批大小
+        count, state['batch_size'] = cleanSessionBatch(conn, state.get('batch_size', 100), latency_budget, max_batch)
+        return count
+
+    def backlog(conn):
+        return max(0, conn.zcard('recent:') - LIMIT)
+
+    return redis_daemon.Daemon('cleanFullSession', step, backlog, max_sleep = max_sleep)
 
-def cleanFullSession(conn):
-    # 循环判断，如果是cron job可以不用循环
-    while not QUIT:
-        # 查询最近登录用户会话数
-        size = conn.zcard('recent:')
-        # 没有超过限制，休眠1秒再继续执行
-        if size <= LIMIT:
-            time.sleep(1)
-            continue
-        
-        # 查询最旧登录的最多100个令牌范围
-        end_index = min(size - LIMIT, 100)
-        tokens = conn.zrange('recent:', 0, end_index - 1)
-        
-        # 将要删除的key都推入到数组中，要时候一起删除
-        session_keys = []
-        for token in tokens:
-            session_keys.append('viewed:' + token)
-            session_keys.append('cart:' + token)
-        
-        # 批量删除相应的用户最近浏览商品有序集合，用户的购物车，登录令牌与用户映射关系的散列和记录最近登录用户的有序集合
-        conn.delete(*session_keys)
-        conn.hdel('login:', *tokens)
-        conn.zrem('recent:', *tokens)
+"""
+把全局的QUIT标志作为redis_daemon.runDaemon的停止标志，直接调用守护进程函数时使用
+"""
+class QuitFlag(object):
+    def is_set(self):
+        return QUIT
+
+"""
+清理一批超过限制的会话，并根据耗时和积压情况计算下一批的大小
+
+@param {object}
+@param {int}    这一批最多删除的令牌数
+@param {float}  每次调用的耗时上限(秒)
+@param {int}    每批最多删除的令牌数
+
+@return {tuple} (删除的令牌数, 下一批的大小)
+"""
+def cleanSessionBatch(conn, batch_size, latency_budget = .01, max_batch = 10000):
+    clean = conn.register_script(CLEAN_SESSIONS_LUA)
+    start = time.time()
+    # 删除最旧的最多batch_size个令牌，以及相应的用户最近浏览商品有序集合，用户的购物车，登录令牌与用户映射关系的散列
+    count = clean(keys = ['recent:', 'login:'], args = [LIMIT, batch_size])
+    elapsed = time.time() - start
+
+    with CLEAN_STATS_LOCK:
+        CLEAN_STATS['reclaimed'] += count
+        CLEAN_STATS['seconds'] += elapsed
+        if CLEAN_STATS['seconds']:
+            CLEAN_STATS['rate'] = CLEAN_STATS['reclaimed'] / CLEAN_STATS['seconds']
+        CLEAN_STATS['batch_size'] = batch_size
+
+    # 根据耗时和积压情况调整下一批的大小
+    if count and elapsed > latency_budget:
+        batch_size = max(1, batch_size // 2)
+    elif count == batch_size:
+        batch_size = min(max_batch, batch_size * 2)
+    return count, batch_size
 
 """
 对购物车进行更新，如果用户订购某件商品数量大于0，将商品信息添加到 “用户的购物车散列”中，如果购买商品已经存在，那么更新购买数量
@@ -104,46 +275,253 @@ def addToCart(conn, session, item, count):
 在用户请求页面时，对于不能被缓存的请求，直接生成并返回页面，
 对于可以被缓存的请求，先从缓存取出缓存页面，如果缓存页面不存在，那么会生成页面并将其缓存在Redis，最后将页面返回给函数调用者。
 
+缓存分为两级：
+（1）PAGE_CACHE设置为PageCache实例时，先查询进程内的一级缓存，同一个进程中同一个页面同时只有一个调用者查询redis
+（2）redis中的二级缓存，页面保存ttl + stale秒，另外用一个ttl秒过期的标记键cache:<id>:fresh表示页面是否新鲜，
+标记键过期之后，通过SET NX重新设置标记键的调用者负责重新生成页面，其他调用者继续返回旧页面；
+页面不存在时，其他调用者等待生成页面的调用者，最多等待timeout秒
+
 @param {object} conn
 @param {string} request
 @param {callback}
+@param {int}    页面的缓存时间，默认CACHE_TTL
+@param {int}    页面过期之后仍然可以返回旧页面的时间，默认CACHE_STALE
 
 @return 
 """
-def cacheRequest(conn, request, callback):
+# 页面的缓存时间
+CACHE_TTL = 300
+# 页面过期之后，重新生成期间仍然可以返回旧页面的时间
+CACHE_STALE = 60
+# 设置为PageCache实例时，cacheRequest会先查询进程内的一级缓存
+PAGE_CACHE = None
+# 二级缓存的命中次数、返回旧页面的次数以及生成页面的次数
+CACHE_STATS = {'hits': 0, 'stale_hits': 0, 'misses': 0}
+CACHE_STATS_LOCK = threading.Lock()
+
+def cacheRequest(conn, request, callback, ttl = None, stale = None):
     # 判断请求是否能被缓存，不能的话直接调用回调函数
     if not canCache(conn, request):
         return callback(request)
     
     # 将请求转换为一个简单的字符串健，方便之后进行查找
     page_key = 'cache:' + hashRequest(request)
-    content = conn.get(page_key)
-    
-    # 没有缓存的页面，调用回调函数生成页面，并缓存到redis中
-    if not content:
-        content = callback(request)
-        conn.setex(page_key, content, 300)
 
+    def load():
+        return loadCachedPage(conn, page_key, request, callback,
+            CACHE_TTL if ttl is None else ttl, CACHE_STALE if stale is None else stale)
+
+    cache = PAGE_CACHE
+    if cache is not None:
+        return cache.load(page_key, load)
+    return load()
+
+"""
+从redis的二级缓存中取出页面，页面不存在或者已经过期时，只有一个调用者生成页面
+
+@param {object}   conn
+@param {string}   页面缓存键
+@param {string}   request
+@param {callback}
+@param {int}      页面的缓存时间
+@param {int}      页面过期之后仍然可以返回旧页面的时间
+@param {float}    等待其他调用者生成页面的最长时间
+@param {tuple}    已经用MGET取出的(页面, 标记键)，默认在这里取出
+@param {function} 等待时使用的休眠函数，默认为time.sleep
+
+@return
+"""
+def loadCachedPage(conn, page_key, request, callback, ttl, stale, timeout = 1, cached = None, sleep = None):
+    fresh_key = page_key + ':fresh'
+    content, fresh = cached or conn.mget(page_key, fresh_key)
+    if content is not None and fresh:
+        countCacheStat('hits')
+        return content
+
+    # 设置了标记键的调用者负责重新生成页面，并缓存到redis中
+    if conn.set(fresh_key, 1, ex = ttl, nx = True):
+        try:
+            content = callback(request)
+        except:
+            # 生成页面失败，让其他调用者可以重新生成
+            conn.delete(fresh_key)
+            raise
+        conn.setex(page_key, content, ttl + stale)
+        countCacheStat('misses')
+        return content
+
+    # 其他调用者正在重新生成页面，先返回旧页面
+    if content is not None:
+        countCacheStat('stale_hits')
+        return content
+
+    # 页面还不存在，等待其他调用者生成页面
+    end = time.time() + timeout
+    while time.time() < end:
+        (sleep or time.sleep)(.01)
+        content = conn.get(page_key)
+        if content is not None:
+            countCacheStat('hits')
+            return content
+
+    content = callback(request)
+    conn.setex(page_key, content, ttl + stale)
+    countCacheStat('misses')
     return content
 
+"""
+记录二级缓存的命中情况
+
+@param {string} hits, stale_hits或者misses
+"""
+def countCacheStat(name):
+    with CACHE_STATS_LOCK:
+        CACHE_STATS[name] += 1
+
+"""
+进程内的一级页面缓存
+页面缓存ttl秒，所有页面最多占用max_bytes字节，超过时淘汰最近最少使用的页面。
+同一个页面在本进程中同时只有一个调用者执行load，其他调用者等待它完成之后直接读取一级缓存。
+
+@param {float} 页面在一级缓存中的缓存时间(秒)
+@param {int}   一级缓存最多占用的字节数
+@param {float} 等待其他调用者加载页面的最长时间
+"""
+class PageCache(object):
+    def __init__(self, ttl = 5, max_bytes = 64 * 1024 * 1024, timeout = 1):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._pages = OrderedDict()
+        # 正在加载的页面 => threading.Event
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._pages.pop(key, None)
+            if entry is None:
+                return None
+            if entry[0] < time.time():
+                self.size -= len(entry[1])
+                return None
+
+            # 重新插入到末尾，标记为最近使用
+            self._pages[key] = entry
+            return entry[1]
+
+    def set(self, key, content):
+        with self._lock:
+            entry = self._pages.pop(key, None)
+            if entry is not None:
+                self.size -= len(entry[1])
+            if len(content) > self.max_bytes:
+                return
+
+            self._pages[key] = (time.time() + self.ttl, content)
+            self.size += len(content)
+            # 淘汰最近最少使用的页面
+            while self.size > self.max_bytes:
+                key, entry = self._pages.popitem(last = False)
+                self.size -= len(entry[1])
+
+    def load(self, key, loader):
+        content = self.get(key)
+        if content is not None:
+            with self._lock:
+                self.hits += 1
+            return content
+
+        with self._lock:
+            self.misses += 1
+            event = self._loading.get(key)
+            leader = event is None
+            if leader:
+                event = self._loading[key] = threading.Event()
+
+        # 其他调用者正在加载同一个页面，等待它完成
+        if not leader:
+            event.wait(self.timeout)
+            content = self.get(key)
+            if content is not None:
+                return content
+            return loader()
+
+        try:
+            content = loader()
+            self.set(key, content)
+            return content
+        finally:
+            with self._lock:
+                del self._loading[key]
+            event.set()
+
+    def stats(self):
+        with self._lock:
+            hits, misses, size = self.hits, self.misses, self.size
+        total = hits + misses
+        return {
+            'hits': hits,
+            'misses': misses,
+            'size': size,
+            'hit_rate': float(hits) / total if total else 0.0,
+        }
+
 """
 判断页面是否能被缓存，检查商品是否被缓存以及页面是否为商品页面，根据商品排名来判断是否需要缓存
 
+请求的URL只解析一次。VIEWED_SNAPSHOT设置为ViewedSnapshot实例时，使用本地定期刷新的前CACHE_ITEMS个商品集合判断排名，
+不需要每次都执行ZRANK。
+
 @param {object} conn
 @param {string} request
 
 @return {boolean}
 """
+# 浏览次数排名在前CACHE_ITEMS的商品页面才会被缓存
+CACHE_ITEMS = 10000
+# 设置为ViewedSnapshot实例时，canCache使用本地的热门商品集合
+VIEWED_SNAPSHOT = None
+
 def canCache(conn, request):
-    # 根据请求的URL，得到商品ID
-    item_id = extractItemId(request)
+    # 根据请求的URL，得到商品ID以及是否为动态页面
+    item_id, dynamic = classifyRequest(request)
     # 检查这个页面能否被缓存以及这个页面是否为商品页面
-    if not item_id or isDynamic(request):
+    if not item_id or dynamic:
         return False
 
+    snapshot = VIEWED_SNAPSHOT
+    if snapshot is not None:
+        return snapshot.contains(conn, item_id)
+
     # 商品的浏览排名
     rank = conn.zrank('viewed:', item_id)
-    return rank is not None and rank < 10000
+    return rank is not None and rank < CACHE_ITEMS
+
+"""
+解析请求的URL，取得query字典
+
+@param {string} request
+
+@return {dict}
+"""
+def parseRequest(request):
+    parsed = urlparse.urlparse(request)
+    return urlparse.parse_qs(parsed.query)
+
+"""
+对请求进行分类，只解析一次URL，取得query中的item id以及是否为动态页面
+
+@param {string} request
+
+@return {tuple} (item id, 是否为动态页面)
+"""
+def classifyRequest(request):
+    query = parseRequest(request)
+    return (query.get('item') or [None])[0], '_' in query
 
 """
 解析请求的URL,取得query中的item id
@@ -153,10 +531,7 @@ def canCache(conn, request):
 @return {string}
 """
 def extractItemId(request):
-    parsed = urlparse.urlparse(request)
-    # 返回query字典
-    query  = urlparse.parse_qs(parsed.query)
-    return (query.get('item') or [None])[0]
+    return classifyRequest(request)[0]
 
 """
 判断请求的页面是否动态页面
@@ -166,18 +541,47 @@ def extractItemId(request):
 @return {boolean}
 """
 def isDynamic(request):
-    parsed = urlparse.urlparse(request)
-    query = urlparse.parse_qs(parsed.query)
-    return '_' in query
+    return classifyRequest(request)[1]
 
 """
 将请求转换为一个简单的字符串健，方便之后进行查找
+使用md5而不是hash()，hash()的结果在不同的进程中可能不同，不同进程无法共享页面缓存
+
 @param {string} request
 
 @return {string}
 """
 def hashRequest(request):
-    return str(hash(request))
+    return hashlib.md5(request).hexdigest()
+
+"""
+本地的热门商品集合
+每隔refresh秒用一次ZRANGE取出浏览次数排名前limit的商品，判断商品排名时不需要访问redis。
+快照过期时只有一个调用者负责刷新，其他调用者继续使用旧的快照。
+
+@param {int}   商品数量
+@param {float} 刷新间隔(秒)
+"""
+class ViewedSnapshot(object):
+    def __init__(self, limit = CACHE_ITEMS, refresh = 10):
+        self.limit = limit
+        self.refresh = refresh
+        self.items = None
+        self.expires = 0
+        self._lock = threading.Lock()
+
+    def contains(self, conn, item_id):
+        if self.items is None or self.expires < time.time():
+            # 只有拿到锁的调用者刷新快照，第一次加载时其他调用者等待
+            if self._lock.acquire(self.items is None):
+                try:
+                    if self.items is None or self.expires < time.time():
+                        self.items = frozenset(conn.zrange('viewed:', 0, self.limit - 1))
+                        self.expires = time.time() + self.refresh
+                finally:
+                    self._lock.release()
+
+        return item_id in self.items
 
 """
 设置数据行缓存的延迟值和调度时间
@@ -194,44 +598,152 @@ def scheduleRowCache(conn, row_id, delay):
 """
 守护进程，根据调度时间有序集合和延迟值缓存数据行
 
+可以在多个线程或者进程中同时运行：
+（1）每次用一个Lua脚本领取最多batch_size个已经到期的数据行，领取时就更新它们的调度时间，其他工作者不会重复领取；
+延迟值小于或者等于0的数据行会被取消调度并删除缓存
+（2）批量读取领取到的数据行，并用一个流水线写入所有inv:*缓存
+（3）没有到期的数据行时，休眠到下一个数据行的调度时间，最多休眠max_sleep秒
+（4）积压量是已经到期还没有缓存的数据行数，延迟是最早到期的数据行已经过期的秒数
+
+cacheRow(conn)在当前线程中运行，直到QUIT为True；cacheRowDaemon()返回redis_daemon.Daemon，由redis_daemon.DaemonRunner运行。
+
+@param {object} conn
+@param {int}    每次最多领取的数据行数
+@param {float}  最长休眠时间(秒)
+"""
+def cacheRow(conn, batch_size = 100, max_sleep = .5):
+    redis_daemon.runDaemon(conn, cacheRowDaemon(batch_size, max_sleep), QuitFlag())
+
+def cacheRowDaemon(batch_size = 100, max_sleep = .5):
+    def step(conn, state):
+        return cacheDueRows(conn, batch_size)
+
+    def backlog(conn):
+        return conn.zcount('schedule:', '-inf', time.time())
+
+    def lag(conn):
+        first = conn.zrange('schedule:', 0, 0, withscores = True)
+        return max(0, time.time() - first[0][1]) if first else 0
+
+    return redis_daemon.Daemon('cacheRow', step, backlog, lag, max_sleep = max_sleep)
+
+"""
+领取并缓存一批已经到期的数据行
+
 @param {object} conn
+@param {int}    最多领取的数据行数
 
+@return {tuple} (缓存的数据行数, 下一个数据行的调度时间)
 """
-def cacheRow(conn):
-    while not QUIT:
-        # 需要读取”数据行缓存调度有序集合“的第一个元素，如果没有包含任何元素，或者分值存储的时间戳所指定的时间尚未来临，那么函数先休眠50毫秒，然后再重新进行检查
-        next = conn.zrange('schedule:', 0, 0, withscores=True)
-        now = time.time()
-        if not next or next[0][1] > now:
-            time.sleep(.05)
-            continue
-        
-        row_id = next[0][0]
-        # 取出延迟值
-        delay = conn.zscore('delay:', row_id)
-        # 如果延迟值小于等于0，则不再缓存该数据行
-        if delay <= 0:
-            conn.zrem('schedule:', row_id)
-            conn.zrem('delay:', row_id)
-            conn.delete('inv:' + row_id) 
-            continue;
-
-        # 需要缓存的，更新缓存调度的有序集合，并缓存该数据行
-        row = Inventory.get(row_id)
-        conn.zadd('schedule:', row_id, now + delay)
-        conn.set('inv:' + row_id, json.dumps(row.toDict()))
-
-"""
-守护进程，删除所有排名在20000名之后的商品，并将删除之后剩余的所有商品浏览次数减半，5分钟执行一次
+CLAIM_ROWS_LUA = '''
+local rows = redis.call('zrangebyscore', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+local claimed = {}
+for i, row in ipairs(rows) do
+    local delay = tonumber(redis.call('zscore', KEYS[2], row))
+    if not delay or delay <= 0 then
+        -- 延迟值小于等于0，则不再缓存该数据行
+        redis.call('zrem', KEYS[1], row)
+        redis.call('zrem', KEYS[2], row)
+        redis.call('del', 'inv:' .. row)
+    else
+        -- 更新调度时间，相当于领取了这个数据行
+        redis.call('zadd', KEYS[1], tonumber(ARGV[1]) + delay, row)
+        claimed[#claimed + 1] = row
+    end
+end
+
+local next_due = redis.call('zrange', KEYS[1], 0, 0, 'WITHSCORES')
+return {claimed, next_due[2] or false}
+'''
+
+def cacheDueRows(conn, batch_size = 100):
+    claim = conn.register_script(CLAIM_ROWS_LUA)
+    row_ids, next_due = claim(keys = ['schedule:', 'delay:'], args = [time.time(), batch_size])
+
+    if row_ids:
+        # 批量读取数据行，并用一个流水线缓存
+        pipe = conn.pipeline(False)
+        for row in Inventory.getMany(row_ids):
+            pipe.set('inv:' + row.id, json.dumps(row.toDict()))
+        pipe.execute()
+
+    return len(row_ids), float(next_due) if next_due else None
+
+"""
+守护进程，删除所有排名在20000名之后的商品，并将删除之后剩余的所有商品浏览次数减半，默认5分钟执行一次
+
+删除和减半都分成最多chunk_size个商品一批执行，每批都是一个很短的命令或者Lua脚本，
+无论记录了多少商品，redis每次被阻塞的时间都有上限。积压量是排名在VIEWED_KEEP之后的商品数。
+rescaleViewed(conn)在当前线程中运行，直到QUIT为True；rescaleViewedDaemon()返回redis_daemon.Daemon，由redis_daemon.DaemonRunner运行。
 
 @param {object} conn
+@param {int}    每批处理的商品数
+@param {float}  执行间隔(秒)
+"""
+# 保留浏览次数排名前VIEWED_KEEP的商品
+VIEWED_KEEP = 20000
+
+def rescaleViewed(conn, chunk_size = 1000, interval = 300):
+    redis_daemon.runDaemon(conn, rescaleViewedDaemon(chunk_size, interval), QuitFlag())
+
+def rescaleViewedDaemon(chunk_size = 1000, interval = 300):
+    def step(conn, state):
+        trimViewed(conn, VIEWED_KEEP, chunk_size)
+        halveViewed(conn, .5, chunk_size)
+        # 每次执行之后都休眠interval秒
+        return 0
+
+    def backlog(conn):
+        return max(0, conn.zcard('viewed:') - VIEWED_KEEP)
+
+    return redis_daemon.Daemon('rescaleViewed', step, backlog, min_sleep = interval, max_sleep = interval)
 
 """
-def rescaleViewed(conn):
-    while not QUIT:
-        conn.zremrangebyrank('viewed:', 20000, -1)
-        conn.zinterstore('viewed:', {'viewed:', .5})
-        time.sleep(300)
+分批删除排名在keep之后的商品，每批从末尾删除最多chunk_size个
+
+@param {object} conn
+@param {int}    保留的商品数
+@param {int}    每批删除的商品数
+"""
+def trimViewed(conn, keep = VIEWED_KEEP, chunk_size = 1000):
+    size = conn.zcard('viewed:')
+    while size > keep:
+        size = max(keep, size - chunk_size)
+        conn.zremrangebyrank('viewed:', size, -1)
+
+"""
+分批将所有商品的浏览次数乘以weight
+用ZSCAN按商品名称遍历viewed:，每批用一个Lua脚本把这些商品当前的浏览次数乘以weight。
+减半期间updateToken仍然在修改浏览次数，商品的排名会变化，所以不能按排名分批；
+ZSCAN保证遍历期间一直存在的商品至少返回一次，重复返回的商品在本地跳过，每个商品只减半一次。
+遍历期间新浏览的商品可能减半，也可能不减半。
+
+@param {object} conn
+@param {float}  权重
+@param {int}    每批处理的商品数
+"""
+RESCALE_MEMBERS_LUA = '''
+for i = 2, #ARGV do
+    local score = redis.call('zscore', KEYS[1], ARGV[i])
+    if score then
+        redis.call('zadd', KEYS[1], tonumber(score) * tonumber(ARGV[1]), ARGV[i])
+    end
+end
+'''
+
+def halveViewed(conn, weight = .5, chunk_size = 1000):
+    rescale = conn.register_script(RESCALE_MEMBERS_LUA)
+    rescaled = set()
+    cursor = 0
+    while True:
+        cursor, items = conn.zscan('viewed:', cursor, count = chunk_size)
+        items = [item for item, score in items if item not in rescaled]
+        rescaled.update(items)
+        # 商品较少时，redis可能一次返回超过chunk_size个商品
+        for offset in xrange(0, len(items), chunk_size):
+            rescale(keys = ['viewed:'], args = [weight] + items[offset:offset + chunk_size])
+        if cursor == 0:
+            break
 
 """
 库存类，库存的商品信息
@@ -243,17 +755,24 @@ class Inventory(object):
     @classmethod
     def get(cls, id):
         return Inventory(id)
+
+    @classmethod
+    def getMany(cls, ids):
+        return [Inventory(id) for id in ids]
     
     def toDict(self):
         return {'id':self.id, 'data':'data to cache...','cached':time.time()}
 
+# 测试通过仓库根目录的redis_standin连接redis，设置环境变量REDIS_STANDIN=1时使用进程内的替身服务器和虚拟时间
+
 """
 测试
 """
 class TestShoppingWebsite(unittest.TestCase):
     def setUp(self):
-        import redis
-        self.conn = redis.Redis(db=15)
+        import redis_standin
+        self.conn = redis_standin.connect(db=15, modules=[sys.modules[__name__], redis_daemon])
+        self.addCleanup(redis_standin.restoreTime)
     
     def tearDown(self):
         conn = self.conn
@@ -275,7 +794,7 @@ class TestShoppingWebsite(unittest.TestCase):
 
     def testLoginCookies(self):
         conn = self.conn
-        global LIMIT, QUIT
+        global LIMIT
         token = str(uuid.uuid4())
 
         updateToken(conn, token, 'username', 'itemX')
@@ -293,13 +812,10 @@ class TestShoppingWebsite(unittest.TestCase):
         print "We will start a thread to do the cleaning, while we stop it later"
 
         LIMIT = 0
-        t = threading.Thread(target = cleanFullSession, args = (conn,))
-        t.setDaemon(1)
-        t.start()
+        runner = redis_daemon.DaemonRunner(lambda: conn, processes = False)
+        runner.start(cleanFullSessionDaemon())
         time.sleep(1)
-        QUIT = True
-        time.sleep(2)
-        if t.isAlive():
+        if not runner.stop():
             raise Exception("The clean sessions thread is still slive?!?")
 
         s = conn.hlen('login:')
@@ -323,7 +839,7 @@ class TestShoppingWebsite(unittest.TestCase):
 
         print "Let's clean out our sessions an carts"
         LIMIT = 0
-        t = threading.Thread(target=cleanFullSession, args=(conn,))
+        t = threading.Thread(target = cleanFullSession, args = (conn,))
         t.setDaemon(1)
         t.start()
         time.sleep(1)
@@ -365,7 +881,6 @@ class TestShoppingWebsite(unittest.TestCase):
     def testCacheRows(self):
         import pprint
         conn = self.conn
-        global  QUIT
 
         print "First, let's schedule caching of itemX every 5 seconds"
         scheduleRowCache(conn, 'itemX', 5)
@@ -375,9 +890,8 @@ class TestShoppingWebsite(unittest.TestCase):
         self.assertTrue(s)
 
         print "We'll start a caching thread that will cache the data..."
-        t = threading.Thread(target=cacheRow, args=(conn,))
-        t.setDaemon(1)
-        t.start()
+        runner = redis_daemon.DaemonRunner(lambda: conn, processes = False)
+        runner.start(cacheRowDaemon())
         time.sleep(1)
         print "Our cached data looks like:"
         r = conn.get('inv:itemX')
@@ -401,11 +915,219 @@ class TestShoppingWebsite(unittest.TestCase):
         print
         self.assertFalse(r)
 
+        if not runner.stop():
+            raise Exception("The database caching thread is still alive?!?")
+
+
+    def testSessionBuffer(self):
+        conn = self.conn
+        global QUIT
+        tokens = [str(uuid.uuid4()) for i in xrange(3)]
+
+        buffer = SessionBuffer(conn, window = .1)
+        for token in tokens:
+            buffer.update(token, 'username', 'itemX')
+            buffer.update(token, 'username', 'itemY')
+        buffer.update(tokens[0], 'other_user')
+
+        print "Buffered updates are not written before the flush"
+        self.assertFalse(checkToken(conn, tokens[0]))
+
+        print "We'll start a flushing thread to write the buffered updates..."
+        t = threading.Thread(target = flushSessionBuffer, args = (buffer,))
+        t.setDaemon(1)
+        t.start()
+        time.sleep(.3)
         QUIT = True
-        time.sleep(2)
+        time.sleep(.1)
         if t.isAlive():
+            raise Exception("The session flushing thread is still alive?!?")
+
+        print "Flushed", buffer.flushed_tokens, "tokens in", buffer.flushed_batches, "batch(es)"
+        self.assertEquals(buffer.flushed_batches, 1)
+        self.assertEquals(checkToken(conn, tokens[0]), 'other_user')
+        self.assertEquals(conn.zcard('recent:'), 3)
+        self.assertEquals(conn.zrange('viewed:' + tokens[1], 0, -1), ['itemX', 'itemY'])
+        self.assertEquals(conn.zscore('viewed:', 'itemX'), -3)
+
+    def testCleanSessionWorkers(self):
+        conn = self.conn
+        global LIMIT
+        tokens = [str(uuid.uuid4()) for i in xrange(1000)]
+        for token in tokens:
+            updateToken(conn, token, 'username', 'itemX')
+            addToCart(conn, token, 'itemY', 1)
+
+        print "Let's keep the newest 10 sessions with 3 cleaning threads"
+        LIMIT = 10
+        CLEAN_STATS.update(reclaimed = 0, seconds = 0.0)
+        runner = redis_daemon.DaemonRunner(lambda: conn, processes = False)
+        runner.start(cleanFullSessionDaemon(), workers = 3)
+        time.sleep(.5)
+        health = runner.health()['cleanFullSession']
+        print "Daemon health:", health
+        self.assertEquals(health['workers'], 3)
+        self.assertEquals(health['backlog'], 0)
+        self.assertEquals(health['items'], 990)
+        if not runner.stop():
+            raise Exception("The clean sessions thread is still alive?!?")
+
+        print "Clean stats:", CLEAN_STATS
+        self.assertEquals(conn.zcard('recent:'), 10)
+        self.assertEquals(conn.hlen('login:'), 10)
+        self.assertEquals(CLEAN_STATS['reclaimed'], 990)
+        self.assertFalse(conn.exists('cart:' + tokens[0]))
+        self.assertTrue(conn.exists('cart:' + tokens[-1]))
+
+    def testTwoTierCache(self):
+        conn = self.conn
+        global PAGE_CACHE
+        token = str(uuid.uuid4())
+        calls = []
+
+        def callback(request):
+            calls.append(request)
+            time.sleep(.1)
+            return "content for " + request
+
+        updateToken(conn, token, 'username', 'itemX')
+        url = 'http://test.com/?item=itemX'
+        PAGE_CACHE = PageCache(ttl = 60)
+        try:
+            print "Let's request the same page from 5 threads at once"
+            threads = [threading.Thread(target = cacheRequest, args = (conn, url, callback)) for i in xrange(5)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertEquals(len(calls), 1)
+            self.assertEquals(cacheRequest(conn, url, None), "content for " + url)
+            print "L1 stats:", PAGE_CACHE.stats()
+            print "L2 stats:", CACHE_STATS
+            self.assertEquals(PAGE_CACHE.hits, 1)
+
+            print "After the page expires, stale content is served while one caller regenerates it"
+            PAGE_CACHE = None
+            conn.delete('cache:' + hashRequest(url) + ':fresh')
+            calls[:] = []
+            def stale_callback(request):
+                self.assertEquals(cacheRequest(conn, url, None), "content for " + url)
+                return "new " + callback(request)
+            self.assertEquals(cacheRequest(conn, url, stale_callback), "new content for " + url)
+            self.assertEquals(cacheRequest(conn, url, None), "new content for " + url)
+            self.assertEquals(len(calls), 1)
+        finally:
+            PAGE_CACHE = None
+
+    def testViewedSnapshot(self):
+        conn = self.conn
+        global VIEWED_SNAPSHOT
+        token = str(uuid.uuid4())
+
+        print "Cache keys are the same in every process"
+        self.assertEquals(hashRequest('http://test.com/?item=itemX'), '8991d4fe0216dbf3be556166b6c7dc77')
+        self.assertEquals(classifyRequest('http://test.com/?item=itemX&_=1234567'), ('itemX', True))
+
+        updateToken(conn, token, 'username', 'itemX')
+        VIEWED_SNAPSHOT = ViewedSnapshot(refresh = 60)
+        try:
+            self.assertTrue(canCache(conn, 'http://test.com/?item=itemX'))
+            self.assertFalse(canCache(conn, 'http://test.com/?item=itemY'))
+
+            print "Newly viewed items are only seen after the snapshot is refreshed"
+            updateToken(conn, token, 'username', 'itemY')
+            self.assertFalse(canCache(conn, 'http://test.com/?item=itemY'))
+            VIEWED_SNAPSHOT.expires = 0
+            self.assertTrue(canCache(conn, 'http://test.com/?item=itemY'))
+        finally:
+            VIEWED_SNAPSHOT = None
+
+    def testCacheRowWorkers(self):
+        conn = self.conn
+
+        print "Let's schedule 500 rows and cache them with 3 worker threads"
+        for i in xrange(500):
+            scheduleRowCache(conn, 'row%s' % i, 5)
+        scheduleRowCache(conn, 'row0', -1)
+
+        runner = redis_daemon.DaemonRunner(lambda: conn, processes = False)
+        daemon = cacheRowDaemon(50)
+        print "Backlog before the workers start:", daemon.backlog(conn), "rows,", daemon.lag(conn), "seconds behind"
+        self.assertEquals(daemon.backlog(conn), 500)
+        runner.start(daemon, workers = 3)
+        time.sleep(.5)
+        health = runner.health()['cacheRow']
+        self.assertEquals(health['backlog'], 0)
+        self.assertEquals(health['lag'], 0)
+        if not runner.stop():
             raise Exception("The database caching thread is still alive?!?")
 
+        self.assertEquals(len(conn.keys('inv:*')), 499)
+        self.assertFalse(conn.exists('inv:row0'))
+        self.assertEquals(conn.zcard('schedule:'), 499)
+        self.assertTrue(conn.zrange('schedule:', 0, 0, withscores = True)[0][1] > time.time())
+
+    def testRescaleViewed(self):
+        conn = self.conn
+
+        print "Let's record views for 50 items and rescale them in chunks of 7"
+        for i in xrange(50):
+            conn.zadd('viewed:', 'item%s' % i, -2 * (i + 1))
+        before = conn.zrange('viewed:', 0, 19)
+
+        trimViewed(conn, 20, 7)
+        halveViewed(conn, .5, 7)
+        after = conn.zrange('viewed:', 0, -1, withscores = True)
+        self.assertEquals([item for item, score in after], before)
+        self.assertEquals(dict(after), dict(('item%s' % i, -(i + 1.0)) for i in xrange(30, 50)))
+
+        print "The daemon runs right away and then once per interval"
+        global VIEWED_KEEP
+        VIEWED_KEEP, keep = 10, VIEWED_KEEP
+        try:
+            runner = redis_daemon.DaemonRunner(lambda: conn, processes = False)
+            runner.start(rescaleViewedDaemon(7, interval = 60))
+            time.sleep(1)
+            health = runner.health()['rescaleViewed']
+            self.assertEquals(health['runs'], 1)
+            self.assertEquals(health['backlog'], 0)
+            self.assertTrue(runner.stop())
+        finally:
+            VIEWED_KEEP = keep
+        self.assertEquals(conn.zrange('viewed:', 0, -1, withscores = True)[0], ('item49', -25.0))
+
+    def testRescaleViewedWhileViewing(self):
+        conn = self.conn
+
+        print "Items viewed while the rescale is running are rescaled exactly once"
+        for i in xrange(500):
+            conn.zadd('viewed:', 'item%s' % i, -4 if i % 5 else -2 * (i + 1))
+        before = dict(conn.zrange('viewed:', 0, -1, withscores = True))
+        # 每取得一批商品之前，再浏览一个已经减半的商品和一个新商品
+        zscan = conn.zscan
+        scanned = []
+        extra = {}
+        def interleaved(name, cursor = 0, **kwargs):
+            if scanned:
+                item = scanned[len(scanned) // 2]
+                updateToken(conn, 'token', 'user', item)
+                extra[item] = extra.get(item, 0) - 1
+                updateToken(conn, 'token', 'user', 'new%s' % len(scanned))
+            cursor, items = zscan(name, cursor, **kwargs)
+            scanned.extend(item for item, score in items)
+            return cursor, items
+        conn.zscan = interleaved
+        try:
+            halveViewed(conn, .5, 50)
+        finally:
+            del conn.zscan
+        self.assertTrue(len(extra) > 1)
+        after = dict(conn.zrange('viewed:', 0, -1, withscores = True))
+        for item, score in before.items():
+            self.assertEquals(after[item], score * .5 + extra.get(item, 0))
+        for item in after:
+            if item.startswith('new'):
+                self.assertTrue(after[item] in (-1, -.5))
 
 if __name__ == '__main__':
     unittest.main()
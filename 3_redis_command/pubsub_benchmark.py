@@ -0,0 +1,92 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+发布与订阅的吞吐量测试
+对每种消息大小，BatchPublisher发布指定数量的消息，Subscriber的工作线程处理消息，
+报告从开始发布到最后一条消息被处理之间每秒处理的消息数和字节数，以及丢弃的消息数和背压指标。
+--batch-size 1相当于每条消息单独发送一个PUBLISH，可以和批量发布比较。
+
+用法：python pubsub_benchmark.py --sizes 16 256 4096 16384 --messages 100000 --batch-size 1000
+      python pubsub_benchmark.py --standin --messages 10000
+"""
+
+import os
+import sys
+import time
+import argparse
+import threading
+
+import redis
+
+from redis_command import BatchPublisher, Subscriber
+
+"""
+使用指定的消息大小运行一次测试
+
+@return {dict} 测试结果
+"""
+def benchmark(conn, size, args):
+    handled = [0]
+    lock = threading.Lock()
+    def handler(channel, message):
+        with lock:
+            handled[0] += 1
+
+    subscriber = Subscriber(conn, {'benchmark': handler}, args.workers, args.queue_size, args.policy)
+    subscriber.start()
+    publisher = BatchPublisher(conn, args.batch_size)
+    message = 'x' * size
+
+    start = time.time()
+    publisher.start()
+    for i in xrange(args.messages):
+        publisher.publish('benchmark', message)
+    publisher.close()
+    # 等待所有消息被处理或者丢弃
+    end = time.time() + args.timeout
+    while time.time() < end:
+        stats = subscriber.stats()
+        if stats['handled'] + stats['dropped'] + stats['errors'] >= args.messages:
+            break
+        time.sleep(.001)
+    seconds = time.time() - start
+    subscriber.stop(drain = False)
+
+    stats = subscriber.stats()
+    return {
+        'messages_per_sec': handled[0] / seconds,
+        'mb_per_sec': handled[0] * size / seconds / 1024 / 1024,
+        'dropped': stats['dropped'],
+        'lost': args.messages - stats['received'],
+        'max_depth': stats['max_depth'],
+        'blocked_seconds': stats['blocked_seconds'],
+        'slow_events': stats['slow_events'],
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='pub/sub throughput benchmark')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[16, 256, 4096, 16384])
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--queue-size', type=int, default=10000)
+    parser.add_argument('--policy', choices=['block', 'drop'], default='block')
+    parser.add_argument('--timeout', type=float, default=60, help='seconds to wait for the subscriber')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=6379)
+    parser.add_argument('--standin', action='store_true', help='use the in-process redis_standin server')
+    args = parser.parse_args()
+
+    if args.standin:
+        sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+        import redis_standin
+        conn = redis_standin.standinRedis()
+    else:
+        conn = redis.Redis(host=args.host, port=args.port)
+
+    for size in args.sizes:
+        result = benchmark(conn, size, args)
+        print "%6s bytes: %8.0f messages/sec, %7.2f MB/sec, dropped %s, lost %s, max depth %s, blocked %.3f s, slow events %s" % (
+            size, result['messages_per_sec'], result['mb_per_sec'], result['dropped'], result['lost'],
+            result['max_depth'], result['blocked_seconds'], result['slow_events'])
@@ -1,7 +1,10 @@
 # !/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import os
+import sys
 import time
+import Queue
 import threading
 import unittest
 """
@@ -50,13 +53,273 @@ def trans(conn):
     # 执行被事务包裹的命令，并打印自增操作的执行结果
     print pipeline.execute()[0]
 
+"""
+批量发布消息，所有PUBLISH使用一个非事务流水线发送，每batch_size条消息只需要一次通信往返
+
+@param {object}
+@param {array}  消息列表，每个元素为(频道, 消息)
+@param {int}    每个流水线发送的消息数
+
+@return {array} 每条消息的接收者数量
+"""
+# 每个流水线发送的消息数
+PUBLISH_BATCH_SIZE = 1000
+
+def publishBatch(conn, messages, batch_size = PUBLISH_BATCH_SIZE):
+    messages = list(messages)
+
+    receivers = []
+    for offset in xrange(0, len(messages), batch_size):
+        pipe = conn.pipeline(False)
+        for channel, message in messages[offset:offset + batch_size]:
+            pipe.publish(channel, message)
+        receivers.extend(pipe.execute())
+    return receivers
+
+"""
+批量发布者
+publish()只把消息放入缓冲区，缓冲的消息达到batch_size条，或者最早的消息已经等待了window秒时，
+用一个流水线发送所有消息。调用start()之后由后台线程按时发送，close()发送剩余的消息并停止后台线程。
+缓冲的消息达到max_pending条时，publish()在调用者的线程中立即发送，调用者因此被减速（背压）。
+
+@param {object} conn
+@param {int}    每个流水线发送的消息数
+@param {float}  消息在缓冲区中最多等待的时间(秒)
+@param {int}    缓冲区最多保存的消息数
+"""
+class BatchPublisher(object):
+    def __init__(self, conn, batch_size = PUBLISH_BATCH_SIZE, window = .005, max_pending = 10000):
+        self.conn = conn
+        self.batch_size = batch_size
+        self.window = window
+        self.max_pending = max(batch_size, max_pending)
+        # 发布的消息数、流水线数，以及没有任何订阅者接收的消息数
+        self.published = 0
+        self.batches = 0
+        self.undelivered = 0
+        self._pending = []
+        self._started = None
+        self._lock = threading.Lock()
+        # 同时只有一个线程发送，保证消息的顺序
+        self._send_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def publish(self, channel, message):
+        with self._lock:
+            self._pending.append((channel, message))
+            if self._started is None:
+                self._started = time.time()
+            size = len(self._pending)
+
+        # 没有后台线程时，缓冲满一批就发送；有后台线程时，缓冲区满了才在调用者的线程中发送
+        if size >= (self.max_pending if self._thread else self.batch_size):
+            self.flush()
+
+    def due(self):
+        started = self._started
+        return started is not None and (
+            len(self._pending) >= self.batch_size or time.time() - started >= self.window)
+
+    def flush(self):
+        with self._send_lock:
+            with self._lock:
+                pending = self._pending
+                self._pending = []
+                self._started = None
+            if not pending:
+                return 0
+
+            receivers = publishBatch(self.conn, pending, self.batch_size)
+            self.published += len(pending)
+            self.batches += (len(pending) + self.batch_size - 1) // self.batch_size
+            self.undelivered += receivers.count(0)
+            return len(pending)
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target = self._run)
+        self._thread.setDaemon(1)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.is_set():
+            if self.due():
+                self.flush()
+            else:
+                time.sleep(self.window / 2.0)
+
+    def close(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def stats(self):
+        return {
+            'published': self.published,
+            'batches': self.batches,
+            'undelivered': self.undelivered,
+            'pending': len(self._pending),
+            'messages_per_batch': float(self.published) / self.batches if self.batches else 0.0,
+        }
+
+"""
+订阅者，读取线程从redis接收消息放入有界队列，由workers个工作线程调用各个频道的处理函数
+（1）队列满时，policy为'block'则读取线程等待工作线程，redis中这个客户端的输出缓冲区会随之增长，
+超过client-output-buffer-limit pubsub时redis会断开连接；policy为'drop'则丢弃新消息并计数
+（2）背压指标：队列长度及其最大值、读取线程因为队列满而等待的时间、丢弃的消息数、消息在队列中等待的最长时间
+（3）队列长度超过容量的slow_ratio，或者消息在队列中等待超过max_lag秒时，认为消费者过慢，
+记录一次slow_events并调用on_slow(stats)，两个条件都恢复之前不会重复报告；队列容量为0时不限制长度，只按等待时间判断
+
+@param {object} conn
+@param {dict}   频道：处理函数，处理函数的参数为(频道, 消息)
+@param {int}    工作线程数
+@param {int}    队列容量
+@param {string} 队列满时的策略，block或者drop
+@param {float}  判断消费者过慢的队列长度比例
+@param {float}  判断消费者过慢的等待时间(秒)
+@param {function} 消费者过慢时调用的函数
+"""
+class Subscriber(object):
+    def __init__(self, conn, handlers, workers = 4, queue_size = 10000, policy = 'block',
+            slow_ratio = .8, max_lag = 1, on_slow = None):
+        if policy not in ('block', 'drop'):
+            raise ValueError('policy must be block or drop')
+        self.conn = conn
+        self.handlers = handlers
+        self.workers = workers
+        self.queue = Queue.Queue(queue_size)
+        self.policy = policy
+        self.slow_ratio = slow_ratio
+        self.max_lag = max_lag
+        self.on_slow = on_slow
+        self.slow = False
+        # 分别记录队列长度和等待时间是否过慢，读取线程只更新队列长度
+        self._slow_depth = False
+        self._slow_lag = False
+        self.counters = dict.fromkeys(
+            ['received', 'handled', 'errors', 'dropped', 'slow_events', 'max_depth'], 0)
+        self.counters.update(blocked_seconds = 0.0, max_lag = 0.0)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._threads = []
+
+    def start(self):
+        self._stop.clear()
+        self.pubsub = self.conn.pubsub(ignore_subscribe_messages = True)
+        self.pubsub.subscribe(*self.handlers.keys())
+        self._threads = [threading.Thread(target = self._read)] + [
+            threading.Thread(target = self._work) for i in xrange(self.workers)]
+        for thread in self._threads:
+            thread.setDaemon(1)
+            thread.start()
+
+    def _count(self, name, value = 1):
+        with self._lock:
+            self.counters[name] += value
+
+    def _read(self):
+        while not self._stop.is_set():
+            message = self.pubsub.get_message(timeout = .1)
+            if message is None or message['type'] not in ('message', 'pmessage'):
+                continue
+            self._count('received')
+            item = (message['channel'], message['data'], time.time())
+
+            if self.policy == 'drop':
+                try:
+                    self.queue.put_nowait(item)
+                except Queue.Full:
+                    self._count('dropped')
+            else:
+                start = time.time()
+                while not self._stop.is_set():
+                    try:
+                        self.queue.put(item, timeout = .1)
+                        break
+                    except Queue.Full:
+                        pass
+                if time.time() - start > .001:
+                    self._count('blocked_seconds', time.time() - start)
+
+            depth = self.queue.qsize()
+            with self._lock:
+                self.counters['max_depth'] = max(self.counters['max_depth'], depth)
+            self._checkSlow(depth)
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            channel, data, received = item
+            lag = time.time() - received
+            try:
+                self.handlers[channel](channel, data)
+                self._count('handled')
+            except Exception:
+                self._count('errors')
+            finally:
+                self.queue.task_done()
+            with self._lock:
+                self.counters['max_lag'] = max(self.counters['max_lag'], lag)
+            self._checkSlow(self.queue.qsize(), lag)
+
+    def _checkSlow(self, depth, lag = None):
+        # 无界队列没有容量，不按队列长度判断
+        bounded = self.queue.maxsize > 0
+        with self._lock:
+            self._slow_depth = bounded and depth >= self.slow_ratio * self.queue.maxsize
+            if lag is not None:
+                self._slow_lag = lag > self.max_lag
+            slow = self._slow_depth or self._slow_lag
+            changed = slow != self.slow
+            self.slow = slow
+            if changed and slow:
+                self.counters['slow_events'] += 1
+        if changed and slow and self.on_slow is not None:
+            self.on_slow(self.stats())
+
+    """
+    停止订阅，drain为True时先处理完队列中的所有消息
+    """
+    def stop(self, drain = True):
+        self._stop.set()
+        self._threads[0].join()
+        self.pubsub.unsubscribe()
+        self.pubsub.close()
+        if not drain:
+            while True:
+                try:
+                    self.queue.get_nowait()
+                    self.queue.task_done()
+                except Queue.Empty:
+                    break
+        for thread in self._threads[1:]:
+            self.queue.put(None)
+        for thread in self._threads[1:]:
+            thread.join()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+        stats.update(depth = self.queue.qsize(), slow = self.slow)
+        return stats
+
+# 测试通过仓库根目录的redis_standin连接redis，设置环境变量REDIS_STANDIN=1时使用进程内的替身服务器和虚拟时间
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
 """
 测试
 """
 class TestRedisPubSub(unittest.TestCase):
     def setUp(self):
-        import redis
-        self.conn = redis.Redis(db=15)
+        import redis_standin
+        self.conn = redis_standin.connect(db=15, modules=[sys.modules[__name__]])
+        self.addCleanup(redis_standin.restoreTime)
     
     def tearDown(self):
         del self.conn
@@ -66,6 +329,77 @@ class TestRedisPubSub(unittest.TestCase):
     def testRunPubsub(self):
         runPubsub(self.conn)
 
+    def testBatchPublisher(self):
+        conn = self.conn
+        received = []
+        lock = threading.Lock()
+        def handler(channel, message):
+            with lock:
+                received.append((channel, message))
+
+        subscriber = Subscriber(conn, {'orders': handler, 'users': handler}, workers = 3)
+        subscriber.start()
+        publisher = BatchPublisher(conn, batch_size = 50)
+        publisher.start()
+        for i in xrange(500):
+            publisher.publish('orders' if i % 2 else 'users', i)
+        publisher.publish('nobody', 'lost')
+        publisher.close()
+        time.sleep(.5)
+        subscriber.stop()
+
+        print "Publisher:", publisher.stats()
+        print "Subscriber:", subscriber.stats()
+        self.assertEquals(publisher.published, 501)
+        self.assertEquals(publisher.undelivered, 1)
+        self.assertTrue(publisher.batches < 501)
+        self.assertEquals(sorted(int(message) for channel, message in received), range(500))
+        self.assertEquals(subscriber.stats()['handled'], 500)
+
+    def testSlowSubscriber(self):
+        conn = self.conn
+        slow = []
+        release = threading.Event()
+        def handler(channel, message):
+            release.wait()
+
+        subscriber = Subscriber(conn, {'channel': handler}, workers = 1, queue_size = 10,
+            policy = 'drop', on_slow = slow.append)
+        subscriber.start()
+        self.assertEquals(publishBatch(conn, [('channel', i) for i in xrange(30)], 7), [1] * 30)
+        time.sleep(.5)
+        release.set()
+        subscriber.stop()
+
+        stats = subscriber.stats()
+        print "Subscriber:", stats
+        self.assertEquals(stats['received'], 30)
+        self.assertEquals(stats['handled'] + stats['dropped'], 30)
+        self.assertTrue(stats['dropped'] >= 19)
+        self.assertEquals(stats['max_depth'], 10)
+        self.assertEquals(stats['slow_events'], 1)
+        self.assertTrue(slow and slow[0]['slow'])
+
+        # 无界队列只按等待时间判断
+        unbounded = Subscriber(conn, {'channel': handler}, queue_size = 0)
+        unbounded._checkSlow(1000, 0)
+        self.assertFalse(unbounded.slow)
+        unbounded._checkSlow(0, 5)
+        self.assertTrue(unbounded.slow)
+
+        # 等待时间一直很长时，读取线程检查队列长度不会清除过慢的状态，只报告一次
+        lagging = Subscriber(conn, {'channel': handler}, queue_size = 0, on_slow = slow.append)
+        for lag in xrange(3, 15):
+            lagging._checkSlow(1)
+            lagging._checkSlow(1, lag)
+        self.assertTrue(lagging.slow)
+        self.assertEquals(lagging.counters['slow_events'], 1)
+        # 恢复之后再次过慢时重新报告
+        lagging._checkSlow(0, 0)
+        self.assertFalse(lagging.slow)
+        lagging._checkSlow(1, 5)
+        self.assertEquals(lagging.counters['slow_events'], 2)
+
     def testTrans(self):
         for i in xrange(3):
             threading.Thread(target=trans, args=(self.conn,)).start()
@@ -1,8 +1,13 @@
 # !/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import os
+import sys
 import time
+import heapq
+import Queue
 import logging
+import threading
 import unittest
 import redis
 from datetime import datetime
@@ -43,17 +48,461 @@ def logRecent(conn, name, message, severity=logging.INFO, pip=None):
     pipe.ltrim(destination, 0, 99)
     pipe.execute()
 
+"""
+批量存储最新日志，所有消息使用一个非事务流水线写入，同一个日志列表只执行一次LPUSH和一次LTRIM
+
+@param {object}
+@param {array}  日志列表，每个元素为(消息队列名称, 消息, 安全级别, 记录时间)
+@param {int}    每个日志列表保留的消息数
+
+@return {int} 写入的消息数
+"""
+def logRecentBatch(conn, records, keep=100):
+    # 按照日志列表分组，保持消息的先后顺序
+    destinations = {}
+    order = []
+    for name, message, severity, created in records:
+        severity = str(SEVERITY.get(severity, severity)).lower()
+        destination = 'recent:%s:%s'%(name, severity)
+        if destination not in destinations:
+            destinations[destination] = []
+            order.append(destination)
+        destinations[destination].append(time.asctime(time.localtime(created)) + ' ' + message)
+
+    pipe = conn.pipeline(False)
+    for destination in order:
+        # LPUSH多个消息时依次插入到列表的最前面，和逐条LPUSH的结果相同
+        pipe.lpush(destination, *destinations[destination])
+        pipe.ltrim(destination, 0, keep - 1)
+    pipe.execute()
+    return len(records)
+
+"""
+把logging模块的日志写入最新日志列表的处理器
+emit()只把日志放入内存中的有界队列，由后台线程每次取出最多batch_size条，调用logRecentBatch批量写入，
+记录日志的线程不需要等待redis。队列满时，policy为drop则丢弃日志，为block则最多等待block_timeout秒再丢弃。
+counters中记录放入队列、写入、丢弃和写入失败的日志数，以及写入的批数。
+
+用法：
+    logging.getLogger().addHandler(RedisLogHandler(conn, 'web'))
+
+@param {object}
+@param {string} 消息队列名称
+@param {int}    队列容量
+@param {string} 队列满时的策略，drop或者block
+@param {float}  block策略下最多等待的时间(秒)，None表示一直等待
+@param {int}    每批最多写入的日志数
+@param {int}    每个日志列表保留的消息数
+@param {bool}   是否立即启动后台线程
+"""
+class RedisLogHandler(logging.Handler):
+    def __init__(self, conn, name, capacity=10000, policy='drop', block_timeout=None,
+            batch_size=1000, keep=100, start=True):
+        if policy not in ('drop', 'block'):
+            raise ValueError('policy must be drop or block')
+        logging.Handler.__init__(self)
+        self.conn = conn
+        # logging.Handler.name是处理器自己的名称，日志列表的名称单独保存
+        self.log_name = name
+        self.queue = Queue.Queue(capacity)
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.batch_size = batch_size
+        self.keep = keep
+        self.counters = dict.fromkeys(['queued', 'flushed', 'dropped', 'failed', 'batches'], 0)
+        self._counter_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        if start:
+            self.start()
+
+    def _count(self, name, value=1):
+        with self._counter_lock:
+            self.counters[name] += value
+
+    def emit(self, record):
+        try:
+            item = (self.log_name, self.format(record), record.levelno, record.created)
+        except Exception:
+            self.handleError(record)
+            return
+        try:
+            if self.policy == 'drop':
+                self.queue.put_nowait(item)
+            else:
+                self.queue.put(item, timeout=self.block_timeout)
+            self._count('queued')
+        except Queue.Full:
+            self._count('dropped')
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.setDaemon(1)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.is_set() or not self.queue.empty():
+            try:
+                records = [self.queue.get(timeout=.1)]
+            except Queue.Empty:
+                continue
+            # 取出已经在队列中的日志，凑成一批
+            while len(records) < self.batch_size:
+                try:
+                    records.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            try:
+                logRecentBatch(self.conn, records, self.keep)
+                self._count('flushed', len(records))
+                self._count('batches')
+            except Exception:
+                # redis不可用时丢弃这一批，记录日志的线程不受影响
+                self._count('failed', len(records))
+            finally:
+                for record in records:
+                    self.queue.task_done()
+
+    """
+    等待队列中已有的日志全部写入
+    """
+    def flush(self):
+        if self._thread is not None:
+            self.queue.join()
+
+    def close(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        logging.Handler.close(self)
+
+# 每个日志流大约保留的条目数
+STREAM_MAXLEN = 100000
+
+"""
+使用流存储结构化的日志，每个消息队列名称和安全级别一个流：stream:<name>:<severity>
+条目ID由redis根据服务器时间生成（毫秒-序号），所以不需要在消息中加入时间字符串，
+可以用XRANGE直接查询某个时间段内的日志；流使用MAXLEN ~近似裁剪，只在整个内部节点可以删除时才删除，开销很小。
+
+@param {object}
+@param {string} name     消息队列名称
+@param {string} message  消息
+@param {string} severity 安全级别
+@param {int}    maxlen   流大约保留的条目数
+@param {object} pipe     可选的流水线
+@param {dict}   fields   其他字段，例如host、pid
+
+@return {string} 条目ID，在流水线中执行时没有返回值
+"""
+def logStream(conn, name, message, severity=logging.INFO, maxlen=STREAM_MAXLEN, pipe=None, **fields):
+    severity = str(SEVERITY.get(severity, severity)).lower()
+    args = ['XADD', 'stream:%s:%s'%(name, severity), 'MAXLEN', '~', maxlen, '*', 'message', message]
+    for field, value in sorted(fields.items()):
+        args.extend([field, value])
+    # 空的流水线长度为0，不能使用pipe or conn
+    return (conn if pipe is None else pipe).execute_command(*args)
+
+"""
+把XRANGE、XREADGROUP返回的条目转换为字典，包括id、time（秒）、severity和所有字段
+
+@param {string} 安全级别
+@param {array}  条目列表，每个元素为[ID, [字段, 值, ...]]
+
+@return {array}
+"""
+def parseStreamEntries(severity, entries):
+    result = []
+    for entry_id, fields in entries:
+        entry = dict(zip(fields[::2], fields[1::2])) if fields else {}
+        entry['id'] = entry_id
+        entry['time'] = int(entry_id.partition('-')[0]) / 1000.0
+        entry['severity'] = severity
+        result.append(entry)
+    return result
+
+"""
+条目ID的排序键，ID的毫秒部分和序号部分都按照整数比较
+
+@param {dict} 日志条目
+
+@return {tuple} (毫秒, 序号)
+"""
+def streamIdKey(entry):
+    ms, dash, seq = entry['id'].partition('-')
+    return int(ms), int(seq or 0)
+
+"""
+查询某个时间段内指定安全级别的日志
+每个安全级别执行一次XRANGE（或者XREVRANGE），在一个流水线中发送，结果按照时间合并。
+
+@param {object}
+@param {string} name       消息队列名称
+@param {array}  severities 安全级别，默认为所有级别
+@param {float}  start      开始时间，默认为最早
+@param {float}  end        结束时间（包含），默认为最新
+@param {int}    count      最多返回的条目数
+@param {bool}   reverse    是否从最新的日志开始返回
+
+@return {array} 日志条目
+"""
+def queryStream(conn, name, severities=None, start=None, end=None, count=None, reverse=False):
+    severities = [str(SEVERITY.get(severity, severity)).lower() for severity in severities or
+        ['debug', 'info', 'warning', 'error', 'critical']]
+    low = '-' if start is None else '%d'%int(start * 1000)
+    high = '+' if end is None else '%d'%int(end * 1000)
+
+    pipe = conn.pipeline(False)
+    for severity in severities:
+        args = ['XREVRANGE', 'stream:%s:%s'%(name, severity), high, low] if reverse else \
+            ['XRANGE', 'stream:%s:%s'%(name, severity), low, high]
+        if count is not None:
+            args.extend(['COUNT', count])
+        pipe.execute_command(*args)
+
+    # 每个流的结果已经按照ID排好序，合并时只需要比较每个流的第一个条目；不同的流中ID可能相同，按照流的顺序排列
+    streams = []
+    sign = -1 if reverse else 1
+    for index, (severity, entries) in enumerate(zip(severities, pipe.execute())):
+        streams.append([(tuple(sign * part for part in streamIdKey(entry)), sign * index, entry)
+            for entry in parseStreamEntries(severity, entries or [])])
+    merged = [entry for key, index, entry in heapq.merge(*streams)]
+    return merged if count is None else merged[:count]
+
+"""
+使用消费者组读取日志流，同一个组中的多个聚合进程分担所有日志，每个条目只分发给其中一个消费者
+（1）createGroup()为每个安全级别的流创建消费者组，已经存在时忽略
+（2）read()先返回这个消费者以前领取但没有确认的条目（进程崩溃之后重新启动时），之后等待新的条目，最多等待block毫秒
+（3）处理完之后调用ack()确认，没有确认的条目在XPENDING中可以看到
+
+@param {object}
+@param {string} name       消息队列名称
+@param {string} group      消费者组
+@param {string} consumer   消费者名称，每个进程不同
+@param {array}  severities 安全级别，默认为所有级别
+@param {int}    count      每次从每个流最多读取的条目数
+@param {int}    block      没有新条目时的等待时间(毫秒)
+"""
+class StreamTailer(object):
+    def __init__(self, conn, name, group, consumer, severities=None, count=100, block=1000):
+        self.conn = conn
+        self.group = group
+        self.consumer = consumer
+        self.count = count
+        self.block = block
+        severities = [str(SEVERITY.get(severity, severity)).lower() for severity in severities or
+            ['debug', 'info', 'warning', 'error', 'critical']]
+        # 流名称：安全级别
+        self.streams = dict(('stream:%s:%s'%(name, severity), severity) for severity in severities)
+        self.keys = sorted(self.streams)
+        self._recovering = True
+
+    def createGroup(self, start='$'):
+        for key in self.keys:
+            try:
+                self.conn.execute_command('XGROUP', 'CREATE', key, self.group, start, 'MKSTREAM')
+            except redis.exceptions.ResponseError as error:
+                if not str(error).startswith('BUSYGROUP'):
+                    raise
+
+    def read(self):
+        if self._recovering:
+            reply = self.conn.execute_command('XREADGROUP', 'GROUP', self.group, self.consumer,
+                'COUNT', self.count, 'STREAMS', *(self.keys + ['0'] * len(self.keys)))
+            entries = self._parse(reply)
+            if entries:
+                return entries
+            # 以前领取的条目都已经确认
+            self._recovering = False
+
+        reply = self.conn.execute_command('XREADGROUP', 'GROUP', self.group, self.consumer,
+            'COUNT', self.count, 'BLOCK', self.block, 'STREAMS', *(self.keys + ['>'] * len(self.keys)))
+        return self._parse(reply)
+
+    def _parse(self, reply):
+        entries = []
+        for key, items in reply or []:
+            for entry in parseStreamEntries(self.streams[key], items):
+                entry['stream'] = key
+                entries.append(entry)
+        return sorted(entries, key=streamIdKey)
+
+    def ack(self, entries):
+        ids = {}
+        for entry in entries:
+            ids.setdefault(entry['stream'], []).append(entry['id'])
+        pipe = self.conn.pipeline(False)
+        for key, key_ids in ids.items():
+            pipe.execute_command('XACK', key, self.group, *key_ids)
+        return sum(pipe.execute())
+
+    """
+    不断读取、处理和确认日志，直到stop被设置
+
+    @param {function} 处理函数，参数为日志条目列表
+    @param {object}   threading.Event
+    """
+    def run(self, handler, stop):
+        while not stop.is_set():
+            entries = self.read()
+            if entries:
+                handler(entries)
+                self.ack(entries)
+
 """
 记录较高频率出现的日志，每小时一次的频率对消息进行轮换，并在轮换日志的时候保留上一个小时记录的常见消息
 
+检查是否需要轮换、轮换、ZINCRBY、LPUSH和LTRIM在一个Lua脚本中完成，不需要WATCH，
+并发写入时不会重试，也不会在整点轮换时丢失消息。
+消息所属的小时比当前的日志早一个小时（例如预先聚合的计数在整点之后才写入），计数会加到上一个小时的日志中。
+
+@param {object}
+@param {string} name    消息队列名称
+@param {string} message 消息
+@param {string} severity安全级别
+@param {int}    timeout 原来的执行超时时间，脚本不需要重试，保留这个参数只是为了兼容原来的调用
+@param {int}    count   出现次数
+@param {object} pipe    可选的流水线，传入时只将脚本放入流水线
+@param {float}  now     消息的记录时间，默认为当前时间
+
+"""
+LOG_COMMON_LUA = '''
+local existing = redis.call('get', KEYS[2])
+local target = KEYS[1]
+if existing and existing < ARGV[1] then
+    -- 将上个小时的常见日志归档
+    if redis.call('exists', KEYS[1]) == 1 then
+        redis.call('rename', KEYS[1], KEYS[4])
+    else
+        redis.call('del', KEYS[4])
+    end
+    redis.call('rename', KEYS[2], KEYS[5])
+    redis.call('set', KEYS[2], ARGV[1])
+elseif not existing then
+    redis.call('set', KEYS[2], ARGV[1])
+elseif existing > ARGV[1] and redis.call('get', KEYS[5]) == ARGV[1] then
+    -- 上个小时的消息在轮换之后才写入
+    target = KEYS[4]
+end
+
+redis.call('zincrby', target, ARGV[3], ARGV[2])
+redis.call('lpush', KEYS[3], ARGV[4])
+redis.call('ltrim', KEYS[3], 0, 99)
+'''
+
+def logCommon(conn, name, message, severity=logging.INFO, timeout=5, count=1, pipe=None, now=None):
+    # 设置日志安全级别
+    severity = str(SEVERITY.get(severity, severity)).lower()
+    # 负责存储近期的常见日志消息的键
+    destination = 'common:%s:%s'%(name, severity)
+    now = time.time() if now is None else now
+    # 当前所处的小时数
+    hour_start = datetime(*time.gmtime(now)[:4]).isoformat()
+
+    log = conn.register_script(LOG_COMMON_LUA)
+    log(
+        keys=[destination, destination + ':start', 'recent:%s:%s'%(name, severity),
+            destination + ':last', destination + ':pstart'],
+        args=[hour_start, message, count, time.asctime(time.localtime(now)) + ' ' + message],
+        client=pipe)
+
+"""
+常见日志的本地预先聚合
+log()只在进程内对相同的消息计数，后台线程每隔interval秒，或者不同的消息数达到max_messages时，
+用一个流水线为每个不同的消息执行一次logCommon，ZINCRBY的增量就是这段时间内的出现次数。
+计数按照消息所属的小时分开，整点之后写入的上一个小时的计数仍然加到上一个小时的日志中。
+每次写入时，每个不同的消息只在最新日志列表中记录一次。
+
+@param {object}
+@param {float}  写入间隔(秒)
+@param {int}    最多缓存的不同消息数
+@param {bool}   是否立即启动后台线程
+"""
+class CommonLogAggregator(object):
+    def __init__(self, conn, interval=1, max_messages=10000, start=True):
+        self.conn = conn
+        self.interval = interval
+        self.max_messages = max_messages
+        # 记录的消息数、写入的消息数以及写入的批数
+        self.logged = 0
+        self.flushed = 0
+        self.batches = 0
+        self._counts = {}
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        if start:
+            self.start()
+
+    def log(self, name, message, severity=logging.INFO):
+        now = time.time()
+        key = (name, message, str(SEVERITY.get(severity, severity)).lower(), int(now // 3600))
+        with self._lock:
+            entry = self._counts.get(key)
+            if entry is None:
+                entry = self._counts[key] = [0, now]
+            entry[0] += 1
+            entry[1] = now
+            self.logged += 1
+            full = len(self._counts) >= self.max_messages
+
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self._send_lock:
+            with self._lock:
+                counts = self._counts
+                self._counts = {}
+            if not counts:
+                return 0
+
+            pipe = self.conn.pipeline(False)
+            # 先写入较早的小时，保证轮换的顺序
+            for (name, message, severity, hour), (count, last) in sorted(counts.items(), key=lambda item: item[0][3]):
+                logCommon(self.conn, name, message, severity, count=count, pipe=pipe, now=last)
+            pipe.execute()
+            self.flushed += sum(count for count, last in counts.values())
+            self.batches += 1
+            return len(counts)
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.setDaemon(1)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.is_set():
+            time.sleep(self.interval)
+            self.flush()
+
+    def close(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+"""
+使用WATCH/MULTI记录常见日志，原来logCommon的实现，保留用于和Lua脚本的版本比较
+并发写入同一个日志时，每次都要重试，重试次数和超时之后丢失的消息数记录在WATCH_STATS中
+
 @param {object}
 @param {string} name    消息队列名称
 @param {string} message 消息
 @param {string} severity安全级别
 @param {int}    timeout 执行超时时间
 
+@return {bool} 是否记录成功
 """
-def logCommon(conn, name, message, severity=logging.INFO, timeout=5):
+# WATCH失败重试的次数，以及超时之后丢失的消息数
+WATCH_STATS = {'retries': 0, 'timeouts': 0}
+WATCH_STATS_LOCK = threading.Lock()
+
+def logCommonWatch(conn, name, message, severity=logging.INFO, timeout=5):
     # 设置日志安全级别
     severity = str(SEVERITY.get(severity, severity)).lower()
     # 负责存储近期的常见日志消息的键
@@ -88,17 +537,27 @@ def logCommon(conn, name, message, severity=logging.INFO, timeout=5):
             pipe.zincrby(destination, message)
             # 将日志记录到日志列表中，调用excute
             logRecent(pipe, name, message, severity, pipe)
-            return
+            return True
         except redis.exceptions.WatchError:
+            with WATCH_STATS_LOCK:
+                WATCH_STATS['retries'] += 1
             continue
 
+    with WATCH_STATS_LOCK:
+        WATCH_STATS['timeouts'] += 1
+    return False
+
+# 测试通过仓库根目录的redis_standin连接redis，设置环境变量REDIS_STANDIN=1时使用进程内的替身服务器和虚拟时间
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
 """
 单元测试
 """
 class TestLog(unittest.TestCase):
     def setUp(self):
-        import redis
-        self.conn = redis.Redis(db=15)
+        import redis_standin
+        self.conn = redis_standin.connect(db=15, modules=[sys.modules[__name__]])
+        self.addCleanup(redis_standin.restoreTime)
         self.conn.flushdb
 
     def tearDown(self):
@@ -136,5 +595,163 @@ class TestLog(unittest.TestCase):
         pprint.pprint(common)
         self.assertTrue(len(common) >= 5)
 
+    def testLogHandler(self):
+        conn = self.conn
+
+        print "Let's ship 250 log records through a logging handler"
+        logger = logging.getLogger('test.shipper')
+        logger.propagate = False
+        logger.setLevel(logging.INFO)
+        handler = RedisLogHandler(conn, 'test', batch_size=50)
+        # 日志列表的名称不会成为处理器的名称
+        self.assertEquals(handler.name, None)
+        logger.addHandler(handler)
+        try:
+            for i in xrange(200):
+                logger.info('this is message %s', i)
+            for i in xrange(50):
+                logger.error('this is error %s', i)
+            handler.flush()
+        finally:
+            logger.removeHandler(handler)
+            handler.close()
+
+        print "Handler counters:", handler.counters
+        recent = conn.lrange('recent:test:info', 0, -1)
+        self.assertEquals(len(recent), 100)
+        self.assertTrue(recent[0].endswith(' this is message 199'))
+        self.assertTrue(recent[-1].endswith(' this is message 100'))
+        self.assertEquals(conn.llen('recent:test:error'), 50)
+        self.assertEquals(handler.counters['flushed'], 250)
+        self.assertEquals(handler.counters['dropped'], 0)
+        self.assertTrue(handler.counters['batches'] >= 5)
+
+    def testLogHandlerDrops(self):
+        conn = self.conn
+
+        print "A full queue drops new records instead of blocking the caller"
+        handler = RedisLogHandler(conn, 'test', capacity=10, start=False)
+        record = logging.LogRecord('test', logging.WARNING, __file__, 0, 'warning %s', (1,), None)
+        for i in xrange(15):
+            handler.handle(record)
+        self.assertEquals(handler.counters['dropped'], 5)
+        handler.start()
+        handler.flush()
+        handler.close()
+        print "Handler counters:", handler.counters
+        self.assertEquals(handler.counters['flushed'], 10)
+        self.assertEquals(conn.lrange('recent:test:warning', 0, 0)[0].split(' ', 5)[-1], 'warning 1')
+
+    def testLogCommonRotation(self):
+        conn = self.conn
+
+        print "Pretend the common log was started in an earlier hour"
+        logCommon(conn, 'test', 'old message')
+        conn.set('common:test:info:start', '2000-01-01T00:00:00')
+        # 原来的第5个参数是timeout
+        logCommon(conn, 'test', 'new message', logging.INFO, 5)
+        print "Current:", conn.zrange('common:test:info', 0, -1, withscores=True)
+        print "Last hour:", conn.zrange('common:test:info:last', 0, -1, withscores=True)
+        self.assertEquals(conn.zrange('common:test:info', 0, -1, withscores=True), [('new message', 1)])
+        self.assertEquals(conn.zrange('common:test:info:last', 0, -1, withscores=True), [('old message', 1)])
+        self.assertEquals(conn.get('common:test:info:pstart'), '2000-01-01T00:00:00')
+
+        print "Counts from the previous hour that arrive late go to the archived log"
+        conn.set('common:test:info:pstart', datetime(*time.gmtime(time.time() - 3600)[:4]).isoformat())
+        logCommon(conn, 'test', 'old message', count=2, now=time.time() - 3600)
+        self.assertEquals(conn.zscore('common:test:info:last', 'old message'), 3)
+        self.assertEquals(conn.llen('recent:test:info'), 3)
+
+    def testCommonLogAggregator(self):
+        conn = self.conn
+
+        print "Let's count messages locally and flush them in one pipeline"
+        aggregator = CommonLogAggregator(conn, start=False)
+        for count in xrange(1, 6):
+            for i in xrange(count * 10):
+                aggregator.log('test', 'message-%s'%count)
+        aggregator.log('test', 'disk full', logging.ERROR)
+        self.assertFalse(conn.exists('common:test:info'))
+        self.assertEquals(aggregator.flush(), 6)
+        aggregator.close()
+
+        common = conn.zrevrange('common:test:info', 0, -1, withscores=True)
+        print "Common messages:", common
+        self.assertEquals(common, [('message-%s'%count, count * 10) for count in xrange(5, 0, -1)])
+        self.assertEquals(conn.zscore('common:test:error', 'disk full'), 1)
+        self.assertEquals(conn.llen('recent:test:info'), 5)
+        self.assertEquals((aggregator.logged, aggregator.flushed, aggregator.batches), (151, 151, 1))
+
+    def testLogCommonWatch(self):
+        conn = self.conn
+        for i in xrange(3):
+            self.assertTrue(logCommonWatch(conn, 'test', 'message'))
+        self.assertEquals(conn.zscore('common:test:info', 'message'), 3)
+
+    def testLogStream(self):
+        conn = self.conn
+
+        print "Let's write structured logs to streams and query them by time and severity"
+        start = time.time()
+        for i in xrange(10):
+            logStream(conn, 'test', 'request %s'%i, host='web1')
+            if i % 3 == 0:
+                time.sleep(.5)
+                logStream(conn, 'test', 'failure %s'%i, logging.ERROR)
+            time.sleep(1)
+        middle = start + 4.5
+
+        errors = queryStream(conn, 'test', [logging.ERROR], start=middle)
+        print "Errors after the middle:", errors
+        self.assertEquals([entry['message'] for entry in errors], ['failure 6', 'failure 9'])
+        self.assertTrue(all(entry['time'] >= middle for entry in errors))
+
+        merged = queryStream(conn, 'test', ['info', 'error'], end=middle)
+        self.assertEquals([entry['message'] for entry in merged][:3], ['request 0', 'failure 0', 'request 1'])
+        self.assertEquals(merged[0]['host'], 'web1')
+        self.assertEquals(len(merged), 6)
+
+        latest = queryStream(conn, 'test', count=2, reverse=True)
+        self.assertEquals([entry['message'] for entry in latest], ['failure 9', 'request 9'])
+
+        logStream(conn, 'trimmed', 'message', maxlen=5)
+        for i in xrange(300):
+            logStream(conn, 'trimmed', 'message', maxlen=5)
+        self.assertTrue(5 <= conn.execute_command('XLEN', 'stream:trimmed:info') < 300)
+
+    def testStreamTailer(self):
+        conn = self.conn
+
+        print "Two consumers in one group share the log entries"
+        tailers = [StreamTailer(conn, 'test', 'aggregators', 'consumer%s'%i, ['info', 'error'], count=4, block=100)
+            for i in xrange(2)]
+        tailers[0].createGroup()
+        tailers[1].createGroup()
+        for i in xrange(10):
+            logStream(conn, 'test', 'message %s'%i, logging.ERROR if i % 2 else logging.INFO)
+
+        first = tailers[0].read()
+        second = tailers[1].read()
+        self.assertEquals((len(first), len(second)), (8, 2))
+        self.assertFalse(set(entry['id'] for entry in first) & set(entry['id'] for entry in second))
+        self.assertEquals(tailers[0].ack(first), 8)
+
+        print "A restarted consumer gets its unacknowledged entries again"
+        restarted = StreamTailer(conn, 'test', 'aggregators', 'consumer1', ['info', 'error'], count=4, block=100)
+        self.assertEquals([entry['id'] for entry in restarted.read()], [entry['id'] for entry in second])
+        restarted.ack(second)
+
+        logStream(conn, 'test', 'message 10', logging.INFO)
+        logStream(conn, 'test', 'message 11', logging.ERROR)
+        seen = []
+        stop = threading.Event()
+        def handler(entries):
+            seen.extend(entries)
+            if len(seen) >= 2:
+                stop.set()
+        restarted.run(handler, stop)
+        self.assertEquals(len(seen), 2)
+        self.assertEquals(restarted.read(), [])
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,101 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+常见日志的并发写入测试
+threads个线程在指定时间内不断向同一个常见日志写入消息，比较三种实现：
+（1）watch：原来的WATCH/MULTI实现，报告每条消息的平均重试次数和超时丢失的消息数
+（2）script：检查轮换和写入在一个Lua脚本中完成
+（3）aggregate：CommonLogAggregator在进程内预先聚合，定期批量写入
+
+用法：python log_benchmark.py --threads 1 4 16 --seconds 5
+      python log_benchmark.py --standin --modes script aggregate
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+import threading
+
+import redis
+
+import log
+
+"""
+写入线程，在指定时间内不断记录常见日志
+
+@return {int} 记录的消息数
+"""
+def runWriter(conn, mode, aggregator, args, seed, results):
+    rand = random.Random(seed)
+    messages = ['message %s' % i for i in xrange(args.distinct)]
+    count = 0
+    end = time.time() + args.seconds
+    while time.time() < end:
+        message = messages[rand.randrange(len(messages))]
+        if mode == 'watch':
+            log.logCommonWatch(conn, 'benchmark', message, timeout=args.timeout)
+        elif mode == 'script':
+            log.logCommon(conn, 'benchmark', message)
+        else:
+            aggregator.log('benchmark', message)
+        count += 1
+    results.append(count)
+
+"""
+使用指定的实现和线程数运行一次测试
+
+@return {dict} 测试结果
+"""
+def benchmark(conn, mode, threads, args):
+    conn.delete('common:benchmark:info', 'common:benchmark:info:start', 'recent:benchmark:info')
+    log.WATCH_STATS.update(retries=0, timeouts=0)
+    aggregator = log.CommonLogAggregator(conn, args.interval) if mode == 'aggregate' else None
+
+    results = []
+    writers = [threading.Thread(target=runWriter, args=(conn, mode, aggregator, args, i, results))
+        for i in xrange(threads)]
+    start = time.time()
+    for writer in writers:
+        writer.start()
+    for writer in writers:
+        writer.join()
+    if aggregator is not None:
+        aggregator.close()
+    seconds = time.time() - start
+
+    total = sum(results)
+    recorded = sum(score for member, score in conn.zrange('common:benchmark:info', 0, -1, withscores=True))
+    return {
+        'ops_per_sec': total / seconds,
+        'retries_per_op': log.WATCH_STATS['retries'] / float(total or 1),
+        'lost': total - int(recorded),
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='logCommon contention benchmark')
+    parser.add_argument('--modes', nargs='+', choices=['watch', 'script', 'aggregate'], default=['watch', 'script', 'aggregate'])
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--distinct', type=int, default=100, help='number of distinct messages')
+    parser.add_argument('--timeout', type=float, default=5, help='logCommonWatch timeout')
+    parser.add_argument('--interval', type=float, default=.1, help='CommonLogAggregator flush interval')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=6379)
+    parser.add_argument('--db', type=int, default=15)
+    parser.add_argument('--standin', action='store_true', help='use the in-process redis_standin server')
+    args = parser.parse_args()
+
+    if args.standin:
+        import redis_standin
+        conn = redis_standin.standinRedis(args.db)
+    else:
+        conn = redis.Redis(host=args.host, port=args.port, db=args.db)
+
+    for threads in args.threads:
+        for mode in args.modes:
+            result = benchmark(conn, mode, threads, args)
+            print "%3s thread(s) %-9s %8.0f messages/sec, %.3f retries/message, %s lost" % (
+                threads, mode, result['ops_per_sec'], result['retries_per_op'], result['lost'])
@@ -0,0 +1,105 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+列表日志和流日志的比较
+（1）写入：每batch条日志一次通信往返，列表使用logRecentBatch，流使用logStream的pipe参数；
+batch为1时相当于每次调用logRecent和logStream
+（2）查询：查询写入时间中间三分之一内的错误，列表需要LRANGE取出所有消息再解析时间字符串（只精确到秒），
+流使用queryStream直接按照ID范围读取；流的条目ID使用服务器时间，所以查询范围也使用TIME命令取得的服务器时间
+列表保留keep条日志，流保留maxlen条日志；为了比较查询，两者应该保留相同数量的日志。
+
+用法：python stream_benchmark.py --messages 100000 --batch 100 --keep 100000
+      python stream_benchmark.py --standin --messages 10000 --keep 10000
+"""
+
+import time
+import logging
+import argparse
+
+import redis
+
+import log
+
+"""
+取得服务器的当前时间
+
+@return {float} 秒
+"""
+def serverTime(conn):
+    seconds, microseconds = conn.time()
+    return seconds + microseconds / 1000000.0
+
+"""
+写入指定数量的日志，每10条中有1条错误
+
+@return {float} 每秒写入的日志数
+"""
+def benchmarkWrite(conn, backend, args):
+    conn.delete('recent:benchmark:info', 'recent:benchmark:error',
+        'stream:benchmark:info', 'stream:benchmark:error')
+    start = time.time()
+    for offset in xrange(0, args.messages, args.batch):
+        records = [('benchmark', 'message %s'%i, logging.ERROR if i % 10 == 0 else logging.INFO, time.time())
+            for i in xrange(offset, min(offset + args.batch, args.messages))]
+        if backend == 'list':
+            # 只有一条日志时和logRecent一样是一次LPUSH和一次LTRIM，但是保留keep条而不是100条
+            log.logRecentBatch(conn, records, args.keep)
+        else:
+            pipe = conn.pipeline(False) if args.batch > 1 else None
+            for name, message, severity, created in records:
+                log.logStream(conn, name, message, severity, args.keep, pipe)
+            if pipe is not None:
+                pipe.execute()
+    return args.messages / (time.time() - start)
+
+"""
+查询start到end之间的错误
+
+@return {tuple} (每次查询的秒数, 查询到的条目数)
+"""
+def benchmarkQuery(conn, backend, start, end, args):
+    begin = time.time()
+    for i in xrange(args.queries):
+        if backend == 'list':
+            found = []
+            for message in conn.lrange('recent:benchmark:error', 0, -1):
+                # 消息的前24个字符是time.asctime()
+                created = time.mktime(time.strptime(message[:24]))
+                if start <= created <= end:
+                    found.append(message[25:])
+        else:
+            found = log.queryStream(conn, 'benchmark', ['error'], start, end)
+    return (time.time() - begin) / args.queries, len(found)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='list vs stream log benchmark')
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--batch', type=int, nargs='+', default=[1, 100], help='messages per round trip')
+    parser.add_argument('--keep', type=int, default=100000, help='entries kept by each list or stream')
+    parser.add_argument('--queries', type=int, default=10)
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=6379)
+    parser.add_argument('--db', type=int, default=15)
+    parser.add_argument('--standin', action='store_true', help='use the in-process redis_standin server')
+    args = parser.parse_args()
+
+    if args.standin:
+        import redis_standin
+        conn = redis_standin.standinRedis(args.db)
+    else:
+        conn = redis.Redis(host=args.host, port=args.port, db=args.db)
+
+    batches = args.batch
+    for backend in ('list', 'stream'):
+        for batch in batches:
+            args.batch = batch
+            start = time.time() if backend == 'list' else serverTime(conn)
+            rate = benchmarkWrite(conn, backend, args)
+            end = time.time() if backend == 'list' else serverTime(conn)
+            print "%-6s batch %4s: %8.0f messages/sec" % (backend, batch, rate)
+
+        # 查询最后一次写入的时间中间三分之一内的错误
+        third = (end - start) / 3
+        seconds, found = benchmarkQuery(conn, backend, start + third, end - third, args)
+        print "%-6s query: %8.2f ms/query, %s errors found" % (backend, seconds * 1000, found)
@@ -0,0 +1,580 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+import heapq
+import threading
+import unittest
+from itertools import groupby
+from collections import OrderedDict
+
+"""
+添加或者更新一个最近联系人，把联系人移动到列表的最前面，列表只保留最近的100个联系人
+
+@param {object}
+@param {string} 用户
+@param {string} 联系人
+"""
+# 每个用户保留的最近联系人数
+CONTACTS_KEEP = 100
+
+def addUpdateContact(conn, user, contact):
+    ac_list = 'contacts:' + user
+    pipe = conn.pipeline(True)
+    # 如果联系人已经存在，先把它移除
+    pipe.lrem(ac_list, contact)
+    # 将联系人推入到列表的最前面
+    pipe.lpush(ac_list, contact)
+    # 只保留最近的CONTACTS_KEEP个联系人
+    pipe.ltrim(ac_list, 0, CONTACTS_KEEP - 1)
+    pipe.execute()
+
+"""
+移除一个最近联系人
+
+@param {object}
+@param {string} 用户
+@param {string} 联系人
+"""
+def removeContact(conn, user, contact):
+    conn.lrem('contacts:' + user, contact)
+
+"""
+取得以prefix开头的最近联系人，不区分大小写，按照最近联系的顺序排列
+最近联系人最多只有CONTACTS_KEEP个，取出整个列表在客户端过滤比在redis中查找更快
+
+@param {object}
+@param {string} 用户
+@param {string} 前缀
+
+@return {array}
+"""
+def fetchAutocompleteList(conn, user, prefix):
+    candidates = conn.lrange('contacts:' + user, 0, -1)
+    prefix = normalizeTerm(prefix, True)
+    return [candidate for candidate in candidates if normalizeTerm(candidate).startswith(prefix)]
+
+"""
+把词条转换为查询使用的形式：小写，连续的空白合并为一个空格，UTF-8编码
+
+@param {string} 词条
+@param {bool}   是否为前缀，前缀末尾的空白保留为一个空格（输入了一个完整的单词）
+
+@return {string}
+"""
+def normalizeTerm(term, prefix = False):
+    if isinstance(term, str):
+        term = term.decode('utf-8', 'replace')
+    normalized = u' '.join(term.lower().split())
+    if prefix and normalized and term[-1:].isspace():
+        normalized += u' '
+    return normalized.encode('utf-8')
+
+"""
+前缀自动补全的索引，每个索引使用以下几个键：
+autocomplete:<index>             有序集合，所有成员的分值都是0，按照字典序排列，使用ZRANGEBYLEX查找以某个前缀开头的词条
+autocomplete:<index>:weights     有序集合，词条的热门程度
+autocomplete:<index>:top:<prefix> 有序集合，以prefix开头的最热门的TOP_SIZE个词条，为长度不超过TOP_PREFIX_LENGTH的前缀，
+                                 以及匹配的词条超过SUGGEST_SCAN个的较长前缀维护
+成员为“规范化的词条\\x00原来的词条”，查找时只比较规范化的部分，返回原来的词条
+没有热门词条的前缀匹配的词条不超过SUGGEST_SCAN个，按照字典序全部取出再排序就是准确的结果
+"""
+# 总是维护热门词条的最长前缀(字符)
+TOP_PREFIX_LENGTH = 3
+# 每个前缀保留的热门词条数
+TOP_SIZE = 50
+# 没有热门词条的前缀最多匹配多少个词条，查找时全部取出再按照热门程度排序
+SUGGEST_SCAN = 200
+
+def indexKey(index):
+    return 'autocomplete:' + index
+
+def termMember(term):
+    if isinstance(term, unicode):
+        term = term.encode('utf-8')
+    return normalizeTerm(term) + '\x00' + term
+
+"""
+词条的前缀，默认为总是维护热门词条的第1个到第TOP_PREFIX_LENGTH个字符
+
+@param {string} 规范化的词条
+@param {int}    最长的前缀(字符)，None表示所有前缀
+
+@return {array}
+"""
+def topPrefixes(normalized, max_length = TOP_PREFIX_LENGTH):
+    characters = normalized.decode('utf-8')
+    length = len(characters) if max_length is None else min(len(characters), max_length)
+    return [characters[:i].encode('utf-8') for i in xrange(1, length + 1)]
+
+"""
+添加词条，并增加它的热门程度
+加入字典序索引、增加热门程度和更新所有热门前缀在一个Lua脚本中完成，只需要一次通信往返。
+较长的前缀匹配的词条刚刚超过SUGGEST_SCAN个时，为它建立热门词条；
+更长的前缀匹配的词条只会更少，遇到第一个不需要热门词条的前缀就停止检查。
+
+@param {object}
+@param {string} 索引名称
+@param {string} 词条
+@param {float}  增加的热门程度
+@param {object} 可选的流水线，传入时只将脚本放入流水线
+
+@return {float} 词条现在的热门程度，在流水线中执行时没有返回值
+"""
+ADD_TERM_LUA = '''
+redis.call('zadd', KEYS[1], 0, ARGV[1])
+local weight = redis.call('zincrby', KEYS[2], ARGV[2], ARGV[1])
+local size, scan, short = tonumber(ARGV[3]), tonumber(ARGV[4]), tonumber(ARGV[5])
+for i = 6, #ARGV do
+    local top = KEYS[1] .. ':top:' .. ARGV[i]
+    if i - 5 <= short or redis.call('exists', top) == 1 then
+        redis.call('zadd', top, weight, ARGV[1])
+    else
+        local low, high = '[' .. ARGV[i], '[' .. ARGV[i] .. '\\255'
+        if redis.call('zlexcount', KEYS[1], low, high) <= scan then
+            break
+        end
+        -- 匹配的词条刚刚超过scan个，建立这个前缀的热门词条
+        for _, member in ipairs(redis.call('zrangebylex', KEYS[1], low, high)) do
+            redis.call('zadd', top, redis.call('zscore', KEYS[2], member) or 0, member)
+        end
+    end
+    redis.call('zremrangebyrank', top, 0, -size - 1)
+end
+return weight
+'''
+
+def addTerm(conn, index, term, weight = 0, pipe = None):
+    key = indexKey(index)
+    member = termMember(term)
+    prefixes = topPrefixes(member.partition('\x00')[0], None)
+    add = conn.register_script(ADD_TERM_LUA)
+    result = add(keys = [key, key + ':weights'],
+                 args = [member, weight, TOP_SIZE, SUGGEST_SCAN, TOP_PREFIX_LENGTH] + prefixes, client = pipe)
+    return None if pipe is not None else float(result)
+
+"""
+记录用户选择了某个建议，增加词条的热门程度
+
+@param {object}
+@param {string} 索引名称
+@param {string} 词条
+@param {float}  增加的热门程度
+
+@return {float} 词条现在的热门程度
+"""
+def recordSelection(conn, index, term, amount = 1):
+    return addTerm(conn, index, term, amount)
+
+"""
+删除词条
+
+@param {object}
+@param {string} 索引名称
+@param {string} 词条
+"""
+def removeTerm(conn, index, term):
+    key = indexKey(index)
+    member = termMember(term)
+    pipe = conn.pipeline(True)
+    pipe.zrem(key, member)
+    pipe.zrem(key + ':weights', member)
+    for prefix in topPrefixes(member.partition('\x00')[0], None):
+        pipe.zrem(key + ':top:' + prefix, member)
+    pipe.execute()
+
+"""
+批量建立索引
+每batch_size个词条使用一个非事务流水线，字典序索引和热门程度各只需要一次ZADD；
+热门前缀在内存中只保留每个前缀最热门的TOP_SIZE个词条，全部词条处理完之后再写入，并和已有的热门词条合并。
+较长的前缀由buildLongTops在写入之后按照字典序读取索引，为匹配超过SUGGEST_SCAN个词条的前缀重新建立热门词条。
+已经存在的词条的热门程度会被覆盖。
+
+@param {object}
+@param {string}   索引名称
+@param {iterable} 词条，每个元素为(词条, 热门程度)
+@param {int}      每个流水线写入的词条数
+
+@return {int} 写入的词条数
+"""
+def buildIndex(conn, index, terms, batch_size = 1000):
+    key = indexKey(index)
+    # 前缀 => [(热门程度, 成员)]最小堆
+    tops = {}
+    # 第TOP_PREFIX_LENGTH + 1个字符的前缀，写入之后检查是否需要热门词条
+    long_prefixes = set()
+    count = 0
+    batch = []
+
+    def flush():
+        pipe = conn.pipeline(False)
+        pipe.zadd(key, *[value for member, weight in batch for value in (member, 0)])
+        pipe.zadd(key + ':weights', *[value for item in batch for value in item])
+        pipe.execute()
+        del batch[:]
+
+    for term, weight in terms:
+        member = termMember(term)
+        weight = float(weight or 0)
+        batch.append((member, weight))
+        prefixes = topPrefixes(member.partition('\x00')[0], TOP_PREFIX_LENGTH + 1)
+        if len(prefixes) > TOP_PREFIX_LENGTH:
+            long_prefixes.add(prefixes.pop())
+        for prefix in prefixes:
+            heap = tops.setdefault(prefix, [])
+            if len(heap) < TOP_SIZE:
+                heapq.heappush(heap, (weight, member))
+            elif (weight, member) > heap[0]:
+                heapq.heapreplace(heap, (weight, member))
+        count += 1
+        if len(batch) >= batch_size:
+            flush()
+    if batch:
+        flush()
+
+    pipe = conn.pipeline(False)
+    for i, (prefix, heap) in enumerate(tops.iteritems()):
+        top_key = key + ':top:' + prefix
+        pipe.zadd(top_key, *[value for weight, member in heap for value in (member, weight)])
+        pipe.zremrangebyrank(top_key, 0, -TOP_SIZE - 1)
+        if i % batch_size == batch_size - 1:
+            pipe.execute()
+    pipe.execute()
+
+    buildLongTops(conn, index, long_prefixes, batch_size)
+    return count
+
+"""
+为匹配超过SUGGEST_SCAN个词条的较长前缀建立热门词条
+按照字典序取出每个前缀匹配的所有词条，相同前缀的词条是连续的，逐层按下一个字符分组，
+只有超过SUGGEST_SCAN个词条的分组才需要热门词条，也只有它们需要继续分组。
+
+@param {object}
+@param {string} 索引名称
+@param {set}    第TOP_PREFIX_LENGTH + 1个字符的前缀
+@param {int}    每个流水线读取或写入的数量
+"""
+def buildLongTops(conn, index, prefixes, batch_size = 1000):
+    key = indexKey(index)
+    pipe = conn.pipeline(False)
+    for prefix in sorted(prefixes):
+        low, high = '[' + prefix, '[' + prefix + '\xff'
+        if conn.zlexcount(key, low, high) <= SUGGEST_SCAN:
+            continue
+
+        members = conn.zrangebylex(key, low, high)
+        weights = []
+        for offset in xrange(0, len(members), batch_size):
+            reader = conn.pipeline(False)
+            for member in members[offset:offset + batch_size]:
+                reader.zscore(key + ':weights', member)
+            weights.extend(reader.execute())
+        # (规范化的词条, 热门程度, 成员)
+        items = [(member.partition('\x00')[0].decode('utf-8'), float(weight or 0), member)
+                 for member, weight in zip(members, weights)]
+
+        groups = [(len(prefix.decode('utf-8')), items)]
+        while groups:
+            length, group = groups.pop()
+            top_key = key + ':top:' + group[0][0][:length].encode('utf-8')
+            pipe.delete(top_key)
+            top = heapq.nlargest(TOP_SIZE, group, key = lambda item: (item[1], item[2]))
+            pipe.zadd(top_key, *[value for normalized, weight, member in top for value in (member, weight)])
+            for character, subgroup in groupby(group, lambda item: item[0][length:length + 1]):
+                subgroup = list(subgroup)
+                if character and len(subgroup) > SUGGEST_SCAN:
+                    groups.append((length + 1, subgroup))
+            if len(pipe) >= batch_size:
+                pipe.execute()
+    pipe.execute()
+
+"""
+为所有文章的标题建立索引，热门程度为文章的投票数
+使用SCAN遍历article:*，不会像KEYS一样长时间阻塞redis
+
+@param {object}
+@param {string} 索引名称
+@param {int}    每次读取的文章数
+
+@return {int} 写入的词条数
+"""
+def indexArticles(conn, index = 'article', batch_size = 1000):
+    def articles():
+        keys = []
+        for key in conn.scan_iter('article:*', batch_size):
+            # article:是文章ID的计数器，只读取article:<id>散列
+            if key.partition(':')[2].isdigit():
+                keys.append(key)
+            if len(keys) >= batch_size:
+                for article in readArticles(keys):
+                    yield article
+                keys = []
+        for article in readArticles(keys):
+            yield article
+
+    def readArticles(keys):
+        pipe = conn.pipeline(False)
+        for key in keys:
+            pipe.hmget(key, 'title', 'votes')
+        return [(title, votes) for title, votes in pipe.execute() if title]
+
+    return buildIndex(conn, index, articles(), batch_size)
+
+"""
+返回以prefix开头的热门词条，一次通信往返
+（1）前缀有热门词条时（不超过TOP_PREFIX_LENGTH个字符，或者匹配超过SUGGEST_SCAN个词条），直接返回这个前缀的热门词条
+（2）没有热门词条，或者热门词条不够count个时，用ZRANGEBYLEX按照字典序取出最多scan个词条，按照热门程度排序
+没有热门词条的前缀匹配的词条不超过SUGGEST_SCAN个，所以count不超过TOP_SIZE、scan不小于SUGGEST_SCAN时结果是准确的；
+删除词条之后热门词条可能不够count个，这时匹配很多词条的前缀只在字典序的前scan个词条中排序。
+
+@param {object}
+@param {string} 索引名称
+@param {string} 前缀
+@param {int}    返回的词条数
+@param {int}    按照字典序最多取出的词条数
+
+@return {array} 词条，按照热门程度从高到低排列
+"""
+SUGGEST_LUA = '''
+local count = tonumber(ARGV[3])
+if ARGV[5] == '1' then
+    local top = redis.call('zrevrange', KEYS[3], 0, count - 1)
+    if #top >= count then
+        return top
+    end
+end
+local members = redis.call('zrangebylex', KEYS[1], ARGV[1], ARGV[2], 'LIMIT', 0, ARGV[4])
+local scored = {}
+for i, member in ipairs(members) do
+    scored[i] = {member, tonumber(redis.call('zscore', KEYS[2], member) or 0)}
+end
+table.sort(scored, function(a, b)
+    if a[2] ~= b[2] then
+        return a[2] > b[2]
+    end
+    return a[1] < b[1]
+end)
+local result = {}
+for i = 1, math.min(#scored, count) do
+    result[i] = scored[i][1]
+end
+return result
+'''
+
+# 设置为PrefixCache实例时，先查询进程内的前缀缓存
+PREFIX_CACHE = None
+
+def suggest(conn, index, prefix, count = 10, scan = None):
+    prefix = normalizeTerm(prefix, True)
+    scan = SUGGEST_SCAN if scan is None else scan
+    cache = PREFIX_CACHE
+    if cache is not None:
+        return cache.load((index, prefix, count), lambda: fetchSuggestions(conn, index, prefix, count, scan))
+    return fetchSuggestions(conn, index, prefix, count, scan)
+
+def fetchSuggestions(conn, index, prefix, count, scan):
+    key = indexKey(index)
+    low, high = ('[' + prefix, '[' + prefix + '\xff') if prefix else ('-', '+')
+    fetch = conn.register_script(SUGGEST_LUA)
+    members = fetch(keys = [key, key + ':weights', key + ':top:' + prefix],
+                    args = [low, high, count, max(scan, count), '1' if prefix else '0'])
+    return [member.partition('\x00')[2] for member in members]
+
+"""
+进程内的前缀缓存
+每次按键都要查询一次，用户输入的前几个字符集中在少数几个前缀上，缓存这些前缀的结果可以省掉大部分通信往返。
+最多缓存max_prefixes个前缀，超过时淘汰最近最少使用的前缀；只缓存不超过max_length个字符的前缀，
+较长的前缀很少重复出现。结果缓存ttl秒，期间热门程度的变化不会反映在结果中。
+
+@param {float} 缓存时间(秒)
+@param {int}   最多缓存的前缀数
+@param {int}   缓存的最长前缀(字符)
+"""
+class PrefixCache(object):
+    def __init__(self, ttl = 1, max_prefixes = 10000, max_length = TOP_PREFIX_LENGTH):
+        self.ttl = ttl
+        self.max_prefixes = max_prefixes
+        self.max_length = max_length
+        self.hits = 0
+        self.misses = 0
+        self._results = OrderedDict()
+        self._lock = threading.Lock()
+
+    def load(self, key, loader):
+        if len(key[1].decode('utf-8')) > self.max_length:
+            return loader()
+
+        with self._lock:
+            entry = self._results.pop(key, None)
+            if entry is not None and entry[0] >= time.time():
+                # 重新插入到末尾，标记为最近使用
+                self._results[key] = entry
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        result = loader()
+        with self._lock:
+            self._results.pop(key, None)
+            self._results[key] = (time.time() + self.ttl, result)
+            # 淘汰最近最少使用的前缀
+            while len(self._results) > self.max_prefixes:
+                self._results.popitem(last = False)
+        return result
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'prefixes': len(self._results),
+            'hit_rate': float(self.hits) / total if total else 0.0,
+        }
+
+# 测试通过仓库根目录的redis_standin连接redis，设置环境变量REDIS_STANDIN=1时使用进程内的替身服务器和虚拟时间
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+"""
+测试
+"""
+class TestAutoComplete(unittest.TestCase):
+    def setUp(self):
+        import redis_standin
+        self.conn = redis_standin.connect(db=15, modules=[sys.modules[__name__]])
+        self.addCleanup(redis_standin.restoreTime)
+
+    def tearDown(self):
+        global PREFIX_CACHE
+        PREFIX_CACHE = None
+        self.conn.flushdb()
+        del self.conn
+        print
+        print
+
+    def testContacts(self):
+        conn = self.conn
+
+        print "Let's add a few contacts..."
+        for i in xrange(10):
+            addUpdateContact(conn, 'user', 'contact-%i-%i'%(i//3, i))
+        print "Current recently contacted contacts"
+        contacts = conn.lrange('contacts:user', 0, -1)
+        print contacts
+        self.assertTrue(len(contacts) >= 10)
+
+        print "Let's pull one of the older ones up to the front"
+        addUpdateContact(conn, 'user', 'contact-1-4')
+        contacts = conn.lrange('contacts:user', 0, 2)
+        print "New top-3 contacts:", contacts
+        self.assertEquals(contacts[0], 'contact-1-4')
+
+        print "Let's remove a contact..."
+        removeContact(conn, 'user', 'contact-2-6')
+        all_contacts = conn.lrange('contacts:user', 0, -1)
+        self.assertFalse('contact-2-6' in all_contacts)
+
+        print "And let's finally autocomplete on 'Contact-2'"
+        contacts = fetchAutocompleteList(conn, 'user', 'Contact-2')
+        print contacts
+        self.assertEquals(contacts, ['contact-2-8', 'contact-2-7'])
+
+    def testSuggest(self):
+        conn = self.conn
+
+        print "Let's add a few terms with different weights..."
+        for term, weight in [('Redis in Action', 5), ('redis cluster', 8), ('Redis streams', 1),
+                             ('ruby', 20), (u'Redis实战', 3)]:
+            addTerm(conn, 'test', term, weight)
+
+        suggestions = suggest(conn, 'test', 're')
+        print "Suggestions for 're':", suggestions
+        self.assertEquals(suggestions, ['redis cluster', 'Redis in Action', u'Redis实战'.encode('utf-8'), 'Redis streams'])
+        # 较长的前缀按照字典序查找
+        self.assertEquals(suggest(conn, 'test', 'REDIS '), ['redis cluster', 'Redis in Action', 'Redis streams'])
+        self.assertEquals(suggest(conn, 'test', u'redis实'), [u'Redis实战'.encode('utf-8')])
+        self.assertEquals(suggest(conn, 'test', 'redis', 2), ['redis cluster', 'Redis in Action'])
+        self.assertEquals(suggest(conn, 'test', 'x'), [])
+
+        print "Selections make a term more popular"
+        for i in xrange(10):
+            recordSelection(conn, 'test', 'Redis streams')
+        self.assertEquals(suggest(conn, 'test', 'r', 2), ['ruby', 'Redis streams'])
+        self.assertEquals(suggest(conn, 'test', 'redis s'), ['Redis streams'])
+
+        print "Removed terms are no longer suggested"
+        removeTerm(conn, 'test', 'ruby')
+        self.assertEquals(suggest(conn, 'test', 'r', 1), ['Redis streams'])
+        self.assertFalse(conn.exists('autocomplete:test:top:ru'))
+
+    def testIndexArticles(self):
+        global TOP_SIZE
+        conn = self.conn
+
+        print "Let's index the titles of a few articles..."
+        conn.set('article:', 30)
+        for i in xrange(1, 31):
+            conn.hmset('article:%s'%i, {'title': 'article %s'%i, 'votes': i})
+        old_size = TOP_SIZE
+        TOP_SIZE = 5
+        try:
+            self.assertEquals(indexArticles(conn, batch_size=7), 30)
+        finally:
+            TOP_SIZE = old_size
+        self.assertEquals(conn.zcard('autocomplete:article'), 30)
+        self.assertEquals(conn.zcard('autocomplete:article:top:a'), 5)
+
+        suggestions = suggest(conn, 'article', 'art', 3)
+        print "Most voted articles:", suggestions
+        self.assertEquals(suggestions, ['article 30', 'article 29', 'article 28'])
+        # 热门词条不够时按照字典序查找
+        self.assertEquals(suggest(conn, 'article', 'a', 7)[-2:], ['article 25', 'article 24'])
+        self.assertEquals(suggest(conn, 'article', 'article 1'),
+            ['article 19', 'article 18', 'article 17', 'article 16', 'article 15',
+             'article 14', 'article 13', 'article 12', 'article 11', 'article 10'])
+
+    def testLongPrefix(self):
+        conn = self.conn
+
+        print "Let's add more than SUGGEST_SCAN terms sharing a long prefix..."
+        # 热门程度是1到1000的一个排列，最热门的词条在字典序的后面
+        terms = [('word%04d'%i, (i * 7) % 1000 + 1) for i in xrange(1000)]
+        expected = [term for term, weight in sorted(terms, key = lambda item: -item[1])[:3]]
+        self.assertEquals(buildIndex(conn, 'built', terms), 1000)
+        for term, weight in terms:
+            addTerm(conn, 'added', term, weight)
+
+        for index in ('built', 'added'):
+            self.assertEquals(conn.zcard('autocomplete:%s:top:word'%index), TOP_SIZE)
+            self.assertFalse(conn.exists('autocomplete:%s:top:word00'%index))
+            suggestions = suggest(conn, index, 'word', 3)
+            print index, "suggestions:", suggestions
+            self.assertEquals(suggestions, expected)
+            self.assertEquals(suggest(conn, index, 'word0', 3), expected)
+            self.assertEquals(suggest(conn, index, 'word08', 1), ['word0857'])
+
+        removeTerm(conn, 'added', expected[0])
+        self.assertEquals(suggest(conn, 'added', 'word', 2), expected[1:])
+
+    def testPrefixCache(self):
+        global PREFIX_CACHE
+        conn = self.conn
+        addTerm(conn, 'test', 'redis', 1)
+
+        print "Let's cache the short prefixes..."
+        PREFIX_CACHE = PrefixCache(ttl=1)
+        self.assertEquals(suggest(conn, 'test', 'r'), ['redis'])
+        addTerm(conn, 'test', 'ruby', 10)
+        self.assertEquals(suggest(conn, 'test', 'R'), ['redis'])
+        # 较长的前缀不缓存
+        self.assertEquals(suggest(conn, 'test', 'redi'), ['redis'])
+        self.assertEquals(suggest(conn, 'test', 'redi'), ['redis'])
+        print "Cache stats:", PREFIX_CACHE.stats()
+        self.assertEquals((PREFIX_CACHE.hits, PREFIX_CACHE.misses), (1, 1))
+
+        time.sleep(1.1)
+        self.assertEquals(suggest(conn, 'test', 'r'), ['ruby', 'redis'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+前缀自动补全的按键延迟测试
+用buildIndex为terms个随机词条建立索引，热门程度服从长尾分布；之后模拟用户输入，
+越热门的词条越常被输入，每输入一个字符调用一次suggest，报告每次按键的延迟分布。
+每轮分别在不使用和使用进程内前缀缓存(PrefixCache)的情况下测试。
+
+用法：python autocomplete_benchmark.py --terms 1000000 --queries 10000
+      python autocomplete_benchmark.py --standin --terms 100000 --queries 2000
+"""
+
+import time
+import random
+import argparse
+
+import redis
+
+import auto_complement
+
+SYLLABLES = ['ka', 'ri', 'to', 'me', 'su', 'no', 'ha', 'lo', 'an', 'de', 'vi', 'ro', 'ze', 'mu', 'pe', 'ti']
+
+"""
+生成随机词条，按照热门程度从高到低排列
+
+@return {array} [(词条, 热门程度)]
+"""
+def generateTerms(rand, count):
+    terms = set()
+    while len(terms) < count:
+        words = [''.join(rand.choice(SYLLABLES) for j in xrange(rand.randint(2, 4)))
+            for i in xrange(rand.randint(1, 3))]
+        terms.add(' '.join(words))
+    # 先排序保证同一个种子的结果相同，再打乱，热门程度和字典序无关
+    terms = sorted(terms)
+    rand.shuffle(terms)
+    # 排名为rank的词条的热门程度约为1/rank
+    return [(term, int(count / (rank + 1))) for rank, term in enumerate(terms)]
+
+"""
+计算百分位数
+
+@param {array} 排好序的延迟
+@param {float} 百分位
+
+@return {float}
+"""
+def percentile(latencies, pct):
+    return latencies[min(len(latencies) - 1, int(len(latencies) * pct / 100.0))]
+
+"""
+模拟用户输入queries个词条，每个字符调用一次suggest
+
+@return {array} 排好序的每次按键的延迟(秒)
+"""
+def benchmark(conn, terms, args, seed):
+    rand = random.Random(seed)
+    latencies = []
+    for i in xrange(args.queries):
+        # 按照1/rank的分布选择要输入的词条
+        rank = min(len(terms) - 1, int(len(terms) ** rand.random()) - 1)
+        term = terms[rank][0]
+        for length in xrange(1, min(len(term), args.max_typed) + 1):
+            start = time.time()
+            auto_complement.suggest(conn, 'benchmark', term[:length], args.count)
+            latencies.append(time.time() - start)
+    latencies.sort()
+    return latencies
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='autocomplete keystroke latency benchmark')
+    parser.add_argument('--terms', type=int, default=1000000)
+    parser.add_argument('--queries', type=int, default=10000, help='terms typed by the simulated users')
+    parser.add_argument('--max-typed', type=int, default=10, help='characters typed for each term')
+    parser.add_argument('--count', type=int, default=10, help='suggestions per keystroke')
+    parser.add_argument('--cache-ttl', type=float, default=1)
+    parser.add_argument('--skip-build', action='store_true', help='reuse the index built by a previous run')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=6379)
+    parser.add_argument('--db', type=int, default=15)
+    parser.add_argument('--standin', action='store_true', help='use the in-process redis_standin server')
+    args = parser.parse_args()
+
+    if args.standin:
+        # auto_complement已经把仓库根目录加入了sys.path
+        import redis_standin
+        conn = redis_standin.standinRedis(args.db)
+    else:
+        conn = redis.Redis(host=args.host, port=args.port, db=args.db)
+
+    terms = generateTerms(random.Random(args.seed), args.terms)
+    if not args.skip_build:
+        start = time.time()
+        auto_complement.buildIndex(conn, 'benchmark', terms)
+        print "indexed %s terms in %.1f s" % (len(terms), time.time() - start)
+
+    for cached in (False, True):
+        auto_complement.PREFIX_CACHE = auto_complement.PrefixCache(args.cache_ttl) if cached else None
+        latencies = benchmark(conn, terms, args, args.seed)
+        print "%-8s %7s keystrokes: p50 %.3f ms, p90 %.3f ms, p99 %.3f ms, max %.3f ms%s" % (
+            'cached' if cached else 'uncached', len(latencies),
+            percentile(latencies, 50) * 1000, percentile(latencies, 90) * 1000,
+            percentile(latencies, 99) * 1000, latencies[-1] * 1000,
+            ', hit rate %.2f' % auto_complement.PREFIX_CACHE.stats()['hit_rate'] if cached else '')
@@ -0,0 +1,317 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+文章投票、会话、页面缓存和日志四个场景的端到端基准测试
+每个场景先准备好数据，然后由多个客户端在指定时间内按照接近真实的比例不断执行操作，
+文章、用户、商品和日志消息的热度服从Zipf分布。每个场景报告每秒操作数、p50/p99延迟，
+以及每个操作平均执行的redis命令数（由INFO commandstats统计，包含Lua脚本中执行的命令）。
+
+（1）articles：5%发布文章，75%投票，20%取出文章列表（页码同样服从Zipf分布）
+（2）sessions：90%更新令牌，10%添加购物车，同时有一个线程运行cleanFullSession守护进程清理超过限制的会话
+（3）cache：请求商品页面，热门页面命中缓存，冷门页面由回调函数生成
+（4）logs：70%记录最近日志，30%记录常见日志
+
+测试会清空所使用的数据库。结果可以保存为JSON文件，下次运行时使用--compare和之前的结果比较：
+
+用法：python benchmark.py --clients 4 --seconds 10 --output before.json
+      python benchmark.py --clients 4 --seconds 10 --compare before.json
+      python benchmark.py --standin --workloads articles logs
+"""
+
+import os
+import sys
+import json
+import time
+import bisect
+import random
+import argparse
+import platform
+import threading
+import multiprocessing
+from collections import defaultdict
+
+import redis
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+for chapter in ('1_article_voted', '2_shopping_website', '5_support_program'):
+    sys.path.append(os.path.join(ROOT, chapter))
+
+import redis_standin
+import redis_daemon
+import article_voted
+import shopping_website
+import log
+
+"""
+Zipf分布的随机数，返回0到n-1，0最热门
+
+@param {int}   取值个数
+@param {float} 分布的指数，越大热门数据越集中
+"""
+class Zipf(object):
+    def __init__(self, n, s = 1.0):
+        total = 0.0
+        self.cdf = []
+        for i in xrange(n):
+            total += 1.0 / (i + 1) ** s
+            self.cdf.append(total)
+
+    def next(self, rand):
+        return min(bisect.bisect(self.cdf, rand.random() * self.cdf[-1]), len(self.cdf) - 1)
+
+# 每个进程中已经创建的Zipf分布
+ZIPF_CACHE = {}
+
+def zipf(n, s):
+    if (n, s) not in ZIPF_CACHE:
+        ZIPF_CACHE[(n, s)] = Zipf(n, s)
+    return ZIPF_CACHE[(n, s)]
+
+"""
+文章场景
+"""
+def setupArticles(conn, options):
+    ids = article_voted.postArticles(conn, [
+        ('user:%s' % i, 'title %s' % i, 'http://www.example.com/%s' % i) for i in xrange(options.articles)])
+    return {'articles': ids}
+
+def articleOperation(conn, state, options, rand):
+    action = rand.random()
+    if action < .05:
+        article_voted.postArticle(conn, 'user:%s' % rand.randrange(options.users), 'title', 'http://www.example.com/')
+        return 'postArticle'
+    if action < .8:
+        article = state['articles'][zipf(len(state['articles']), options.zipf).next(rand)]
+        article_voted.voteArticle(conn, 'user:%s' % rand.randrange(options.users), 'article:' + article)
+        return 'voteArticle'
+    page = zipf(10, options.zipf).next(rand) + 1
+    article_voted.getArticles(conn, page)
+    return 'getArticles'
+
+"""
+会话场景，cleanFullSession在后台线程中运行，把会话数量控制在--sessions-limit之内
+"""
+def setupSessions(conn, options):
+    shopping_website.LIMIT = options.sessions_limit
+    return {}
+
+def sessionOperation(conn, state, options, rand):
+    user = zipf(options.users, options.zipf).next(rand)
+    item = 'item%s' % zipf(options.items, options.zipf).next(rand)
+    if rand.random() < .9:
+        shopping_website.updateToken(conn, 'token%s' % user, 'user%s' % user, item)
+        return 'updateToken'
+    shopping_website.addToCart(conn, 'token%s' % user, item, rand.randint(1, 5))
+    return 'addToCart'
+
+def startSessionCleaner(conn):
+    cleaner = redis_daemon.DaemonRunner(lambda: conn, processes = False)
+    cleaner.start(shopping_website.cleanFullSessionDaemon())
+    return cleaner
+
+def stopSessionCleaner(cleaner):
+    cleaner.stop()
+
+"""
+页面缓存场景，所有商品都在浏览排名之内，可以被缓存
+"""
+def setupCache(conn, options):
+    pipe = conn.pipeline(False)
+    for i in xrange(options.items):
+        pipe.zadd('viewed:', 'item%s' % i, -1)
+    pipe.execute()
+    return {}
+
+def cacheOperation(conn, state, options, rand):
+    item = zipf(options.items, options.zipf).next(rand)
+    shopping_website.cacheRequest(
+        conn, 'http://www.example.com/?item=item%s' % item, lambda request: 'x' * options.page_size)
+    return 'cacheRequest'
+
+"""
+日志场景
+"""
+def setupLogs(conn, options):
+    return {}
+
+def logOperation(conn, state, options, rand):
+    message = 'message %s' % zipf(1000, options.zipf).next(rand)
+    if rand.random() < .7:
+        log.logRecent(conn, 'benchmark', message)
+        return 'logRecent'
+    log.logCommon(conn, 'benchmark', message)
+    return 'logCommon'
+
+# 场景名称：(准备数据, 执行一次操作)
+WORKLOADS = {
+    'articles': (setupArticles, articleOperation),
+    'sessions': (setupSessions, sessionOperation),
+    'cache': (setupCache, cacheOperation),
+    'logs': (setupLogs, logOperation),
+}
+
+"""
+创建redis连接，--standin时所有客户端线程共享同一个替身服务器
+"""
+STANDIN_SERVER = None
+
+def connect(options):
+    if options.standin:
+        return redis_standin.standinRedis(options.db, STANDIN_SERVER)
+    return redis.Redis(host = options.host, port = options.port, db = options.db)
+
+"""
+客户端，在指定时间内不断执行操作，记录每个操作的延迟
+
+@param {string} 场景名称
+@param {dict}   准备数据时得到的状态
+@param {object} 命令行参数
+@param {int}    随机数种子
+@param {object} 保存结果的队列
+"""
+def runClient(workload, state, options, seed, results):
+    conn = connect(options)
+    rand = random.Random(seed)
+    operation = WORKLOADS[workload][1]
+    latencies = defaultdict(list)
+
+    end = time.time() + options.seconds
+    while time.time() < end:
+        start = time.time()
+        name = operation(conn, state, options, rand)
+        latencies[name].append(time.time() - start)
+    results.put(dict(latencies))
+
+"""
+取得延迟的百分位数，单位为毫秒
+
+@param {array} 排好序的延迟
+@param {float} 0到100
+"""
+def percentile(latencies, p):
+    if not latencies:
+        return 0.0
+    index = min(len(latencies) - 1, int(len(latencies) * p / 100.0))
+    return latencies[index] * 1000
+
+def summarize(latencies, seconds):
+    latencies = sorted(latencies)
+    return {
+        'ops': len(latencies),
+        'ops_per_sec': len(latencies) / seconds,
+        'p50_ms': percentile(latencies, 50),
+        'p99_ms': percentile(latencies, 99),
+    }
+
+def commandCount(conn):
+    stats = conn.info('commandstats')
+    return sum(value['calls'] for key, value in stats.items() if key.startswith('cmdstat_') and key != 'cmdstat_info')
+
+"""
+运行一个场景
+
+@param {string} 场景名称
+@param {object} 命令行参数
+
+@return {dict} 场景的总体结果和每种操作的结果
+"""
+def runWorkload(workload, options):
+    conn = connect(options)
+    conn.flushdb()
+    state = WORKLOADS[workload][0](conn, options)
+    cleaner = startSessionCleaner(conn) if workload == 'sessions' else None
+
+    # 替身服务器在本进程中，客户端使用线程；真正的redis服务器使用进程，避免受到GIL的限制
+    results = multiprocessing.Queue()
+    commands = commandCount(conn)
+    start = time.time()
+    if options.standin:
+        clients = [threading.Thread(target = runClient, args = (workload, state, options, i, results))
+            for i in xrange(options.clients)]
+    else:
+        clients = [multiprocessing.Process(target = runClient, args = (workload, state, options, i, results))
+            for i in xrange(options.clients)]
+    for client in clients:
+        client.start()
+    latencies = defaultdict(list)
+    for client in clients:
+        for name, values in results.get().items():
+            latencies[name].extend(values)
+    for client in clients:
+        client.join()
+    seconds = time.time() - start
+    commands = commandCount(conn) - commands
+
+    if cleaner is not None:
+        stopSessionCleaner(cleaner)
+
+    total = [latency for values in latencies.values() for latency in values]
+    result = summarize(total, seconds)
+    result['commands_per_op'] = commands / float(len(total) or 1)
+    result['operations'] = dict((name, summarize(values, seconds)) for name, values in latencies.items())
+    conn.flushdb()
+    return result
+
+"""
+打印一个场景的结果，提供了之前的结果时同时打印变化的百分比
+"""
+def report(workload, result, previous = None):
+    def change(key, data, old):
+        if not old or not old.get(key):
+            return ''
+        return ' (%+.1f%%)' % ((data[key] - old[key]) * 100.0 / old[key])
+
+    print '%s: %.0f ops/sec%s, p50 %.3f ms%s, p99 %.3f ms%s, %.2f commands/op%s' % (
+        workload,
+        result['ops_per_sec'], change('ops_per_sec', result, previous),
+        result['p50_ms'], change('p50_ms', result, previous),
+        result['p99_ms'], change('p99_ms', result, previous),
+        result['commands_per_op'], change('commands_per_op', result, previous))
+    for name, data in sorted(result['operations'].items()):
+        old = ((previous or {}).get('operations') or {}).get(name)
+        print '    %-14s %8.0f ops/sec%s, p50 %.3f ms%s, p99 %.3f ms%s' % (
+            name,
+            data['ops_per_sec'], change('ops_per_sec', data, old),
+            data['p50_ms'], change('p50_ms', data, old),
+            data['p99_ms'], change('p99_ms', data, old))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'end-to-end workflow benchmark')
+    parser.add_argument('--workloads', nargs = '+', choices = sorted(WORKLOADS), default = ['articles', 'sessions', 'cache', 'logs'])
+    parser.add_argument('--clients', type = int, default = 4)
+    parser.add_argument('--seconds', type = float, default = 10)
+    parser.add_argument('--zipf', type = float, default = 1.1, help = 'Zipf exponent of item popularity')
+    parser.add_argument('--articles', type = int, default = 10000)
+    parser.add_argument('--users', type = int, default = 100000)
+    parser.add_argument('--items', type = int, default = 10000)
+    parser.add_argument('--sessions-limit', type = int, default = 50000)
+    parser.add_argument('--page-size', type = int, default = 2048)
+    parser.add_argument('--host', default = 'localhost')
+    parser.add_argument('--port', type = int, default = 6379)
+    parser.add_argument('--db', type = int, default = 15, help = 'database to use, it is flushed')
+    parser.add_argument('--standin', action = 'store_true', help = 'use the in-process redis_standin server')
+    parser.add_argument('--output', help = 'save the results to a JSON file')
+    parser.add_argument('--compare', help = 'compare with the results saved in a JSON file')
+    options = parser.parse_args()
+
+    if options.standin:
+        STANDIN_SERVER = redis_standin.StandinServer()
+    previous = {}
+    if options.compare:
+        with open(options.compare) as f:
+            previous = json.load(f)['workloads']
+
+    results = {}
+    for workload in options.workloads:
+        results[workload] = runWorkload(workload, options)
+        report(workload, results[workload], previous.get(workload))
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump({
+                'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+                'host': platform.node(),
+                'options': vars(options),
+                'workloads': results,
+            }, f, indent = 4, sort_keys = True)
@@ -0,0 +1,323 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+守护进程的运行框架
+各章节的守护进程原来都是由全局QUIT标志控制的while循环，并且固定休眠，在这里改为：
+（1）Daemon只描述一次执行做什么（step），以及如何取得积压量（backlog）和延迟（lag）
+（2）DaemonRunner在线程或者进程中运行任意数量的工作者，可以单独启动和停止每个守护进程，停止时等待当前一批完成
+（3）有工作时立即执行下一次；没有工作时休眠时间从min_sleep开始加倍，最多为max_sleep，
+step返回了下一次工作的时间时直接休眠到那个时间，高频运行时不会在空轮询上浪费CPU和redis命令
+（4）每个工作者每隔report_interval秒以及处理完积压时把运行状态写入散列daemons:，health()汇总所有进程的状态、积压量和延迟
+
+用法：
+    runner = DaemonRunner(lambda: redis.Redis(db=15))
+    runner.start(shopping_website.cleanFullSessionDaemon(), workers = 4)
+    print runner.health()
+    runner.stop()
+"""
+
+import os
+import sys
+import json
+import time
+import signal
+import threading
+import unittest
+import multiprocessing
+
+"""
+守护进程的描述
+
+@param {string}   名称
+@param {function} step(conn, state)执行一次，state是每个工作者自己的字典；
+                  返回处理的数量，或者(处理的数量, 下一次工作的时间戳)，时间戳为None表示不知道
+@param {function} backlog(conn)返回积压的数量，可选
+@param {function} lag(conn)返回落后的秒数，可选
+@param {float}    没有工作时的最短休眠时间(秒)
+@param {float}    没有工作时的最长休眠时间(秒)
+"""
+class Daemon(object):
+    def __init__(self, name, step, backlog = None, lag = None, min_sleep = .01, max_sleep = 1):
+        self.name = name
+        self.step = step
+        self.backlog = backlog
+        self.lag = lag
+        self.min_sleep = min_sleep
+        self.max_sleep = max(min_sleep, max_sleep)
+
+# 保存所有工作者运行状态的散列
+HEALTH_KEY = 'daemons:'
+# 休眠时每隔多少秒检查一次停止标志
+STOP_CHECK_INTERVAL = .1
+
+"""
+休眠指定的秒数，停止标志被设置时立即返回
+
+@param {object} threading.Event或者multiprocessing.Event
+@param {float}  秒数
+
+@return {bool} 停止标志是否被设置
+"""
+def waitStop(stop, seconds):
+    end = time.time() + seconds
+    while not stop.is_set():
+        left = end - time.time()
+        if left <= 0:
+            return False
+        # 使用time.sleep而不是stop.wait，测试中的虚拟时钟可以直接跳过休眠时间
+        time.sleep(min(left, STOP_CHECK_INTERVAL))
+    return True
+
+"""
+工作者的主循环，直到停止标志被设置
+也可以在当前线程或者协程中直接调用，停止标志只需要提供is_set()
+
+@param {object}   conn
+@param {object}   Daemon
+@param {object}   停止标志
+@param {string}   工作者ID，默认由名称、进程ID和这次调用生成
+@param {float}    写入运行状态的间隔(秒)
+@param {function} wait_stop(stop, seconds)休眠，停止标志被设置时立即返回，默认为waitStop
+"""
+def runDaemon(conn, daemon, stop, worker = None, report_interval = 1, wait_stop = waitStop):
+    state = {}
+    if worker is None:
+        worker = '%s:%s:%x' % (daemon.name, os.getpid(), id(state))
+    stats = {
+        'daemon': daemon.name, 'worker': worker, 'pid': os.getpid(),
+        'runs': 0, 'items': 0, 'errors': 0, 'last_error': None,
+        'last_duration': 0.0, 'last_run': None, 'sleep': 0.0, 'updated': None,
+    }
+    sleep = daemon.min_sleep
+    reported = reported_items = 0
+
+    while not stop.is_set():
+        start = time.time()
+        try:
+            result = daemon.step(conn, state)
+        except Exception as error:
+            # 出错时同样退避，redis不可用时不会空转
+            stats['errors'] += 1
+            stats['last_error'] = '%s: %s' % (type(error).__name__, error)
+            result = 0
+        count, next_due = result if isinstance(result, tuple) else (result, None)
+        now = time.time()
+
+        stats['runs'] += 1
+        stats['items'] += count
+        stats['last_duration'] = now - start
+        stats['last_run'] = now
+
+        # 有工作时立即执行下一次，没有工作时退避
+        if count:
+            sleep = daemon.min_sleep
+            wait = 0
+        elif next_due is not None:
+            wait = min(daemon.max_sleep, next_due - now)
+        else:
+            wait = sleep
+            sleep = min(daemon.max_sleep, sleep * 2)
+        stats['sleep'] = max(0, wait)
+
+        # 每隔report_interval秒，以及处理完积压开始休眠时写入运行状态
+        if now - reported >= report_interval or (not count and stats['items'] != reported_items):
+            reportHealth(conn, stats)
+            reported, reported_items = now, stats['items']
+        # 有工作时也调用一次，协程可以借此让出CPU
+        wait_stop(stop, max(0, wait))
+
+    # 正常退出时删除自己的运行状态，异常退出的工作者会在health()中显示为不再存活
+    try:
+        conn.hdel(HEALTH_KEY, worker)
+    except Exception:
+        pass
+
+"""
+写入工作者的运行状态
+
+@param {object} conn
+@param {dict}   运行状态
+"""
+def reportHealth(conn, stats):
+    stats['updated'] = time.time()
+    try:
+        conn.hset(HEALTH_KEY, stats['worker'], json.dumps(stats))
+    except Exception as error:
+        stats['errors'] += 1
+        stats['last_error'] = '%s: %s' % (type(error).__name__, error)
+
+"""
+在线程或者进程中运行守护进程
+
+@param {function} 创建redis连接的函数，每个工作者调用一次
+@param {bool}     是否使用进程，False时使用线程
+@param {float}    工作者写入运行状态的间隔(秒)
+"""
+class DaemonRunner(object):
+    def __init__(self, connect, processes = True, report_interval = 1):
+        self.connect = connect
+        self.processes = processes
+        self.report_interval = report_interval
+        # 名称：(Daemon, 停止标志, 工作者列表)
+        self.daemons = {}
+
+    """
+    启动守护进程
+
+    @param {object} Daemon
+    @param {int}    工作者数量
+    """
+    def start(self, daemon, workers = 1):
+        if daemon.name in self.daemons:
+            raise ValueError('daemon %s is already running' % daemon.name)
+        stop = multiprocessing.Event() if self.processes else threading.Event()
+        started = []
+        for index in xrange(workers):
+            args = (daemon, stop, index)
+            if self.processes:
+                worker = multiprocessing.Process(target = self._work, args = args, name = daemon.name)
+            else:
+                worker = threading.Thread(target = self._work, args = args, name = daemon.name)
+            worker.daemon = True
+            worker.start()
+            started.append(worker)
+        self.daemons[daemon.name] = (daemon, stop, started)
+
+    def _work(self, daemon, stop, index):
+        if self.processes:
+            # 子进程收到SIGTERM时完成当前一批再退出，Ctrl-C由父进程统一处理
+            signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+        worker = '%s:%s:%s' % (daemon.name, os.getpid(), index)
+        runDaemon(self.connect(), daemon, stop, worker, self.report_interval)
+
+    """
+    停止守护进程，等待工作者完成当前一批，超时之后结束仍在运行的进程
+
+    @param {string} 名称，默认停止所有守护进程
+    @param {float}  最长等待时间(秒)
+
+    @return {bool} 是否所有工作者都已经退出
+    """
+    def stop(self, name = None, timeout = 5):
+        names = [name] if name is not None else list(self.daemons)
+        for name in names:
+            self.daemons[name][1].set()
+
+        end = time.time() + timeout
+        stopped = True
+        for name in names:
+            daemon, stop, workers = self.daemons.pop(name)
+            for worker in workers:
+                worker.join(max(0, end - time.time()))
+                if worker.is_alive() and self.processes:
+                    worker.terminate()
+                    worker.join(1)
+                    if worker.is_alive():
+                        os.kill(worker.pid, signal.SIGKILL)
+                        worker.join()
+                stopped = stopped and not worker.is_alive()
+        return stopped
+
+    """
+    汇总所有工作者的运行状态，并取得每个守护进程的积压量和延迟
+
+    @param {object} conn，默认新建一个连接
+
+    @return {dict} 名称：运行状态
+    """
+    def health(self, conn = None):
+        conn = conn or self.connect()
+        workers = {}
+        for data in conn.hvals(HEALTH_KEY):
+            stats = json.loads(data)
+            workers.setdefault(stats['daemon'], []).append(stats)
+
+        now = time.time()
+        result = {}
+        for name, (daemon, stop, started) in self.daemons.items():
+            reports = sorted(workers.get(name, []), key = lambda stats: stats['worker'])
+            for stats in reports:
+                # 超过3个写入间隔没有更新，说明工作者已经异常退出或者卡住了
+                stats['alive'] = now - stats['updated'] < 3 * max(self.report_interval, STOP_CHECK_INTERVAL) + stats['sleep']
+            last_runs = [stats['last_run'] for stats in reports if stats['last_run']]
+            result[name] = {
+                'workers': sum(1 for worker in started if worker.is_alive()),
+                'runs': sum(stats['runs'] for stats in reports),
+                'items': sum(stats['items'] for stats in reports),
+                'errors': sum(stats['errors'] for stats in reports),
+                'last_duration': max([stats['last_duration'] for stats in reports] or [0.0]),
+                'since_last_run': now - max(last_runs) if last_runs else None,
+                'backlog': daemon.backlog(conn) if daemon.backlog else None,
+                'lag': daemon.lag(conn) if daemon.lag else None,
+                'reports': reports,
+            }
+        return result
+
+# 测试通过redis_standin连接redis，设置环境变量REDIS_STANDIN=1时使用进程内的替身服务器和虚拟时间
+"""
+测试
+"""
+class TestDaemon(unittest.TestCase):
+    def setUp(self):
+        import redis_standin
+        self.conn = redis_standin.connect(db=15, modules=[sys.modules[__name__]])
+        self.addCleanup(redis_standin.restoreTime)
+
+    def tearDown(self):
+        self.conn.flushdb()
+        del self.conn
+        print
+        print
+
+    def testBackoff(self):
+        conn = self.conn
+        conn.rpush('jobs', *range(10))
+
+        def step(conn, state):
+            state['calls'] = state.get('calls', 0) + 1
+            if state['calls'] == 3:
+                raise ValueError('broken job')
+            return 1 if conn.lpop('jobs') is not None else 0
+
+        def backlog(conn):
+            return conn.llen('jobs')
+
+        runner = DaemonRunner(lambda: conn, processes = False, report_interval = .5)
+        runner.start(Daemon('jobs', step, backlog, min_sleep = .01, max_sleep = 1))
+        time.sleep(10)
+        health = runner.health()['jobs']
+        print "Health:", health
+        self.assertEquals(health['workers'], 1)
+        self.assertEquals(health['items'], 10)
+        self.assertEquals(health['backlog'], 0)
+        self.assertEquals(health['errors'], 1)
+        self.assertTrue(health['reports'][0]['last_error'].startswith('ValueError'))
+        self.assertTrue(health['reports'][0]['alive'])
+        # 没有工作之后休眠时间加倍，10秒内只空转了十几次，而不是每10毫秒一次
+        self.assertTrue(health['runs'] < 30)
+
+        self.assertTrue(runner.stop())
+        self.assertFalse(conn.exists(HEALTH_KEY))
+
+    def testNextDue(self):
+        conn = self.conn
+        calls = []
+
+        def step(conn, state):
+            calls.append(time.time())
+            return 0, time.time() + 2
+
+        runner = DaemonRunner(lambda: conn, processes = False)
+        runner.start(Daemon('scheduled', step, max_sleep = 5))
+        self.assertRaises(ValueError, runner.start, Daemon('scheduled', step))
+        time.sleep(9)
+        self.assertTrue(runner.stop('scheduled'))
+        print "Calls:", len(calls)
+        # 直接休眠到下一次工作的时间
+        self.assertEquals(len(calls), 5)
+        self.assertFalse(runner.daemons)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+基于gevent的异步redis客户端
+GeventConnection使用gevent的socket，等待redis回复时会切换到其他协程，
+一个进程中的几千个协程可以同时等待各自的redis请求，不需要对整个程序执行monkey.patch_all()。
+连接池使用gevent的LifoQueue，连接数达到上限时，协程等待其他协程归还连接，而不是阻塞整个进程。
+
+article_async和shopping_async中的函数返回gevent.Greenlet，调用get()等待结果，相当于asyncio中的await：
+    conn = asyncRedis(db=15)
+    articles = article_async.getArticles(conn, 1).get()
+"""
+
+import gevent
+import gevent.queue
+from gevent import socket
+
+import redis
+from redis.connection import Connection, BlockingConnectionPool
+
+"""
+使用gevent socket的redis连接
+"""
+class GeventConnection(Connection):
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port), self.socket_connect_timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.socket_keepalive:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            for option, value in self.socket_keepalive_options.items():
+                sock.setsockopt(socket.IPPROTO_TCP, option, value)
+        sock.settimeout(self.socket_timeout)
+        return sock
+
+"""
+创建异步redis客户端
+
+@param {string} host
+@param {int}    port
+@param {int}    数据库
+@param {int}    最大连接数
+@param {float}  等待空闲连接的最长时间，None表示一直等待
+
+@return {object} redis.Redis
+"""
+def asyncRedis(host = 'localhost', port = 6379, db = 0, max_connections = 100, timeout = None):
+    pool = BlockingConnectionPool(
+        max_connections = max_connections, timeout = timeout,
+        connection_class = GeventConnection, queue_class = gevent.queue.LifoQueue,
+        host = host, port = port, db = db)
+    return redis.Redis(connection_pool = pool)
+
+"""
+同时等待多个协程，按照顺序返回它们的结果，任何一个协程出错时抛出这个错误
+
+@param {array} gevent.Greenlet
+
+@return {array}
+"""
+def gather(*greenlets):
+    gevent.joinall(greenlets, raise_error = True)
+    return [greenlet.value for greenlet in greenlets]
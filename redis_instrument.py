@@ -0,0 +1,380 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+redis命令统计
+instrument(conn)返回一个和conn共享连接池的redis.Redis，可以直接代替conn传给各章节的函数。
+每次和redis服务器通信（一个命令、一个流水线或者一次Lua脚本调用）都会记录到发起调用的函数上：
+命令数、通信往返次数、发送和接收的字节数（按照redis协议格式计算）以及延迟分布。
+
+例如要确认getArticles没有每篇文章一次HGETALL这样的N+1问题，只需要把
+    articles = getArticles(conn, 1)
+改为
+    articles = getArticles(instrument(conn), 1)
+getArticles在一个Lua脚本中取出一页文章，METRICS.prometheus()或者METRICS.logLine()中
+article_voted.getArticles每次调用应该只有一次通信往返；如果往返次数随着一页文章数增长，就是出现了N+1问题。
+函数名称带有模块名，不同章节中的同名函数分别统计。
+"""
+
+import os
+import sys
+import copy
+import time
+import bisect
+import logging
+import threading
+import unittest
+
+import redis
+
+# 延迟分布的桶，单位为秒
+LATENCY_BUCKETS = (.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1.0)
+
+"""
+按照调用函数统计的redis命令
+
+@param {tuple} 延迟分布的桶
+"""
+class RedisMetrics(object):
+    def __init__(self, buckets = LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.functions = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _stats(self, function):
+        stats = self.functions.get(function)
+        if stats is None:
+            stats = self.functions[function] = {
+                'commands': 0,
+                'round_trips': 0,
+                'sent_bytes': 0,
+                'received_bytes': 0,
+                'seconds': 0.0,
+                # 每个桶内的次数，最后一个为超过最大的桶
+                'histogram': [0] * (len(self.buckets) + 1),
+            }
+        return stats
+
+    """
+    记录一次通信往返
+
+    @param {string} 调用函数
+    @param {int}    命令数
+    @param {int}    发送的字节数
+    @param {int}    接收的字节数
+    @param {float}  耗时
+    """
+    def record(self, function, commands, sent, received, seconds):
+        with self._lock:
+            stats = self._stats(function)
+            stats['commands'] += commands
+            stats['round_trips'] += 1
+            stats['sent_bytes'] += sent
+            stats['received_bytes'] += received
+            stats['seconds'] += seconds
+            stats['histogram'][bisect.bisect_left(self.buckets, seconds)] += 1
+
+    def addReceived(self, size):
+        self._local.received = getattr(self._local, 'received', 0) + size
+
+    """
+    执行一次通信往返并记录下来
+
+    @param {string}   调用函数
+    @param {array}    发送的命令，每个元素为一条命令的参数
+    @param {function}
+    """
+    def measure(self, function, commands, call, *args, **kwargs):
+        # 嵌套调用时保存外层已经接收的字节数
+        outer = getattr(self._local, 'received', 0)
+        self._local.received = 0
+        start = time.time()
+        try:
+            return call(*args, **kwargs)
+        finally:
+            seconds = time.time() - start
+            received = self._local.received
+            self._local.received = outer
+            self.record(function, len(commands), sum(commandSize(command) for command in commands), received, seconds)
+
+    def snapshot(self):
+        with self._lock:
+            return copy.deepcopy(self.functions)
+
+    def reset(self):
+        with self._lock:
+            self.functions = {}
+
+    """
+    根据延迟分布估算百分位数，返回所在桶的上限
+
+    @param {dict}  一个函数的统计
+    @param {float} 0到100
+    """
+    def percentile(self, stats, p):
+        target = stats['round_trips'] * p / 100.0
+        count = 0
+        for i, bucket_count in enumerate(stats['histogram']):
+            count += bucket_count
+            if count >= target and bucket_count:
+                return self.buckets[i] if i < len(self.buckets) else float('inf')
+        return 0.0
+
+    """
+    导出为Prometheus的文本格式
+
+    @param {string} 指标名称的前缀
+
+    @return {string}
+    """
+    def prometheus(self, prefix = 'redis_client'):
+        functions = sorted(self.snapshot().items())
+        lines = []
+        for name, help in (
+                ('commands', 'Redis commands sent'),
+                ('round_trips', 'Round trips to the Redis server'),
+                ('sent_bytes', 'Bytes sent in the Redis protocol'),
+                ('received_bytes', 'Bytes received in the Redis protocol')):
+            metric = '%s_%s_total' % (prefix, name)
+            lines.append('# HELP %s %s, by calling function' % (metric, help))
+            lines.append('# TYPE %s counter' % metric)
+            for function, stats in functions:
+                lines.append('%s{function="%s"} %s' % (metric, function, stats[name]))
+
+        metric = '%s_round_trip_seconds' % prefix
+        lines.append('# HELP %s Round trip latency, by calling function' % metric)
+        lines.append('# TYPE %s histogram' % metric)
+        for function, stats in functions:
+            count = 0
+            for bucket, bucket_count in zip(self.buckets + ('+Inf',), stats['histogram']):
+                count += bucket_count
+                lines.append('%s_bucket{function="%s",le="%s"} %s' % (metric, function, bucket, count))
+            lines.append('%s_sum{function="%s"} %r' % (metric, function, stats['seconds']))
+            lines.append('%s_count{function="%s"} %s' % (metric, function, stats['round_trips']))
+        return '\n'.join(lines) + '\n'
+
+    """
+    导出为一行日志，按照通信往返次数从多到少排列
+
+    @return {string}
+    """
+    def logLine(self):
+        functions = sorted(self.snapshot().items(), key = lambda item: -item[1]['round_trips'])
+        return 'redis: ' + '; '.join(
+            '%s commands=%s round_trips=%s sent=%sB received=%sB p50=%.2fms p99=%.2fms' % (
+                function, stats['commands'], stats['round_trips'], stats['sent_bytes'], stats['received_bytes'],
+                self.percentile(stats, 50) * 1000, self.percentile(stats, 99) * 1000)
+            for function, stats in functions)
+
+# 默认的统计
+METRICS = RedisMetrics()
+
+"""
+按照redis协议格式计算命令和回复的字节数
+"""
+def argumentSize(arg):
+    if isinstance(arg, unicode):
+        return len(arg.encode('utf-8'))
+    if isinstance(arg, float):
+        return len(repr(arg))
+    return len(str(arg))
+
+def commandSize(args):
+    size = len('*%d\r\n' % len(args))
+    for arg in args:
+        length = argumentSize(arg)
+        size += len('$%d\r\n' % length) + length + 2
+    return size
+
+def replySize(reply):
+    if reply is None:
+        return 5
+    if isinstance(reply, (int, long)):
+        return len(':%d\r\n' % reply)
+    if isinstance(reply, Exception):
+        return len(str(reply)) + 3
+    if isinstance(reply, (list, tuple)):
+        return len('*%d\r\n' % len(reply)) + sum(replySize(item) for item in reply)
+    length = argumentSize(reply)
+    return len('$%d\r\n' % length) + length + 2
+
+# 查找调用函数时跳过redis-py的栈帧
+_REDIS_PATH = os.path.dirname(os.path.abspath(redis.__file__)) + os.sep
+
+"""
+取得发起redis调用的函数名称（模块名.函数名），即调用栈中统计方法之上第一个不属于redis-py的函数
+"""
+def callerName():
+    frame = sys._getframe(2)
+    while frame is not None:
+        if not os.path.abspath(frame.f_code.co_filename).startswith(_REDIS_PATH):
+            return '%s.%s' % (frame.f_globals.get('__name__', '?'), frame.f_code.co_name)
+        frame = frame.f_back
+    return '<unknown>'
+
+"""
+包装连接，统计读取到的回复的字节数，其他属性直接使用原来的连接
+"""
+class CountingConnection(object):
+    def __init__(self, connection, metrics):
+        self._connection = connection
+        self._metrics = metrics
+
+    def read_response(self):
+        response = self._connection.read_response()
+        self._metrics.addReceived(replySize(response))
+        return response
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+class InstrumentedClient(object):
+    def execute_command(self, *args, **options):
+        return self.metrics.measure(
+            callerName(), [args], super(InstrumentedClient, self).execute_command, *args, **options)
+
+    def parse_response(self, connection, command_name, **options):
+        return super(InstrumentedClient, self).parse_response(
+            CountingConnection(connection, self.metrics), command_name, **options)
+
+    def pipeline(self, transaction = True, shard_hint = None):
+        pipe = super(InstrumentedClient, self).pipeline(transaction, shard_hint)
+        pipe.__class__ = instrumentedClass(type(pipe), InstrumentedPipeline)
+        pipe.metrics = self.metrics
+        return pipe
+
+class InstrumentedPipeline(object):
+    # WATCH之后的命令立即执行，每个命令一次通信往返
+    def immediate_execute_command(self, *args, **options):
+        return self.metrics.measure(
+            callerName(), [args], super(InstrumentedPipeline, self).immediate_execute_command, *args, **options)
+
+    def parse_response(self, connection, command_name, **options):
+        return super(InstrumentedPipeline, self).parse_response(
+            CountingConnection(connection, self.metrics), command_name, **options)
+
+    def _execute_transaction(self, connection, commands, raise_on_error):
+        sent = [('MULTI',)] + [args for args, options in commands] + [('EXEC',)]
+        return self.metrics.measure(
+            callerName(), sent, super(InstrumentedPipeline, self)._execute_transaction,
+            connection, commands, raise_on_error)
+
+    def _execute_pipeline(self, connection, commands, raise_on_error):
+        return self.metrics.measure(
+            callerName(), [args for args, options in commands], super(InstrumentedPipeline, self)._execute_pipeline,
+            connection, commands, raise_on_error)
+
+_CLASSES = {}
+
+def instrumentedClass(base, mixin):
+    if (base, mixin) not in _CLASSES:
+        _CLASSES[(base, mixin)] = type('Instrumented' + base.__name__, (mixin, base), {})
+    return _CLASSES[(base, mixin)]
+
+"""
+返回统计命令的redis客户端，和conn共享连接池，可以在任何接受conn的地方使用
+
+@param {object} redis.Redis
+@param {object} RedisMetrics，默认为METRICS
+
+@return {object}
+"""
+def instrument(conn, metrics = None):
+    if isinstance(conn, InstrumentedClient):
+        return conn
+    client = copy.copy(conn)
+    client.__class__ = instrumentedClass(type(conn), InstrumentedClient)
+    client.metrics = metrics or METRICS
+    return client
+
+"""
+每隔interval秒把统计写入一行日志
+
+@param {object} RedisMetrics，默认为METRICS
+@param {int}    间隔秒数
+@param {object} logging.Logger，默认为名为redis的logger
+"""
+QUIT = False
+
+def logMetrics(metrics = None, interval = 60, logger = None):
+    metrics = metrics or METRICS
+    logger = logger or logging.getLogger('redis')
+    while not QUIT:
+        time.sleep(interval)
+        if metrics.functions:
+            logger.info(metrics.logLine())
+
+"""
+测试
+"""
+class TestInstrument(unittest.TestCase):
+    def setUp(self):
+        import redis_standin
+        self.conn = redis_standin.connect(db = 15)
+        self.metrics = RedisMetrics()
+
+    def tearDown(self):
+        self.conn.delete(*(['counter'] + ['article:%s' % i for i in xrange(5)]))
+        del self.conn
+        print
+        print
+
+    def testNPlusOne(self):
+        conn = instrument(self.conn, self.metrics)
+
+        def getArticlesOneByOne(conn):
+            ids = conn.lrange('articles', 0, -1)
+            return [conn.hgetall('article:' + id) for id in ids]
+
+        def getArticlesPipelined(conn):
+            pipe = conn.pipeline(False)
+            for i in xrange(5):
+                pipe.hgetall('article:%s' % i)
+            return pipe.execute()
+
+        for i in xrange(5):
+            self.conn.hmset('article:%s' % i, {'title': 'title %s' % i})
+        self.conn.rpush('articles', *range(5))
+        getArticlesOneByOne(conn)
+        getArticlesPipelined(conn)
+        self.conn.delete('articles')
+
+        stats = self.metrics.snapshot()
+        print self.metrics.logLine()
+        one_by_one = stats[__name__ + '.getArticlesOneByOne']
+        pipelined = stats[__name__ + '.getArticlesPipelined']
+        self.assertEquals(one_by_one['round_trips'], 6)
+        self.assertEquals(one_by_one['commands'], 6)
+        self.assertEquals(pipelined['round_trips'], 1)
+        self.assertEquals(pipelined['commands'], 5)
+        self.assertEquals(pipelined['sent_bytes'], 5 * commandSize(['HGETALL', 'article:0']))
+        self.assertTrue(pipelined['received_bytes'] > 5 * len('title 0'))
+
+    def testTransactionAndPrometheus(self):
+        conn = instrument(self.conn, self.metrics)
+
+        def incrementTwice(conn):
+            pipe = conn.pipeline()
+            pipe.watch('counter')
+            pipe.get('counter')
+            pipe.multi()
+            pipe.incr('counter')
+            pipe.incr('counter')
+            return pipe.execute()
+
+        self.assertEquals(incrementTwice(conn), [1, 2])
+        function = __name__ + '.incrementTwice'
+        stats = self.metrics.snapshot()[function]
+        # WATCH、GET、MULTI+2个INCR+EXEC，事务结束后不需要UNWATCH
+        self.assertEquals(stats['round_trips'], 3)
+        self.assertEquals(stats['commands'], 6)
+
+        text = self.metrics.prometheus()
+        print text
+        self.assertTrue('redis_client_round_trips_total{function="%s"} 3' % function in text)
+        self.assertTrue('redis_client_round_trip_seconds_bucket{function="%s",le="+Inf"} 3' % function in text)
+        self.assertTrue('redis_client_round_trip_seconds_count{function="%s"} 3' % function in text)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,316 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+读写分离：把只读的调用发送到从服务器，写命令发送到主服务器
+（1）router.client()返回一个redis.Redis，可以直接代替conn传给各章节的函数：READ_COMMANDS中的命令发送到从服务器，
+     其他命令、流水线和Lua脚本发送到主服务器，例如checkToken的HGET、canCache的ZRANK和cacheRequest的MGET
+（2）router.reader()返回一个从服务器（或者主服务器）的连接，用于指定为只读的调用，
+     例如getArticles使用只读的Lua脚本：getArticles(router.reader(), 1)
+（3）延迟保护：每隔check_interval秒用INFO replication比较主服务器和从服务器的复制偏移量，
+     记录每个从服务器最后一次确认已经同步到的时间；落后超过max_lag秒或者断开连接的从服务器不再使用
+（4）读己之写：每个线程记录最后一次写入的时间，在从服务器同步到这个时间之前，这个线程的读取都发送到主服务器，
+     例如voteArticle之后立即取出文章列表可以看到自己的投票。跨请求时可以把lastWrite()保存在用户会话中，
+     每个请求开始时传给beginRequest()
+
+用法：
+    router = ReplicaRouter(redis.Redis(port=6379), [redis.Redis(port=6380), redis.Redis(port=6381)])
+    conn = router.client()
+    user = shopping_website.checkToken(conn, token)
+    articles = article_voted.getArticles(router.reader(), 1)
+"""
+
+import os
+import sys
+import copy
+import time
+import threading
+import unittest
+from collections import deque
+
+import redis
+
+# 可以发送到从服务器的只读命令
+READ_COMMANDS = frozenset([
+    'EXISTS', 'TYPE', 'TTL', 'PTTL', 'KEYS', 'SCAN', 'DBSIZE', 'RANDOMKEY',
+    'GET', 'MGET', 'STRLEN', 'GETRANGE', 'GETBIT', 'BITCOUNT',
+    'HGET', 'HMGET', 'HGETALL', 'HKEYS', 'HVALS', 'HLEN', 'HEXISTS', 'HSCAN',
+    'LLEN', 'LINDEX', 'LRANGE',
+    'SCARD', 'SISMEMBER', 'SMEMBERS', 'SRANDMEMBER', 'SINTER', 'SUNION', 'SDIFF', 'SSCAN',
+    'ZSCORE', 'ZCARD', 'ZCOUNT', 'ZRANK', 'ZREVRANK', 'ZRANGE', 'ZREVRANGE', 'ZRANGEBYSCORE',
+    'ZREVRANGEBYSCORE', 'ZRANGEBYLEX', 'ZREVRANGEBYLEX', 'ZLEXCOUNT', 'ZSCAN',
+    'XLEN', 'XRANGE', 'XREVRANGE', 'XREAD',
+])
+
+"""
+读写分离的路由
+
+@param {object} 主服务器的redis.Redis
+@param {array}  从服务器的redis.Redis列表
+@param {float}  从服务器最多落后的秒数，超过时不再使用
+@param {float}  检查复制偏移量的间隔(秒)
+"""
+class ReplicaRouter(object):
+    def __init__(self, master, replicas, max_lag = 1, check_interval = .1):
+        self.master = master
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        # 每个从服务器的状态：连接、是否可用、最后一次确认已经同步到的时间
+        self.replicas = [{'conn': conn, 'healthy': False, 'synced_at': None, 'reads': 0} for conn in replicas]
+        self.counters = {'replica_reads': 0, 'master_reads': 0, 'read_your_writes': 0, 'lagging': 0}
+        # 主服务器的(时间, 复制偏移量)，用于判断从服务器同步到了哪个时间
+        self._samples = deque()
+        self._checked = None
+        self._next = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    """
+    记录当前线程写入了主服务器，之后的读取在从服务器同步之前发送到主服务器
+
+    @param {float} 写入完成的时间，默认为当前时间
+    """
+    def wrote(self, at = None):
+        self._local.last_write = time.time() if at is None else at
+
+    def lastWrite(self):
+        return getattr(self._local, 'last_write', None)
+
+    """
+    开始处理一个请求，当前线程的最后写入时间设置为用户会话中保存的时间
+
+    @param {float} 这个用户最后一次写入的时间，None表示没有写入过
+    """
+    def beginRequest(self, last_write = None):
+        self._local.last_write = last_write
+
+    """
+    检查从服务器的复制偏移量，距离上次检查不到check_interval秒时直接返回
+    先取得主服务器的偏移量再取得从服务器的偏移量：从服务器的偏移量不小于主服务器在时间t的偏移量时，
+    说明t之前完成的写入都已经同步到从服务器。保存最近max_lag秒内的多个采样，持续写入时从服务器通常也能追上较早的采样。
+
+    @param {bool} 是否忽略检查间隔
+    """
+    def refresh(self, force = False):
+        now = time.time()
+        with self._lock:
+            if not force and self._checked is not None and now - self._checked < self.check_interval:
+                return
+            self._checked = now
+
+        try:
+            offset = self.master.info('replication')['master_repl_offset']
+        except redis.RedisError:
+            return
+
+        with self._lock:
+            self._samples.append((now, offset))
+            while len(self._samples) > 1 and self._samples[0][0] < now - self.max_lag - self.check_interval:
+                self._samples.popleft()
+            samples = list(self._samples)
+
+        for replica in self.replicas:
+            try:
+                info = replica['conn'].info('replication')
+            except redis.RedisError:
+                replica['healthy'] = False
+                continue
+            replica['healthy'] = info.get('master_link_status') == 'up'
+            synced = [at for at, master_offset in samples if master_offset <= info.get('slave_repl_offset', -1)]
+            if synced and (replica['synced_at'] is None or max(synced) > replica['synced_at']):
+                replica['synced_at'] = max(synced)
+
+    """
+    选择一个可以读取的服务器
+    从服务器必须可用、不超过max_lag秒以前确认过同步，并且已经同步到since；
+    都不满足时返回主服务器。多个从服务器轮流使用。
+
+    @param {float} 需要读到这个时间之前的写入，默认为当前线程最后一次写入的时间
+
+    @return {object} redis.Redis
+    """
+    def reader(self, since = None):
+        since = self.lastWrite() if since is None else since
+        self.refresh()
+        now = time.time()
+        fresh = [replica for replica in self.replicas
+            if replica['healthy'] and replica['synced_at'] is not None and now - replica['synced_at'] <= self.max_lag]
+        candidates = [replica for replica in fresh if since is None or replica['synced_at'] >= since]
+
+        with self._lock:
+            if not candidates:
+                self.counters['master_reads'] += 1
+                if self.replicas:
+                    self.counters['read_your_writes' if fresh else 'lagging'] += 1
+                return self.master
+            self._next = (self._next + 1) % len(candidates)
+            replica = candidates[self._next]
+            replica['reads'] += 1
+            self.counters['replica_reads'] += 1
+            return replica['conn']
+
+    """
+    从服务器连接失败时标记为不可用，直到下一次检查
+    """
+    def failed(self, conn):
+        for replica in self.replicas:
+            if replica['conn'] is conn:
+                replica['healthy'] = False
+
+    """
+    返回读写分离的redis.Redis，和主服务器的连接共享连接池
+
+    @return {object}
+    """
+    def client(self):
+        client = copy.copy(self.master)
+        client.__class__ = routedClass(type(self.master), RoutedClient)
+        client.router = self
+        return client
+
+    """
+    每个从服务器的状态和读取次数
+
+    @return {dict}
+    """
+    def stats(self):
+        now = time.time()
+        result = dict(self.counters)
+        result['replicas'] = [{
+            'healthy': replica['healthy'],
+            'lag': now - replica['synced_at'] if replica['synced_at'] is not None else None,
+            'reads': replica['reads'],
+        } for replica in self.replicas]
+        return result
+
+class RoutedClient(object):
+    def execute_command(self, *args, **options):
+        if args[0].upper() in READ_COMMANDS:
+            conn = self.router.reader()
+            if conn is not self.router.master:
+                try:
+                    return conn.execute_command(*args, **options)
+                except redis.ConnectionError:
+                    # 从服务器不可用，改为读取主服务器
+                    self.router.failed(conn)
+        result = super(RoutedClient, self).execute_command(*args, **options)
+        if args[0].upper() not in READ_COMMANDS:
+            self.router.wrote()
+        return result
+
+    # 流水线可能包含写命令，全部发送到主服务器
+    def pipeline(self, transaction = True, shard_hint = None):
+        pipe = super(RoutedClient, self).pipeline(transaction, shard_hint)
+        pipe.__class__ = routedClass(type(pipe), RoutedPipeline)
+        pipe.router = self.router
+        return pipe
+
+class RoutedPipeline(object):
+    def execute(self, raise_on_error = True):
+        try:
+            return super(RoutedPipeline, self).execute(raise_on_error)
+        finally:
+            self.router.wrote()
+
+_CLASSES = {}
+
+def routedClass(base, mixin):
+    if (base, mixin) not in _CLASSES:
+        _CLASSES[(base, mixin)] = type('Routed' + base.__name__, (mixin, base), {})
+    return _CLASSES[(base, mixin)]
+
+"""
+测试
+设置REDIS_STANDIN=1时使用进程内的替身服务器和它的从服务器；
+否则连接本机6379端口的主服务器和REDIS_REPLICA_PORT（默认6380）端口的从服务器，
+从服务器可以这样启动：redis-server --port 6380 --slaveof 127.0.0.1 6379
+"""
+class TestReplica(unittest.TestCase):
+    def setUp(self):
+        import redis_standin
+        self.conn = redis_standin.connect(db = 15, modules = [sys.modules[__name__]])
+        self.addCleanup(redis_standin.restoreTime)
+        self.standin = redis_standin.enabled()
+        if self.standin:
+            self.replica = redis_standin.standinRedis(15, redis_standin.replicaServer(delay = .5))
+        else:
+            self.replica = redis.Redis(port = int(os.environ.get('REDIS_REPLICA_PORT', 6380)), db = 15)
+            try:
+                if self.replica.info('replication').get('role') != 'slave':
+                    self.replica = None
+            except redis.RedisError:
+                self.replica = None
+
+    def tearDown(self):
+        self.conn.flushdb()
+        if self.standin:
+            self.replica.slaveof()
+        del self.conn, self.replica
+        print
+        print
+
+    def testReadYourWrites(self):
+        if self.replica is None:
+            print "needs a replica, skipping"
+            return
+        router = ReplicaRouter(self.conn, [self.replica], max_lag = 2, check_interval = .1)
+        conn = router.client()
+        time.sleep(1)
+        self.assertTrue(router.reader() is self.replica)
+
+        print "A read right after a write goes to the master"
+        conn.hset('login:', 'token', 'user')
+        self.assertEquals(conn.hget('login:', 'token'), 'user')
+        self.assertEquals(router.counters['read_your_writes'], 1)
+
+        print "Once the replica has caught up, reads go to the replica"
+        time.sleep(1)
+        self.assertEquals(conn.hget('login:', 'token'), 'user')
+        self.assertEquals(router.counters['replica_reads'], 2)
+
+        print "Scripts and pipelines are writes"
+        pipe = conn.pipeline(False)
+        pipe.zadd('viewed:', 'item', -1)
+        pipe.execute()
+        self.assertTrue(router.reader() is self.conn)
+
+        # 其他线程没有写入，可以读取从服务器
+        readers = []
+        thread = threading.Thread(target = lambda: readers.append(router.reader()))
+        thread.start()
+        thread.join()
+        self.assertTrue(readers[0] is self.replica)
+        # 会话中保存的写入时间
+        last_write = router.lastWrite()
+        router.beginRequest()
+        self.assertTrue(router.reader() is self.replica)
+        self.assertTrue(router.reader(since = last_write) is self.conn)
+        router.beginRequest(last_write)
+        self.assertTrue(router.reader() is self.conn)
+        print "Stats:", router.stats()
+
+    def testLagGuard(self):
+        if not self.standin:
+            print "needs the standin replica, skipping"
+            return
+        router = ReplicaRouter(self.conn, [self.replica], max_lag = 1, check_interval = .1)
+        conn = router.client()
+        conn.set('key', 'v1')
+        time.sleep(1)
+        self.assertTrue(router.reader() is self.replica)
+
+        print "A replica that stops replicating is not used after max_lag seconds"
+        self.replica.connection_pool.connection_kwargs['server'].link_up = False
+        conn.set('key', 'v2')
+        time.sleep(1.5)
+        self.assertTrue(router.reader() is self.conn)
+        self.assertEquals(router.counters['lagging'], 1)
+        print "Stats:", router.stats()
+
+        self.replica.connection_pool.connection_kwargs['server'].link_up = True
+        time.sleep(1)
+        self.assertTrue(router.reader() is self.replica)
+        self.assertEquals(conn.get('key'), 'v2')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,2032 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+进程内的redis替身，用于在没有redis服务器的环境下快速运行测试和基准测试
+（1）StandinServer用纯Python实现了各章节用到的命令：字符串、散列、集合、有序集合、列表、过期时间、
+     事务流水线和WATCH、发布与订阅、流和消费者组；安装了lupa时还可以执行Lua脚本（EVAL/EVALSHA）
+（2）StandinConnection替换redis-py的Connection，命令仍然由redis-py打包成协议格式，
+     所以redis.Redis的回调、流水线、WATCH和PubSub都可以原样使用
+（3）replicaServer()创建复制进程内替身服务器的从服务器，每隔delay秒同步一次主服务器的数据，拒绝写命令
+（4）VirtualClock是虚拟时钟，替换模块中的time之后，time.sleep()不再真正等待：
+     当所有线程都在休眠或者等待消息时，时钟直接跳到最早的唤醒时间
+
+设置环境变量REDIS_STANDIN=1时，测试通过connect()使用替身和虚拟时钟，否则连接真正的redis服务器：
+    REDIS_STANDIN=1 python -m unittest shopping_website
+"""
+
+import os
+import copy
+import bisect
+import fnmatch
+import hashlib
+import itertools
+import threading
+import time as _time
+import unittest
+from collections import deque, OrderedDict
+
+import redis
+from redis.connection import Connection, ConnectionPool, BaseParser
+from redis.exceptions import ConnectionError
+
+# 环境变量，非空并且不为0时使用替身
+STANDIN_ENV = 'REDIS_STANDIN'
+# 数据库数量
+DATABASES = 16
+
+"""
+真实时钟
+"""
+class RealClock(object):
+    def __init__(self):
+        self.activity = 0
+        self._cond = threading.Condition()
+
+    def time(self):
+        return _time.time()
+
+    def sleep(self, seconds):
+        _time.sleep(seconds)
+
+    """
+    等待predicate()成立
+
+    @param {function}
+    @param {float}    超时时间，None表示一直等待
+
+    @return {boolean}
+    """
+    def block(self, predicate, timeout = None):
+        end = None if timeout is None else _time.time() + timeout
+        with self._cond:
+            while not predicate():
+                if end is not None:
+                    left = end - _time.time()
+                    if left <= 0:
+                        return False
+                    self._cond.wait(left)
+                else:
+                    self._cond.wait(.1)
+            return True
+
+    def notify(self):
+        with self._cond:
+            self._cond.notify_all()
+
+"""
+虚拟时钟
+时钟只在所有线程都阻塞在sleep()或者block()上时才前进，直接跳到最早的唤醒时间，
+因此测试中的time.sleep(5)不需要真的等待5秒，而后台线程仍然按照原来的先后顺序执行。
+有线程阻塞在其他地方（例如Thread.join()或者Event.wait()）时无法判断它是否还在工作，
+等待grace秒的真实时间之内没有任何redis命令执行，同样让时钟前进。
+和真实时钟一样，每次调用time()都会让时钟前进tick秒，连续取得的时间戳不会相同。
+
+@param {float} 开始时间，默认为当前时间
+@param {float} 判断其他线程空闲的真实等待时间
+@param {float} 每次调用time()前进的秒数
+"""
+class VirtualClock(object):
+    def __init__(self, start = None, grace = .02, tick = .000001):
+        self.now = _time.time() if start is None else start
+        self.grace = grace
+        self.tick = tick
+        self._tick_lock = threading.Lock()
+        # 每执行一个redis命令加1，用于判断其他线程是否空闲
+        self.activity = 0
+        self._cond = threading.Condition(threading.Lock())
+        # 所有等待中的线程的唤醒条件和唤醒时间
+        self._waiters = []
+
+    def time(self):
+        with self._tick_lock:
+            self.now += self.tick
+            return self.now
+
+    def asctime(self, t = None):
+        return _time.asctime(_time.localtime(self.now) if t is None else t)
+
+    def ctime(self, t = None):
+        return _time.ctime(self.now if t is None else t)
+
+    # 其他函数（localtime、strftime等）直接使用time模块
+    def __getattr__(self, name):
+        return getattr(_time, name)
+
+    def sleep(self, seconds):
+        with self._cond:
+            deadline = self.now + max(seconds, 0)
+            self._wait(lambda: self.now >= deadline, deadline)
+
+    def block(self, predicate, timeout = None):
+        with self._cond:
+            if timeout is None:
+                return self._wait(predicate, None)
+            deadline = self.now + timeout
+            self._wait(lambda: predicate() or self.now >= deadline, deadline)
+            return predicate()
+
+    def notify(self):
+        with self._cond:
+            self._cond.notify_all()
+
+    def _wait(self, done, deadline):
+        waiter = (done, deadline)
+        self._waiters.append(waiter)
+        try:
+            while not done():
+                # 已经被唤醒但还没有运行的线程会改变数据，先让它运行
+                ready = any(waiter_done() for waiter_done, _ in self._waiters)
+                if not ready and len(self._waiters) >= threading.active_count():
+                    if self._advance():
+                        continue
+                activity = self.activity
+                self._cond.wait(self.grace)
+                if not done() and self.activity == activity and \
+                        not any(waiter_done() for waiter_done, _ in self._waiters):
+                    self._advance()
+            return True
+        finally:
+            self._waiters.remove(waiter)
+
+    def _advance(self):
+        # 跳到最早的唤醒时间，并唤醒所有线程检查自己的条件
+        deadlines = [deadline for _, deadline in self._waiters if deadline is not None and deadline > self.now]
+        if not deadlines:
+            return False
+        self.now = min(deadlines)
+        self._cond.notify_all()
+        return True
+
+"""
+替身服务器返回的状态回复，例如OK、QUEUED
+"""
+class Status(str):
+    pass
+
+OK = Status('OK')
+QUEUED = Status('QUEUED')
+
+"""
+命令执行错误，转换为错误回复
+"""
+class CommandError(Exception):
+    pass
+
+WRONGTYPE = 'WRONGTYPE Operation against a key holding the wrong kind of value'
+NOT_INTEGER = 'ERR value is not an integer or out of range'
+NOT_FLOAT = 'ERR value is not a valid float'
+SYNTAX = 'ERR syntax error'
+READONLY = "READONLY You can't write against a read only replica."
+
+# 从服务器拒绝执行的写命令
+WRITE_COMMANDS = frozenset([
+    'del', 'rename', 'renamenx', 'expire', 'pexpire', 'expireat', 'persist', 'flushdb', 'flushall',
+    'set', 'setex', 'psetex', 'setnx', 'getset', 'mset', 'incrby', 'incr', 'decrby', 'decr', 'incrbyfloat',
+    'append', 'setbit', 'hset', 'hmset', 'hsetnx', 'hdel', 'hincrby', 'hincrbyfloat',
+    'lpush', 'rpush', 'lpop', 'rpop', 'ltrim', 'lrem', 'sadd', 'srem',
+    'zadd', 'zincrby', 'zrem', 'zremrangebyrank', 'zremrangebyscore', 'zinterstore', 'zunionstore',
+    'xadd', 'xtrim', 'xdel', 'xgroup', 'xreadgroup', 'xack',
+])
+
+def toInt(value):
+    try:
+        return int(value)
+    except ValueError:
+        raise CommandError(NOT_INTEGER)
+
+def toFloat(value):
+    try:
+        return float(value)
+    except ValueError:
+        raise CommandError(NOT_FLOAT)
+
+"""
+和redis一样格式化浮点数，整数不带小数点
+"""
+def formatFloat(value):
+    if value in (float('inf'), float('-inf')):
+        return 'inf' if value > 0 else '-inf'
+    text = repr(float(value))
+    return text[:-2] if text.endswith('.0') else text
+
+"""
+SCAN系列命令的一批结果，游标是names中的位置
+
+@param {array}  排好序的名称
+@param {string} 游标
+@param {array}  MATCH和COUNT选项
+
+@return {array} [下一个游标, 名称列表]
+"""
+def scanBatch(names, cursor, options):
+    pattern, count = None, 10
+    options = list(options)
+    while options:
+        option = options.pop(0).upper()
+        if option == 'MATCH' and options:
+            pattern = options.pop(0)
+        elif option == 'COUNT' and options:
+            count = toInt(options.pop(0))
+        else:
+            raise CommandError(SYNTAX)
+    start = toInt(cursor)
+    stop = start + max(1, count)
+    batch = [name for name in names[start:stop] if pattern is None or fnmatch.fnmatchcase(name, pattern)]
+    return ['%d' % (stop if stop < len(names) else 0), batch]
+
+"""
+将redis风格的起止索引（包含结束位置，可以为负数）转换为Python切片的起止位置
+"""
+def rangeIndex(start, stop, length):
+    start, stop = toInt(start), toInt(stop)
+    if start < 0:
+        start = max(length + start, 0)
+    if stop < 0:
+        stop += length
+    stop = min(stop, length - 1)
+    if start > stop:
+        return 0, 0
+    return start, stop + 1
+
+"""
+解析分值区间的边界，(表示不包含边界
+"""
+def scoreBound(value):
+    if value.startswith('('):
+        return toFloat(value[1:]), True
+    return toFloat(value), False
+
+def inScoreRange(score, low, high):
+    (min_score, min_open), (max_score, max_open) = low, high
+    if score < min_score or (min_open and score == min_score):
+        return False
+    if score > max_score or (max_open and score == max_score):
+        return False
+    return True
+
+"""
+解析字典序区间的边界，-和+表示最小和最大
+"""
+LEX_MIN, LEX_MAX = object(), object()
+
+def lexBound(value):
+    if value == '-':
+        return LEX_MIN, False
+    if value == '+':
+        return LEX_MAX, False
+    if value[:1] not in ('(', '['):
+        raise CommandError('ERR min or max not valid string range item')
+    return value[1:], value[0] == '('
+
+def inLexRange(member, low, high):
+    (min_value, min_open), (max_value, max_open) = low, high
+    if max_value is LEX_MIN or min_value is LEX_MAX:
+        return False
+    if min_value is not LEX_MIN and (member < min_value or (min_open and member == min_value)):
+        return False
+    if max_value is not LEX_MAX and (member > max_value or (max_open and member == max_value)):
+        return False
+    return True
+
+"""
+有序集合，成员到分值的字典，按照(分值, 成员)排好序的列表在第一次使用时生成
+"""
+class SortedSet(dict):
+    def __init__(self, *args):
+        dict.__init__(self, *args)
+        self._order = None
+
+    # 已经排好序时用二分查找更新，不需要重新排序
+    def __setitem__(self, member, score):
+        if self._order is not None:
+            if member in self:
+                self._remove(member)
+            bisect.insort(self._order, (score, member))
+        dict.__setitem__(self, member, score)
+
+    def __delitem__(self, member):
+        if self._order is not None and member in self:
+            self._remove(member)
+        dict.__delitem__(self, member)
+
+    def pop(self, member, *default):
+        if self._order is not None and member in self:
+            self._remove(member)
+        return dict.pop(self, member, *default)
+
+    def _remove(self, member):
+        del self._order[self.rank(member)]
+
+    def ordered(self):
+        if self._order is None:
+            self._order = sorted((score, member) for member, score in self.items())
+        return self._order
+
+    def rank(self, member):
+        return bisect.bisect_left(self.ordered(), (self[member], member))
+
+    """
+    分值在区间之内的(分值, 成员)列表，从较小的边界开始二分查找
+    """
+    def scoreRange(self, low, high):
+        order = self.ordered()
+        items = []
+        for i in xrange(bisect.bisect_left(order, (low[0],)), len(order)):
+            if order[i][0] > high[0]:
+                break
+            if inScoreRange(order[i][0], low, high):
+                items.append(order[i])
+        return items
+
+    """
+    成员在字典序区间之内的(分值, 成员)列表
+    和redis一样只在所有成员的分值相同时有意义，这时排好序的列表也按照成员排序，可以从较小的边界开始二分查找；
+    limit不为None时最多返回limit个
+    """
+    def lexRange(self, low, high, limit = None):
+        order = self.ordered()
+        if not order or low[0] is LEX_MAX or high[0] is LEX_MIN:
+            return []
+        score = order[0][0]
+        start = 0 if low[0] is LEX_MIN else bisect.bisect_left(order, (score, low[0]))
+        items = []
+        for i in xrange(start, len(order)):
+            if len(items) == limit or high[0] is not LEX_MAX and (
+                    order[i][1] > high[0] or (high[1] and order[i][1] == high[0])):
+                break
+            if inLexRange(order[i][1], low, high):
+                items.append(order[i])
+        return items
+
+"""
+解析流条目的ID，-和+表示最小和最大，只有毫秒部分时序号使用seq
+"""
+STREAM_MIN, STREAM_MAX = (0, 0), (2 ** 64 - 1, 2 ** 64 - 1)
+INVALID_STREAM_ID = 'ERR Invalid stream ID specified as stream command argument'
+
+def streamId(value, seq = 0):
+    if value == '-':
+        return STREAM_MIN
+    if value == '+':
+        return STREAM_MAX
+    ms, dash, rest = value.partition('-')
+    try:
+        return (int(ms), int(rest) if dash else seq)
+    except ValueError:
+        raise CommandError(INVALID_STREAM_ID)
+
+def formatStreamId(entry_id):
+    return '%d-%d' % entry_id
+
+"""
+流，按照ID顺序保存的条目，以及每个消费者组的读取位置和待确认的条目
+"""
+class Stream(object):
+    def __init__(self):
+        self.ids = []
+        self.entries = {}
+        self.last_id = STREAM_MIN
+        # 组名：{'last': 最后一个分发的ID, 'pending': ID => [消费者, 分发时间, 分发次数]}
+        self.groups = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    # 流在所有条目都被删除之后仍然存在
+    def __nonzero__(self):
+        return True
+
+    def add(self, entry_id, fields):
+        self.ids.append(entry_id)
+        self.entries[entry_id] = fields
+        self.last_id = entry_id
+
+    def trim(self, maxlen):
+        removed = max(0, len(self.ids) - maxlen)
+        for entry_id in self.ids[:removed]:
+            del self.entries[entry_id]
+        del self.ids[:removed]
+        return removed
+
+    def range(self, low, high, count = None, reverse = False):
+        start = bisect.bisect_left(self.ids, low)
+        stop = bisect.bisect_right(self.ids, high)
+        ids = self.ids[start:stop]
+        if reverse:
+            ids.reverse()
+        if count is not None:
+            ids = ids[:count]
+        return [(entry_id, self.entries[entry_id]) for entry_id in ids]
+
+    def after(self, entry_id, count = None):
+        start = bisect.bisect_right(self.ids, entry_id)
+        ids = self.ids[start:] if count is None else self.ids[start:start + count]
+        return [(entry_id, self.entries[entry_id]) for entry_id in ids]
+
+def streamReply(entries):
+    return [[formatStreamId(entry_id), list(fields) if fields is not None else None] for entry_id, fields in entries]
+
+"""
+XREAD和XREADGROUP在BLOCK时没有新条目，连接在服务器的锁之外等待新的条目，再重新执行args
+
+@param {array} 重新执行的命令，$已经替换为当时最后的ID
+@param {float} 最长等待时间(秒)，0表示一直等待
+@param {int}   当时的流版本号
+"""
+class Blocked(object):
+    def __init__(self, args, timeout, version):
+        self.args = args
+        self.timeout = timeout
+        self.version = version
+
+"""
+一个数据库，保存键值、过期时间和每个键的版本号（用于WATCH）
+"""
+class Database(object):
+    def __init__(self, server):
+        self.server = server
+        self.data = {}
+        self.expires = {}
+        self.versions = {}
+
+    def expired(self, key):
+        deadline = self.expires.get(key)
+        if deadline is not None and deadline <= self.server.clock.time():
+            self.delete(key)
+            return True
+        return False
+
+    def exists(self, key):
+        return not self.expired(key) and key in self.data
+
+    """
+    取出指定类型的值，键不存在时返回None，类型不对时抛出WRONGTYPE错误
+    """
+    def get(self, key, kind):
+        if self.expired(key) or key not in self.data:
+            return None
+        value_kind, value = self.data[key]
+        if value_kind != kind:
+            raise CommandError(WRONGTYPE)
+        return value
+
+    """
+    取出指定类型的值，键不存在时使用factory创建
+    """
+    def obtain(self, key, kind, factory):
+        value = self.get(key, kind)
+        if value is None:
+            value = factory()
+            self.data[key] = (kind, value)
+        return value
+
+    def kind(self, key):
+        if self.expired(key) or key not in self.data:
+            return 'none'
+        return self.data[key][0]
+
+    def set(self, key, kind, value, keep_ttl = False):
+        self.data[key] = (kind, value)
+        if not keep_ttl:
+            self.expires.pop(key, None)
+        self.touch(key)
+
+    def delete(self, key):
+        if key in self.data:
+            del self.data[key]
+            self.expires.pop(key, None)
+            self.touch(key)
+            return True
+        return False
+
+    def touch(self, key):
+        self.versions[key] = self.versions.get(key, 0) + 1
+        # 每次修改都推进复制偏移量，从服务器据此判断是否已经同步
+        self.server.repl_offset += 1
+
+    # 修改之后集合类型的值变为空时删除这个键
+    def cleanup(self, key):
+        if key in self.data and not self.data[key][1]:
+            self.delete(key)
+
+    def version(self, key):
+        self.expired(key)
+        return self.versions.get(key, 0)
+
+    def keys(self):
+        return [key for key in list(self.data) if not self.expired(key)]
+
+"""
+每个连接的客户端状态：当前数据库、事务队列、WATCH的键和订阅的频道
+"""
+class Client(object):
+    def __init__(self, server):
+        self.server = server
+        self.db = 0
+        self.multi = None
+        self.watched = {}
+        self.channels = set()
+        # 发送给客户端的回复
+        self.replies = deque()
+
+    @property
+    def database(self):
+        return self.server.dbs[self.db]
+
+"""
+替身服务器
+命令在一个锁中依次执行，所以单个命令、事务和Lua脚本都是原子的。
+每个命令对应一个cmd_<命令名>方法，返回值转换为redis的回复：
+int为整数回复，str为批量回复，Status为状态回复，None为空回复，list为多条批量回复。
+
+@param {object} 时钟，默认使用真实时钟
+"""
+class StandinServer(object):
+    def __init__(self, clock = None):
+        self.clock = clock or RealClock()
+        self.dbs = [Database(self) for i in xrange(DATABASES)]
+        self.lock = threading.RLock()
+        self.subscribers = {}
+        self.scripts = {}
+        # 每次添加流条目时加1，阻塞读取的连接据此判断是否需要重新读取
+        self.stream_version = 0
+        # 每个命令的执行次数，通过INFO commandstats取得
+        self.command_calls = {}
+        self._lua = None
+        # 复制：主服务器的修改次数，从服务器复制的主服务器、同步间隔、连接状态、上次同步的时间和偏移量
+        self.repl_offset = 0
+        self.replicas = []
+        self.master = None
+        self.repl_delay = 0
+        self.link_up = True
+        self.last_sync = None
+        self.synced_offset = 0
+
+    """
+    作为从服务器复制master，每隔delay秒同步一次，所以从服务器上的数据最多落后delay秒
+
+    @param {object} 主服务器
+    @param {float}  同步间隔(秒)
+    """
+    def replicate(self, master, delay = 0):
+        with self.lock:
+            self.master = master
+            self.repl_delay = delay
+            self.link_up = True
+            master.replicas.append(self)
+            self.sync()
+
+    # 复制主服务器的所有数据，需要持有self.lock
+    def sync(self):
+        master = self.master
+        with master.lock:
+            if self.last_sync is None or master.repl_offset != self.synced_offset:
+                for db, source in zip(self.dbs, master.dbs):
+                    db.data = copy.deepcopy(source.data)
+                    db.expires = dict(source.expires)
+                    db.versions = dict(source.versions)
+                self.synced_offset = master.repl_offset
+        self.last_sync = self.clock.time()
+
+    # 执行命令之前检查是否到了同步时间，连接断开时不再同步
+    def syncIfDue(self):
+        if self.master is not None and self.link_up and self.clock.time() - self.last_sync >= self.repl_delay:
+            self.sync()
+
+    """
+    执行一条命令，返回回复或者错误
+    """
+    def execute(self, client, args):
+        with self.lock:
+            self.clock.activity += 1
+            self.syncIfDue()
+            name = args[0].lower()
+            if client.multi is not None and name not in ('exec', 'discard', 'multi', 'watch'):
+                if not hasattr(self, 'cmd_' + name):
+                    client.multi = None
+                    return CommandError("ERR unknown command '%s'" % args[0])
+                client.multi.append(args)
+                return QUEUED
+            return self.dispatch(client, args, True)
+
+    """
+    执行一条命令，只有直接发送的命令可以阻塞，事务和脚本中的阻塞命令立即返回空回复
+    """
+    def dispatch(self, client, args, blocking = False):
+        name = args[0].lower()
+        handler = getattr(self, 'cmd_' + name, None)
+        if handler is None:
+            return CommandError("ERR unknown command '%s'" % args[0])
+        # 事务和Lua脚本中的写命令同样被拒绝
+        if self.master is not None and name in WRITE_COMMANDS:
+            return CommandError(READONLY)
+        self.command_calls[name] = self.command_calls.get(name, 0) + 1
+        try:
+            reply = handler(client, *args[1:])
+            if isinstance(reply, Blocked) and not blocking:
+                return None
+            return reply
+        except CommandError as error:
+            return error
+        except TypeError:
+            return CommandError("ERR wrong number of arguments for '%s' command" % args[0].lower())
+
+    # 连接和服务器
+    def cmd_ping(self, client, message = None):
+        return Status('PONG') if message is None else message
+
+    def cmd_echo(self, client, message):
+        return message
+
+    def cmd_select(self, client, db):
+        db = toInt(db)
+        if not 0 <= db < DATABASES:
+            raise CommandError('ERR DB index is out of range')
+        client.db = db
+        return OK
+
+    def cmd_dbsize(self, client):
+        return len(client.database.keys())
+
+    def cmd_flushdb(self, client):
+        for key in list(client.database.data):
+            client.database.delete(key)
+        return OK
+
+    def cmd_flushall(self, client):
+        for db in self.dbs:
+            for key in list(db.data):
+                db.delete(key)
+        return OK
+
+    def cmd_info(self, client, section = None):
+        section = (section or 'all').lower()
+        lines = []
+        if section in ('all', 'server'):
+            lines.extend(['# Server', 'redis_version:standin', 'redis_mode:standalone'])
+        if section in ('all', 'replication'):
+            lines.extend(self.replicationInfo())
+        if section in ('all', 'commandstats'):
+            lines.append('# Commandstats')
+            for name, calls in sorted(self.command_calls.items()):
+                lines.append('cmdstat_%s:calls=%s,usec=0,usec_per_call=0.00' % (name, calls))
+        return '\r\n'.join(lines) + '\r\n'
+
+    # 只支持SLAVEOF NO ONE，停止复制之后成为主服务器；从服务器由replicaServer()创建
+    def cmd_slaveof(self, client, host, port):
+        if (host.upper(), port.upper()) != ('NO', 'ONE'):
+            raise CommandError('ERR standin replicas are created with replicaServer()')
+        if self.master is not None:
+            self.master.replicas.remove(self)
+            self.master = None
+        return OK
+
+    def replicationInfo(self):
+        lines = ['# Replication']
+        if self.master is None:
+            lines.extend(['role:master', 'connected_slaves:%d' % len(self.replicas)])
+            for i, replica in enumerate(self.replicas):
+                lines.append('slave%d:ip=standin,port=0,state=%s,offset=%d,lag=%d' % (
+                    i, 'online' if replica.link_up else 'wait_bgsave', replica.synced_offset,
+                    self.clock.time() - replica.last_sync))
+            lines.append('master_repl_offset:%d' % self.repl_offset)
+        else:
+            lines.extend([
+                'role:slave',
+                'master_host:standin',
+                'master_link_status:%s' % ('up' if self.link_up else 'down'),
+                'master_last_io_seconds_ago:%d' % (self.clock.time() - self.last_sync),
+                'slave_repl_offset:%d' % self.synced_offset,
+                'master_repl_offset:%d' % self.synced_offset,
+            ])
+        return lines
+
+    def cmd_time(self, client):
+        now = self.clock.time()
+        return [str(int(now)), str(int(now % 1 * 1000000))]
+
+    # 键
+    def cmd_del(self, client, *keys):
+        return sum(1 for key in keys if client.database.exists(key) and client.database.delete(key))
+
+    def cmd_exists(self, client, *keys):
+        return sum(1 for key in keys if client.database.exists(key))
+
+    def cmd_type(self, client, key):
+        return Status(client.database.kind(key))
+
+    def cmd_keys(self, client, pattern):
+        return [key for key in client.database.keys() if fnmatch.fnmatchcase(key, pattern)]
+
+    # 游标是按照名称排序之后的位置，遍历期间一直存在的键都会被返回
+    def cmd_scan(self, client, cursor, *options):
+        keys = sorted(client.database.keys())
+        return scanBatch(keys, cursor, options)
+
+    def cmd_rename(self, client, key, new_key):
+        db = client.database
+        if not db.exists(key):
+            raise CommandError('ERR no such key')
+        kind, value = db.data[key]
+        deadline = db.expires.get(key)
+        db.delete(key)
+        db.delete(new_key)
+        db.set(new_key, kind, value)
+        if deadline is not None:
+            db.expires[new_key] = deadline
+        return OK
+
+    def cmd_renamenx(self, client, key, new_key):
+        if client.database.exists(new_key):
+            if not client.database.exists(key):
+                raise CommandError('ERR no such key')
+            return 0
+        self.cmd_rename(client, key, new_key)
+        return 1
+
+    def cmd_expire(self, client, key, seconds):
+        return self.cmd_pexpire(client, key, toInt(seconds) * 1000)
+
+    def cmd_pexpire(self, client, key, milliseconds):
+        db = client.database
+        if not db.exists(key):
+            return 0
+        db.expires[key] = self.clock.time() + toInt(milliseconds) / 1000.0
+        db.touch(key)
+        return 1
+
+    def cmd_expireat(self, client, key, timestamp):
+        return self.cmd_pexpire(client, key, int((toInt(timestamp) - self.clock.time()) * 1000))
+
+    def cmd_persist(self, client, key):
+        db = client.database
+        if db.exists(key) and db.expires.pop(key, None) is not None:
+            return 1
+        return 0
+
+    def cmd_pttl(self, client, key):
+        db = client.database
+        if not db.exists(key):
+            return -2
+        if key not in db.expires:
+            return -1
+        return int(round((db.expires[key] - self.clock.time()) * 1000))
+
+    def cmd_ttl(self, client, key):
+        ttl = self.cmd_pttl(client, key)
+        return ttl if ttl < 0 else int(round(ttl / 1000.0))
+
+    # 字符串
+    def cmd_get(self, client, key):
+        return client.database.get(key, 'string')
+
+    def cmd_set(self, client, key, value, *options):
+        db = client.database
+        ttl = None
+        nx = xx = False
+        options = list(options)
+        while options:
+            option = options.pop(0).upper()
+            if option in ('EX', 'PX') and options:
+                ttl = toInt(options.pop(0)) / (1.0 if option == 'EX' else 1000.0)
+                if ttl <= 0:
+                    raise CommandError('ERR invalid expire time in set')
+            elif option == 'NX':
+                nx = True
+            elif option == 'XX':
+                xx = True
+            else:
+                raise CommandError(SYNTAX)
+        if (nx and db.exists(key)) or (xx and not db.exists(key)):
+            return None
+        db.set(key, 'string', value)
+        if ttl is not None:
+            db.expires[key] = self.clock.time() + ttl
+        return OK
+
+    def cmd_setex(self, client, key, seconds, value):
+        return self.cmd_set(client, key, value, 'EX', seconds)
+
+    def cmd_psetex(self, client, key, milliseconds, value):
+        return self.cmd_set(client, key, value, 'PX', milliseconds)
+
+    def cmd_setnx(self, client, key, value):
+        return 1 if self.cmd_set(client, key, value, 'NX') else 0
+
+    def cmd_getset(self, client, key, value):
+        old = client.database.get(key, 'string')
+        client.database.set(key, 'string', value)
+        return old
+
+    def cmd_mget(self, client, *keys):
+        result = []
+        for key in keys:
+            value = None
+            if client.database.kind(key) == 'string':
+                value = client.database.get(key, 'string')
+            result.append(value)
+        return result
+
+    def cmd_mset(self, client, *pairs):
+        if not pairs or len(pairs) % 2:
+            raise TypeError
+        for i in xrange(0, len(pairs), 2):
+            client.database.set(pairs[i], 'string', pairs[i + 1])
+        return OK
+
+    def cmd_incrby(self, client, key, amount):
+        db = client.database
+        value = toInt(db.get(key, 'string') or 0) + toInt(amount)
+        db.set(key, 'string', str(value), keep_ttl = True)
+        return value
+
+    def cmd_incr(self, client, key):
+        return self.cmd_incrby(client, key, '1')
+
+    def cmd_decrby(self, client, key, amount):
+        return self.cmd_incrby(client, key, str(-toInt(amount)))
+
+    def cmd_decr(self, client, key):
+        return self.cmd_incrby(client, key, '-1')
+
+    def cmd_incrbyfloat(self, client, key, amount):
+        db = client.database
+        value = formatFloat(toFloat(db.get(key, 'string') or 0) + toFloat(amount))
+        db.set(key, 'string', value, keep_ttl = True)
+        return value
+
+    def cmd_append(self, client, key, value):
+        db = client.database
+        value = (db.get(key, 'string') or '') + value
+        db.set(key, 'string', value, keep_ttl = True)
+        return len(value)
+
+    def cmd_strlen(self, client, key):
+        return len(client.database.get(key, 'string') or '')
+
+    def cmd_setbit(self, client, key, offset, bit):
+        db = client.database
+        offset, bit = toInt(offset), toInt(bit)
+        value = bytearray(db.get(key, 'string') or '')
+        if offset >= len(value) * 8:
+            value.extend('\0' * (offset // 8 + 1 - len(value)))
+        mask = 0x80 >> (offset % 8)
+        old = 1 if value[offset // 8] & mask else 0
+        if bit:
+            value[offset // 8] |= mask
+        else:
+            value[offset // 8] &= ~mask
+        db.set(key, 'string', str(value), keep_ttl = True)
+        return old
+
+    def cmd_getbit(self, client, key, offset):
+        offset = toInt(offset)
+        value = bytearray(client.database.get(key, 'string') or '')
+        if offset >= len(value) * 8:
+            return 0
+        return 1 if value[offset // 8] & (0x80 >> (offset % 8)) else 0
+
+    def cmd_bitcount(self, client, key):
+        value = bytearray(client.database.get(key, 'string') or '')
+        return sum(bin(byte).count('1') for byte in value)
+
+    # 散列
+    def cmd_hset(self, client, key, *pairs):
+        if not pairs or len(pairs) % 2:
+            raise TypeError
+        db = client.database
+        hash = db.obtain(key, 'hash', dict)
+        added = 0
+        for i in xrange(0, len(pairs), 2):
+            added += pairs[i] not in hash
+            hash[pairs[i]] = pairs[i + 1]
+        db.touch(key)
+        return added
+
+    def cmd_hmset(self, client, key, *pairs):
+        self.cmd_hset(client, key, *pairs)
+        return OK
+
+    def cmd_hsetnx(self, client, key, field, value):
+        hash = client.database.get(key, 'hash')
+        if hash is not None and field in hash:
+            return 0
+        return self.cmd_hset(client, key, field, value)
+
+    def cmd_hget(self, client, key, field):
+        return (client.database.get(key, 'hash') or {}).get(field)
+
+    def cmd_hmget(self, client, key, *fields):
+        hash = client.database.get(key, 'hash') or {}
+        return [hash.get(field) for field in fields]
+
+    def cmd_hgetall(self, client, key):
+        result = []
+        for field, value in (client.database.get(key, 'hash') or {}).items():
+            result.extend((field, value))
+        return result
+
+    def cmd_hkeys(self, client, key):
+        return list(client.database.get(key, 'hash') or {})
+
+    def cmd_hvals(self, client, key):
+        return list((client.database.get(key, 'hash') or {}).values())
+
+    def cmd_hlen(self, client, key):
+        return len(client.database.get(key, 'hash') or {})
+
+    def cmd_hexists(self, client, key, field):
+        return int(field in (client.database.get(key, 'hash') or {}))
+
+    def cmd_hdel(self, client, key, *fields):
+        db = client.database
+        hash = db.get(key, 'hash') or {}
+        removed = sum(1 for field in fields if hash.pop(field, None) is not None)
+        if removed:
+            db.touch(key)
+            db.cleanup(key)
+        return removed
+
+    def cmd_hincrby(self, client, key, field, amount):
+        db = client.database
+        hash = db.obtain(key, 'hash', dict)
+        value = toInt(hash.get(field, 0)) + toInt(amount)
+        hash[field] = str(value)
+        db.touch(key)
+        return value
+
+    def cmd_hincrbyfloat(self, client, key, field, amount):
+        db = client.database
+        hash = db.obtain(key, 'hash', dict)
+        value = formatFloat(toFloat(hash.get(field, 0)) + toFloat(amount))
+        hash[field] = value
+        db.touch(key)
+        return value
+
+    # 列表
+    def cmd_lpush(self, client, key, *values):
+        if not values:
+            raise TypeError
+        db = client.database
+        items = db.obtain(key, 'list', list)
+        items[0:0] = reversed(values)
+        db.touch(key)
+        return len(items)
+
+    def cmd_rpush(self, client, key, *values):
+        if not values:
+            raise TypeError
+        db = client.database
+        items = db.obtain(key, 'list', list)
+        items.extend(values)
+        db.touch(key)
+        return len(items)
+
+    def cmd_lpop(self, client, key):
+        return self._pop(client, key, 0)
+
+    def cmd_rpop(self, client, key):
+        return self._pop(client, key, -1)
+
+    def _pop(self, client, key, index):
+        db = client.database
+        items = db.get(key, 'list')
+        if not items:
+            return None
+        value = items.pop(index)
+        db.touch(key)
+        db.cleanup(key)
+        return value
+
+    def cmd_llen(self, client, key):
+        return len(client.database.get(key, 'list') or [])
+
+    def cmd_lindex(self, client, key, index):
+        items = client.database.get(key, 'list') or []
+        index = toInt(index)
+        if -len(items) <= index < len(items):
+            return items[index]
+        return None
+
+    def cmd_lrange(self, client, key, start, stop):
+        items = client.database.get(key, 'list') or []
+        start, stop = rangeIndex(start, stop, len(items))
+        return items[start:stop]
+
+    def cmd_ltrim(self, client, key, start, stop):
+        db = client.database
+        items = db.get(key, 'list')
+        if items is not None:
+            start, stop = rangeIndex(start, stop, len(items))
+            items[:] = items[start:stop]
+            db.touch(key)
+            db.cleanup(key)
+        return OK
+
+    def cmd_lrem(self, client, key, count, value):
+        db = client.database
+        items = db.get(key, 'list') or []
+        count = toInt(count)
+        indexes = [i for i, item in enumerate(items) if item == value]
+        if count < 0:
+            indexes = indexes[::-1][:-count]
+        elif count > 0:
+            indexes = indexes[:count]
+        for i in sorted(indexes, reverse = True):
+            del items[i]
+        if indexes:
+            db.touch(key)
+            db.cleanup(key)
+        return len(indexes)
+
+    # 集合
+    def cmd_sadd(self, client, key, *members):
+        if not members:
+            raise TypeError
+        db = client.database
+        members_set = db.obtain(key, 'set', set)
+        added = len(set(members) - members_set)
+        members_set.update(members)
+        db.touch(key)
+        return added
+
+    def cmd_srem(self, client, key, *members):
+        db = client.database
+        members_set = db.get(key, 'set') or set()
+        removed = len(members_set & set(members))
+        members_set.difference_update(members)
+        if removed:
+            db.touch(key)
+            db.cleanup(key)
+        return removed
+
+    def cmd_sismember(self, client, key, member):
+        return int(member in (client.database.get(key, 'set') or ()))
+
+    def cmd_smembers(self, client, key):
+        return list(client.database.get(key, 'set') or ())
+
+    def cmd_scard(self, client, key):
+        return len(client.database.get(key, 'set') or ())
+
+    # 有序集合
+    def _zset(self, client, key):
+        return client.database.get(key, 'zset') or SortedSet()
+
+    def _withScores(self, items, withscores):
+        result = []
+        for score, member in items:
+            result.append(member)
+            if withscores:
+                result.append(formatFloat(score))
+        return result
+
+    def cmd_zadd(self, client, key, *args):
+        args = list(args)
+        nx = xx = ch = incr = False
+        while args and args[0].upper() in ('NX', 'XX', 'CH', 'INCR'):
+            option = args.pop(0).upper()
+            nx, xx = nx or option == 'NX', xx or option == 'XX'
+            ch, incr = ch or option == 'CH', incr or option == 'INCR'
+        if not args or len(args) % 2:
+            raise TypeError
+        pairs = [(toFloat(args[i]), args[i + 1]) for i in xrange(0, len(args), 2)]
+
+        db = client.database
+        zset = db.obtain(key, 'zset', SortedSet)
+        changed = 0
+        for score, member in pairs:
+            exists = member in zset
+            if (nx and exists) or (xx and not exists):
+                continue
+            if incr:
+                score += zset.get(member, 0)
+            changed += not exists or (ch and zset[member] != score)
+            zset[member] = score
+        db.touch(key)
+        db.cleanup(key)
+        if incr:
+            return formatFloat(zset[pairs[0][1]]) if pairs[0][1] in zset else None
+        return changed
+
+    def cmd_zincrby(self, client, key, amount, member):
+        db = client.database
+        zset = db.obtain(key, 'zset', SortedSet)
+        zset[member] = zset.get(member, 0) + toFloat(amount)
+        db.touch(key)
+        return formatFloat(zset[member])
+
+    def cmd_zscore(self, client, key, member):
+        score = self._zset(client, key).get(member)
+        return None if score is None else formatFloat(score)
+
+    def cmd_zscan(self, client, key, cursor, *options):
+        zset = self._zset(client, key)
+        cursor, members = scanBatch(sorted(zset), cursor, options)
+        reply = []
+        for member in members:
+            reply.extend([member, formatFloat(zset[member])])
+        return [cursor, reply]
+
+    def cmd_zcard(self, client, key):
+        return len(self._zset(client, key))
+
+    def cmd_zcount(self, client, key, low, high):
+        low, high = scoreBound(low), scoreBound(high)
+        return sum(1 for score in self._zset(client, key).values() if inScoreRange(score, low, high))
+
+    def cmd_zrank(self, client, key, member, reverse = False):
+        zset = self._zset(client, key)
+        if member not in zset:
+            return None
+        rank = zset.rank(member)
+        return len(zset) - 1 - rank if reverse else rank
+
+    def cmd_zrevrank(self, client, key, member):
+        return self.cmd_zrank(client, key, member, True)
+
+    def cmd_zrange(self, client, key, start, stop, *options, **kwargs):
+        order = self._zset(client, key).ordered()
+        start, stop = rangeIndex(start, stop, len(order))
+        if kwargs.get('reverse', False):
+            items = order[len(order) - stop:len(order) - start][::-1]
+        else:
+            items = order[start:stop]
+        return self._withScores(items, [o.upper() for o in options] == ['WITHSCORES'])
+
+    def cmd_zrevrange(self, client, key, start, stop, *options):
+        return self.cmd_zrange(client, key, start, stop, *options, reverse = True)
+
+    def _rangeOptions(self, options):
+        withscores = False
+        offset, count = 0, -1
+        options = [option for option in options]
+        while options:
+            option = options.pop(0).upper()
+            if option == 'WITHSCORES':
+                withscores = True
+            elif option == 'LIMIT' and len(options) >= 2:
+                offset, count = toInt(options.pop(0)), toInt(options.pop(0))
+            else:
+                raise CommandError(SYNTAX)
+        return withscores, offset, count
+
+    def _limit(self, items, offset, count):
+        if offset < 0:
+            return []
+        return items[offset:] if count < 0 else items[offset:offset + count]
+
+    def cmd_zrangebyscore(self, client, key, low, high, *options, **kwargs):
+        reverse = kwargs.get('reverse', False)
+        low, high = scoreBound(low), scoreBound(high)
+        withscores, offset, count = self._rangeOptions(options)
+        items = self._zset(client, key).scoreRange(low, high)
+        if reverse:
+            items.reverse()
+        return self._withScores(self._limit(items, offset, count), withscores)
+
+    def cmd_zrevrangebyscore(self, client, key, high, low, *options):
+        return self.cmd_zrangebyscore(client, key, low, high, *options, reverse = True)
+
+    def cmd_zrangebylex(self, client, key, low, high, *options, **kwargs):
+        reverse = kwargs.get('reverse', False)
+        low, high = lexBound(low), lexBound(high)
+        withscores, offset, count = self._rangeOptions(options)
+        if withscores:
+            raise CommandError(SYNTAX)
+        # 正向查询只需要取出LIMIT需要的成员
+        limit = offset + count if not reverse and offset >= 0 and count >= 0 else None
+        items = self._zset(client, key).lexRange(low, high, limit)
+        if reverse:
+            items.reverse()
+        return self._withScores(self._limit(items, offset, count), False)
+
+    def cmd_zrevrangebylex(self, client, key, high, low, *options):
+        return self.cmd_zrangebylex(client, key, low, high, *options, reverse = True)
+
+    def cmd_zlexcount(self, client, key, low, high):
+        low, high = lexBound(low), lexBound(high)
+        return len(self._zset(client, key).lexRange(low, high))
+
+    def cmd_zrem(self, client, key, *members):
+        db = client.database
+        zset = db.get(key, 'zset') or {}
+        removed = sum(1 for member in members if zset.pop(member, None) is not None)
+        if removed:
+            db.touch(key)
+            db.cleanup(key)
+        return removed
+
+    def cmd_zremrangebyrank(self, client, key, start, stop):
+        zset = self._zset(client, key)
+        items = zset.ordered()
+        start, stop = rangeIndex(start, stop, len(items))
+        return self.cmd_zrem(client, key, *[member for score, member in items[start:stop]]) if stop > start else 0
+
+    def cmd_zremrangebyscore(self, client, key, low, high):
+        low, high = scoreBound(low), scoreBound(high)
+        members = [member for member, score in self._zset(client, key).items() if inScoreRange(score, low, high)]
+        return self.cmd_zrem(client, key, *members) if members else 0
+
+    def _zstore(self, client, dest, numkeys, args, union):
+        numkeys = toInt(numkeys)
+        keys, args = list(args[:numkeys]), [arg.upper() for arg in args[numkeys:]]
+        weights = [1.0] * numkeys
+        aggregate = 'SUM'
+        while args:
+            option = args.pop(0)
+            if option == 'WEIGHTS':
+                weights, args = [toFloat(weight) for weight in args[:numkeys]], args[numkeys:]
+            elif option == 'AGGREGATE' and args:
+                aggregate = args.pop(0)
+            else:
+                raise CommandError(SYNTAX)
+        combine = {'SUM': lambda a, b: a + b, 'MIN': min, 'MAX': max}[aggregate]
+
+        db = client.database
+        sources = []
+        for key in keys:
+            kind = db.kind(key)
+            if kind == 'set':
+                sources.append(dict((member, 1.0) for member in db.get(key, 'set')))
+            elif kind in ('zset', 'none'):
+                sources.append(dict(db.get(key, 'zset') or {}))
+            else:
+                raise CommandError(WRONGTYPE)
+
+        result = {}
+        if union:
+            for source, weight in zip(sources, weights):
+                for member, score in source.items():
+                    score *= weight
+                    result[member] = combine(result[member], score) if member in result else score
+        elif sources:
+            for member in set(sources[0]).intersection(*sources[1:]):
+                scores = [source[member] * weight for source, weight in zip(sources, weights)]
+                result[member] = reduce(combine, scores)
+
+        db.delete(dest)
+        if result:
+            db.set(dest, 'zset', SortedSet(result))
+        return len(result)
+
+    def cmd_zinterstore(self, client, dest, numkeys, *args):
+        return self._zstore(client, dest, numkeys, args, False)
+
+    def cmd_zunionstore(self, client, dest, numkeys, *args):
+        return self._zstore(client, dest, numkeys, args, True)
+
+    # 流
+    def cmd_xadd(self, client, key, *args):
+        args = list(args)
+        maxlen = None
+        if args and args[0].upper() == 'MAXLEN':
+            args.pop(0)
+            # 近似裁剪和精确裁剪一样处理，保留的条目数不少于maxlen
+            if args and args[0] in ('~', '='):
+                args.pop(0)
+            if not args:
+                raise CommandError(SYNTAX)
+            maxlen = toInt(args.pop(0))
+        if len(args) < 3 or len(args) % 2 == 0:
+            raise CommandError("ERR wrong number of arguments for 'xadd' command")
+
+        db = client.database
+        stream = db.obtain(key, 'stream', Stream)
+        if args[0] == '*':
+            ms = int(self.clock.time() * 1000)
+            last = stream.last_id
+            entry_id = (ms, 0) if ms > last[0] else (last[0], last[1] + 1)
+        else:
+            entry_id = streamId(args[0])
+            if entry_id <= stream.last_id:
+                raise CommandError('ERR The ID specified in XADD is equal or smaller than the target stream top item')
+        stream.add(entry_id, tuple(args[1:]))
+        if maxlen is not None:
+            stream.trim(maxlen)
+        db.touch(key)
+        self.stream_version += 1
+        self.clock.notify()
+        return formatStreamId(entry_id)
+
+    def cmd_xlen(self, client, key):
+        stream = client.database.get(key, 'stream')
+        return len(stream) if stream is not None else 0
+
+    def _xrange(self, client, key, low, high, options, reverse):
+        count = None
+        if options:
+            if len(options) != 2 or options[0].upper() != 'COUNT':
+                raise CommandError(SYNTAX)
+            count = toInt(options[1])
+        stream = client.database.get(key, 'stream')
+        if stream is None:
+            return []
+        return streamReply(stream.range(streamId(low), streamId(high, 2 ** 64 - 1), count, reverse))
+
+    def cmd_xrange(self, client, key, start, end, *options):
+        return self._xrange(client, key, start, end, options, False)
+
+    def cmd_xrevrange(self, client, key, end, start, *options):
+        return self._xrange(client, key, start, end, options, True)
+
+    def cmd_xtrim(self, client, key, strategy, *args):
+        if strategy.upper() != 'MAXLEN' or not args:
+            raise CommandError(SYNTAX)
+        stream = client.database.get(key, 'stream')
+        if stream is None:
+            return 0
+        removed = stream.trim(toInt(args[-1]))
+        client.database.touch(key)
+        return removed
+
+    def cmd_xdel(self, client, key, *ids):
+        stream = client.database.get(key, 'stream')
+        if stream is None:
+            return 0
+        removed = 0
+        for entry_id in map(streamId, ids):
+            if entry_id in stream.entries:
+                del stream.entries[entry_id]
+                stream.ids.remove(entry_id)
+                removed += 1
+        client.database.touch(key)
+        return removed
+
+    def cmd_xgroup(self, client, subcommand, key, group, *args):
+        subcommand = subcommand.upper()
+        db = client.database
+        if subcommand == 'CREATE':
+            if not args:
+                raise CommandError(SYNTAX)
+            stream = db.get(key, 'stream')
+            if stream is None:
+                if 'MKSTREAM' not in [arg.upper() for arg in args[1:]]:
+                    raise CommandError('ERR The XGROUP subcommand requires the key to exist. '
+                        'Note that for CREATE you may want to use the MKSTREAM option to create an empty stream automatically.')
+                stream = db.obtain(key, 'stream', Stream)
+            if group in stream.groups:
+                raise CommandError('BUSYGROUP Consumer Group name already exists')
+            last = stream.last_id if args[0] == '$' else streamId(args[0])
+            stream.groups[group] = {'last': last, 'pending': OrderedDict()}
+            return OK
+        if subcommand == 'DESTROY':
+            stream = db.get(key, 'stream')
+            return int(stream is not None and stream.groups.pop(group, None) is not None)
+        raise CommandError(SYNTAX)
+
+    """
+    解析XREAD和XREADGROUP的COUNT、BLOCK、NOACK和STREAMS选项
+
+    @return {tuple} (count, block, noack, keys, ids)
+    """
+    def _readOptions(self, args):
+        count = block = None
+        noack = False
+        i = 0
+        while i < len(args):
+            option = args[i].upper()
+            if option == 'COUNT':
+                count = toInt(args[i + 1])
+                i += 2
+            elif option == 'BLOCK':
+                block = toInt(args[i + 1])
+                i += 2
+            elif option == 'NOACK':
+                noack = True
+                i += 1
+            elif option == 'STREAMS':
+                streams = args[i + 1:]
+                if not streams or len(streams) % 2:
+                    raise CommandError("ERR Unbalanced XREAD list of streams: for each stream key an ID or '$' must be specified.")
+                half = len(streams) // 2
+                return count, block, noack, list(streams[:half]), list(streams[half:])
+            else:
+                raise CommandError(SYNTAX)
+        raise CommandError(SYNTAX)
+
+    def cmd_xread(self, client, *args):
+        count, block, noack, keys, ids = self._readOptions(args)
+        db = client.database
+        result = []
+        for index, key in enumerate(keys):
+            stream = db.get(key, 'stream')
+            if ids[index] == '$':
+                ids[index] = formatStreamId(stream.last_id if stream is not None else STREAM_MIN)
+            entries = stream.after(streamId(ids[index]), count) if stream is not None else []
+            if entries:
+                result.append([key, streamReply(entries)])
+        if not result and block is not None:
+            streams = [arg.upper() for arg in args].index('STREAMS')
+            return Blocked(['XREAD'] + list(args[:streams + 1]) + keys + ids, block / 1000.0, self.stream_version)
+        return result or None
+
+    def cmd_xreadgroup(self, client, group_option, group, consumer, *args):
+        if group_option.upper() != 'GROUP':
+            raise CommandError(SYNTAX)
+        count, block, noack, keys, ids = self._readOptions(args)
+        db = client.database
+        now = int(self.clock.time() * 1000)
+        result = []
+        waiting = False
+        for key, entry_id in zip(keys, ids):
+            stream = db.get(key, 'stream')
+            state = stream.groups.get(group) if stream is not None else None
+            if state is None:
+                raise CommandError("NOGROUP No such key '%s' or consumer group '%s' in XREADGROUP with GROUP option" % (key, group))
+            if entry_id == '>':
+                # 分发新的条目，加入待确认列表
+                entries = stream.after(state['last'], count)
+                if entries:
+                    state['last'] = entries[-1][0]
+                    if not noack:
+                        for new_id, fields in entries:
+                            state['pending'][new_id] = [consumer, now, 1]
+                    result.append([key, streamReply(entries)])
+                else:
+                    waiting = True
+            else:
+                # 重新读取这个消费者已经领取但还没有确认的条目
+                start = streamId(entry_id)
+                entries = []
+                for pending_id, pending in state['pending'].items():
+                    if pending[0] == consumer and pending_id > start:
+                        entries.append((pending_id, stream.entries.get(pending_id)))
+                        pending[2] += 1
+                        if count is not None and len(entries) >= count:
+                            break
+                result.append([key, streamReply(entries)])
+        if not result and waiting and block is not None:
+            return Blocked(['XREADGROUP', group_option, group, consumer] + list(args), block / 1000.0, self.stream_version)
+        return result or None
+
+    def cmd_xack(self, client, key, group, *ids):
+        stream = client.database.get(key, 'stream')
+        state = stream.groups.get(group) if stream is not None else None
+        if state is None:
+            return 0
+        return sum(1 for entry_id in map(streamId, ids) if state['pending'].pop(entry_id, None) is not None)
+
+    def cmd_xpending(self, client, key, group):
+        stream = client.database.get(key, 'stream')
+        state = stream.groups.get(group) if stream is not None else None
+        if state is None:
+            raise CommandError("NOGROUP No such key '%s' or consumer group '%s'" % (key, group))
+        pending = state['pending']
+        if not pending:
+            return [0, None, None, None]
+        consumers = {}
+        for owner, delivered, deliveries in pending.values():
+            consumers[owner] = consumers.get(owner, 0) + 1
+        ids = sorted(pending)
+        return [len(ids), formatStreamId(ids[0]), formatStreamId(ids[-1]),
+            [[owner, str(number)] for owner, number in sorted(consumers.items())]]
+
+    # 事务
+    def cmd_multi(self, client):
+        if client.multi is not None:
+            raise CommandError('ERR MULTI calls can not be nested')
+        client.multi = []
+        return OK
+
+    def cmd_exec(self, client):
+        if client.multi is None:
+            raise CommandError('ERR EXEC without MULTI')
+        queued, client.multi = client.multi, None
+        watched, client.watched = client.watched, {}
+        # WATCH的键被修改过时放弃执行事务
+        for (db, key), version in watched.items():
+            if self.dbs[db].version(key) != version:
+                return None
+        return [self.dispatch(client, args) for args in queued]
+
+    def cmd_discard(self, client):
+        if client.multi is None:
+            raise CommandError('ERR DISCARD without MULTI')
+        client.multi = None
+        client.watched = {}
+        return OK
+
+    def cmd_watch(self, client, *keys):
+        if client.multi is not None:
+            raise CommandError('ERR WATCH inside MULTI is not allowed')
+        for key in keys:
+            client.watched.setdefault((client.db, key), client.database.version(key))
+        return OK
+
+    def cmd_unwatch(self, client):
+        client.watched = {}
+        return OK
+
+    # 发布与订阅
+    def cmd_publish(self, client, channel, message):
+        receivers = list(self.subscribers.get(channel, ()))
+        for receiver in receivers:
+            receiver.replies.append(['message', channel, message])
+        self.clock.notify()
+        return len(receivers)
+
+    def cmd_subscribe(self, client, *channels):
+        for channel in channels:
+            client.channels.add(channel)
+            self.subscribers.setdefault(channel, set()).add(client)
+            client.replies.append(['subscribe', channel, len(client.channels)])
+        return None
+
+    def cmd_unsubscribe(self, client, *channels):
+        channels = channels or sorted(client.channels)
+        if not channels:
+            client.replies.append(['unsubscribe', None, 0])
+        for channel in channels:
+            client.channels.discard(channel)
+            self.subscribers.get(channel, set()).discard(client)
+            client.replies.append(['unsubscribe', channel, len(client.channels)])
+        return None
+
+    # Lua脚本，需要安装lupa
+    def cmd_script(self, client, subcommand, *args):
+        subcommand = subcommand.upper()
+        if subcommand == 'LOAD':
+            sha = hashlib.sha1(args[0]).hexdigest()
+            self.scripts[sha] = args[0]
+            return sha
+        if subcommand == 'EXISTS':
+            return [int(sha.lower() in self.scripts) for sha in args]
+        if subcommand == 'FLUSH':
+            self.scripts.clear()
+            return OK
+        raise CommandError(SYNTAX)
+
+    def cmd_eval(self, client, script, numkeys, *args):
+        sha = hashlib.sha1(script).hexdigest()
+        self.scripts[sha] = script
+        return self.cmd_evalsha(client, sha, numkeys, *args)
+
+    def cmd_evalsha(self, client, sha, numkeys, *args):
+        script = self.scripts.get(sha.lower())
+        if script is None:
+            raise CommandError('NOSCRIPT No matching script. Please use EVAL.')
+        numkeys = toInt(numkeys)
+        if not 0 <= numkeys <= len(args):
+            raise CommandError('ERR Number of keys can\'t be greater than number of args')
+        return LuaScripting.run(self, client, script, args[:numkeys], args[numkeys:])
+
+"""
+用lupa执行Lua脚本，按照redis的规则转换Lua和redis之间的值
+"""
+class LuaScripting(object):
+    def __init__(self, server):
+        try:
+            # redis使用Lua 5.1，lupa 2.0以上可以选择Lua版本
+            from lupa import lua51 as lupa
+        except ImportError:
+            import lupa
+        self.lupa = lupa
+        self.runtime = lupa.LuaRuntime(encoding = None)
+        self.server = server
+        self.client = None
+        self.functions = {}
+
+        helpers = self.runtime.eval('function(call, pcall) return {call = call, pcall = pcall} end')
+        library = helpers(self.call, self.pcall)
+        library.error_reply = lambda message: self.runtime.table_from({'err': message})
+        library.status_reply = lambda message: self.runtime.table_from({'ok': message})
+        library.sha1hex = lambda value: hashlib.sha1(value).hexdigest()
+        self.runtime.globals().redis = library
+
+    @classmethod
+    def run(cls, server, client, script, keys, argv):
+        if server._lua is None:
+            try:
+                server._lua = cls(server)
+            except ImportError:
+                raise CommandError('ERR scripting in redis_standin needs the lupa package')
+        return server._lua.execute(client, script, keys, argv)
+
+    def execute(self, client, script, keys, argv):
+        function = self.functions.get(script)
+        if function is None:
+            try:
+                function = self.runtime.execute('return function() ' + script + '\nend')
+            except self.lupa.LuaError as error:
+                raise CommandError('ERR Error compiling script: %s' % error)
+            self.functions[script] = function
+
+        lua_globals = self.runtime.globals()
+        lua_globals.KEYS = self.runtime.table(*keys)
+        lua_globals.ARGV = self.runtime.table(*argv)
+        self.client = client
+        try:
+            return self.toReply(function())
+        except self.lupa.LuaError as error:
+            raise CommandError('ERR Error running script: %s' % error)
+
+    def call(self, *args):
+        reply = self.server.dispatch(self.client, [self.toArgument(arg) for arg in args])
+        if isinstance(reply, CommandError):
+            raise reply
+        return self.toLua(reply)
+
+    def pcall(self, *args):
+        try:
+            return self.call(*args)
+        except CommandError as error:
+            return self.runtime.table_from({'err': str(error)})
+
+    # Lua的数字参数和redis一样按照%.17g转换为字符串
+    def toArgument(self, value):
+        if isinstance(value, bool):
+            raise CommandError('ERR Lua redis() command arguments must be strings or integers')
+        if isinstance(value, float):
+            return '%.17g' % value
+        return str(value)
+
+    def toLua(self, reply):
+        if reply is None:
+            return False
+        if isinstance(reply, Status):
+            return self.runtime.table_from({'ok': str(reply)})
+        if isinstance(reply, list):
+            return self.runtime.table(*[self.toLua(item) for item in reply])
+        return reply
+
+    def toReply(self, value):
+        if value is None or value is False:
+            return None
+        if value is True:
+            return 1
+        if isinstance(value, (int, long, float)):
+            return int(value)
+        if self.lupa.lua_type(value) == 'table':
+            if value['err'] is not None:
+                raise CommandError(value['err'])
+            if value['ok'] is not None:
+                return Status(value['ok'])
+            result = []
+            i = 1
+            while value[i] is not None:
+                result.append(self.toReply(value[i]))
+                i += 1
+            return result
+        return str(value)
+
+"""
+打包好的命令，每个元素为一条命令的参数列表
+"""
+class PackedCommands(list):
+    pass
+
+"""
+替换redis-py Connection的替身连接，发送的命令直接在StandinServer中执行，
+回复保存在队列中，由read_response()依次取出。
+"""
+class StandinConnection(Connection):
+    def __init__(self, server = None, **kwargs):
+        super(StandinConnection, self).__init__(**kwargs)
+        self.server = server or getServer()
+        self.client = None
+        self._error_parser = BaseParser()
+
+    def __repr__(self):
+        return '%s<db=%s>' % (type(self).__name__, self.db)
+
+    def connect(self):
+        if self._sock:
+            return
+        self._sock = True
+        self.client = Client(self.server)
+        self.client.db = self.db
+        for callback in self._connect_callbacks:
+            callback(self)
+
+    def disconnect(self):
+        if self.client is not None:
+            with self.server.lock:
+                for channel in self.client.channels:
+                    self.server.subscribers.get(channel, set()).discard(self.client)
+        self._sock = None
+        self.client = None
+
+    # 命令不需要转换为协议格式，直接保存编码后的参数列表
+    def pack_command(self, *args):
+        args = tuple(args[0].split()) + args[1:]
+        return PackedCommands([[self.encoder.encode(arg) for arg in args]])
+
+    def pack_commands(self, commands):
+        packed = PackedCommands()
+        for args in commands:
+            packed.extend(self.pack_command(*args))
+        return packed
+
+    def send_packed_command(self, command):
+        if not self._sock:
+            self.connect()
+        if not isinstance(command, PackedCommands):
+            command = parseCommands(''.join(command) if isinstance(command, (list, tuple)) else command)
+        for args in command:
+            reply = self.server.execute(self.client, args)
+            if isinstance(reply, Blocked):
+                reply = self.waitBlocked(reply)
+            if isinstance(reply, CommandError) or reply is not None or args[0].upper() not in ('SUBSCRIBE', 'UNSUBSCRIBE'):
+                self.client.replies.append(reply)
+
+    """
+    在服务器的锁之外等待新的流条目，然后重新执行阻塞的命令，超时之后返回空回复
+    """
+    def waitBlocked(self, blocked):
+        clock = self.server.clock
+        end = clock.time() + blocked.timeout if blocked.timeout else None
+        while True:
+            version = blocked.version
+            left = None if end is None else end - clock.time()
+            if left is not None and left <= 0:
+                return None
+            clock.block(lambda: self.server.stream_version != version, left)
+            reply = self.server.execute(self.client, blocked.args)
+            if not isinstance(reply, Blocked):
+                return reply
+            blocked = reply
+
+    def can_read(self, timeout = 0):
+        if not self._sock:
+            self.connect()
+        if self.client.replies:
+            return True
+        if not timeout:
+            return False
+        return self.server.clock.block(lambda: bool(self.client.replies), timeout)
+
+    def read_response(self):
+        client = self.client
+        if client is None:
+            raise ConnectionError('Connection closed by server.')
+        if not client.replies:
+            if not client.channels:
+                raise ConnectionError('No reply from redis_standin.')
+            # 订阅状态下等待新消息
+            self.server.clock.block(lambda: bool(client.replies))
+        return self.toResponse(client.replies.popleft(), True)
+
+    def toResponse(self, reply, top = False):
+        if isinstance(reply, CommandError):
+            error = self._error_parser.parse_error(str(reply))
+            if top:
+                raise error
+            return error
+        if isinstance(reply, list):
+            return [self.toResponse(item) for item in reply]
+        return reply
+
+"""
+解析redis协议格式的命令
+
+@param {string}
+
+@return {array} 每条命令的参数列表
+"""
+def parseCommands(data):
+    commands = []
+    pos = 0
+    while pos < len(data):
+        line_end = data.index('\r\n', pos)
+        count = int(data[pos + 1:line_end])
+        pos = line_end + 2
+        args = []
+        for i in xrange(count):
+            line_end = data.index('\r\n', pos)
+            length = int(data[pos + 1:line_end])
+            pos = line_end + 2
+            args.append(data[pos:pos + length])
+            pos += length + 2
+        commands.append(args)
+    return commands
+
+# 进程内共享的替身服务器和虚拟时钟
+SERVER = None
+CLOCK = None
+_lock = threading.Lock()
+
+def enabled():
+    return os.environ.get(STANDIN_ENV, '') not in ('', '0')
+
+"""
+取得进程内共享的替身服务器，使用虚拟时钟
+"""
+def getServer():
+    global SERVER, CLOCK
+    with _lock:
+        if SERVER is None:
+            CLOCK = VirtualClock()
+            SERVER = StandinServer(CLOCK)
+        return SERVER
+
+"""
+创建复制进程内共享的替身服务器的从服务器，使用同一个虚拟时钟
+
+@param {float} 同步间隔(秒)
+
+@return {object} StandinServer，可以传给standinRedis
+"""
+def replicaServer(delay = 0):
+    master = getServer()
+    replica = StandinServer(master.clock)
+    replica.replicate(master, delay)
+    return replica
+
+"""
+连接到替身服务器
+
+@param {int}    数据库
+@param {object} StandinServer，默认为进程内共享的使用虚拟时钟的替身服务器
+
+@return {object} redis.Redis
+"""
+def standinRedis(db = 0, server = None):
+    pool = ConnectionPool(connection_class = StandinConnection, server = server or getServer(), db = db)
+    return redis.Redis(connection_pool = pool)
+
+"""
+测试使用的连接：设置了REDIS_STANDIN时返回连接到替身服务器的redis.Redis，
+并把modules中的time替换为虚拟时钟，直到调用restoreTime()；否则返回连接到本机redis服务器的redis.Redis
+
+@param {int}   数据库
+@param {array} 需要使用虚拟时间的模块
+
+@return {object} redis.Redis
+"""
+# 被替换了time的模块 => 原来的time
+PATCHED_MODULES = {}
+
+def connect(db = 0, modules = ()):
+    if not enabled():
+        return redis.Redis(db = db)
+    conn = standinRedis(db)
+    for module in modules:
+        PATCHED_MODULES.setdefault(module, module.time)
+        module.time = CLOCK
+    return conn
+
+"""
+恢复被connect()替换的time，测试在setUp中用addCleanup注册
+"""
+def restoreTime():
+    for module, original in PATCHED_MODULES.items():
+        module.time = original
+    PATCHED_MODULES.clear()
+
+"""
+测试
+"""
+class TestStandin(unittest.TestCase):
+    def setUp(self):
+        self.conn = standinRedis(db = 15)
+        self.clock = getServer().clock
+
+    def tearDown(self):
+        self.conn.flushdb()
+        del self.conn
+        print
+        print
+
+    def testCommands(self):
+        conn = self.conn
+        conn.hmset('hash', {'a': 1, 'b': 2})
+        self.assertEquals(conn.hgetall('hash'), {'a': '1', 'b': '2'})
+        self.assertEquals(conn.hincrby('hash', 'a', 5), 6)
+
+        conn.rpush('list', 1, 2, 3, 4)
+        conn.ltrim('list', 1, -2)
+        self.assertEquals(conn.lrange('list', 0, -1), ['2', '3'])
+
+        conn.zadd('zset', 'a', 1, 'b', 2, 'c', 3)
+        conn.sadd('set', 'b', 'c', 'd')
+        self.assertEquals(conn.zrangebyscore('zset', '(1', '+inf', withscores = True), [('b', 2.0), ('c', 3.0)])
+        self.assertEquals(conn.zinterstore('inter', ['zset', 'set']), 2)
+        self.assertEquals(conn.zrange('inter', 0, -1, withscores = True), [('b', 3.0), ('c', 4.0)])
+        self.assertEquals(conn.zrangebylex('zset', '[b', '+'), ['b', 'c'])
+        conn.zadd('lex', 'ab', 0, 'abc', 0, 'b', 0, 'ba', 0)
+        self.assertEquals(conn.zrangebylex('lex', '[ab', '[ab\xff'), ['ab', 'abc'])
+        self.assertEquals(conn.zrangebylex('lex', '(ab', '+', 0, 2), ['abc', 'b'])
+        self.assertEquals(conn.zrevrangebylex('lex', '+', '[b', 0, 1), ['ba'])
+        self.assertEquals(conn.zlexcount('lex', '-', '(b'), 2)
+        self.assertEquals(sorted(conn.scan_iter('z*', 2)), ['zset'])
+
+        conn.set('string', 'value')
+        self.assertRaises(redis.exceptions.ResponseError, conn.lpush, 'string', 'x')
+
+    def testExpireWithVirtualTime(self):
+        conn = self.conn
+        conn.setex('key', 'value', 100)
+        start = _time.time()
+        self.clock.sleep(99)
+        self.assertEquals(conn.get('key'), 'value')
+        self.clock.sleep(2)
+        print "Slept 101 virtual seconds in %.3f seconds" % (_time.time() - start)
+        self.assertFalse(conn.exists('key'))
+        self.assertTrue(_time.time() - start < 1)
+
+    def testWatch(self):
+        conn = self.conn
+        pipe = conn.pipeline()
+        pipe.watch('watched')
+        conn.set('watched', 1)
+        pipe.multi()
+        pipe.incr('watched')
+        self.assertRaises(redis.exceptions.WatchError, pipe.execute)
+
+        pipe.watch('watched')
+        pipe.multi()
+        pipe.incr('watched')
+        self.assertEquals(pipe.execute(), [2])
+
+    def testPubSub(self):
+        conn = self.conn
+
+        def publish():
+            for i in xrange(3):
+                self.clock.sleep(10)
+                conn.publish('channel', i)
+
+        pubsub = conn.pubsub()
+        pubsub.subscribe(['channel'])
+        threading.Thread(target = publish).start()
+        start = self.clock.time()
+        messages = [item['data'] for item in itertools.islice(pubsub.listen(), 4)]
+        pubsub.unsubscribe()
+        print "Received:", messages
+        self.assertEquals(messages, [1, '0', '1', '2'])
+        self.assertTrue(self.clock.time() - start >= 30)
+
+    def testStreams(self):
+        conn = self.conn
+        ids = [conn.execute_command('XADD', 'stream', 'MAXLEN', '~', 3, '*', 'n', i) for i in xrange(5)]
+        self.assertEquals(conn.execute_command('XLEN', 'stream'), 3)
+        entries = conn.execute_command('XRANGE', 'stream', '-', '+', 'COUNT', 2)
+        self.assertEquals(entries, [[ids[2], ['n', '2']], [ids[3], ['n', '3']]])
+        self.assertEquals(conn.execute_command('XREVRANGE', 'stream', '+', ids[3])[0][0], ids[4])
+
+        conn.execute_command('XGROUP', 'CREATE', 'stream', 'group', '0')
+        self.assertRaises(redis.ResponseError, conn.execute_command, 'XGROUP', 'CREATE', 'stream', 'group', '$')
+        read = conn.execute_command('XREADGROUP', 'GROUP', 'group', 'a', 'COUNT', 2, 'STREAMS', 'stream', '>')
+        self.assertEquals([entry[0] for entry in read[0][1]], ids[2:4])
+        self.assertEquals(conn.execute_command('XPENDING', 'stream', 'group')[0], 2)
+        self.assertEquals(conn.execute_command('XACK', 'stream', 'group', ids[2]), 1)
+        pending = conn.execute_command('XREADGROUP', 'GROUP', 'group', 'a', 'STREAMS', 'stream', '0')
+        self.assertEquals([entry[0] for entry in pending[0][1]], [ids[3]])
+
+        # 阻塞读取等待其他线程添加的条目
+        def add():
+            self.clock.sleep(5)
+            conn.execute_command('XADD', 'stream', '*', 'n', 5)
+        threading.Thread(target = add).start()
+        start = self.clock.time()
+        read = conn.execute_command('XREADGROUP', 'GROUP', 'group', 'b', 'BLOCK', 0, 'STREAMS', 'stream', '>')
+        self.assertEquals([entry[0] for entry in read[0][1]], [ids[4]])
+        read = conn.execute_command('XREADGROUP', 'GROUP', 'group', 'b', 'BLOCK', 10000, 'STREAMS', 'stream', '>')
+        self.assertEquals(read[0][1][0][1], ['n', '5'])
+        self.assertTrue(self.clock.time() - start >= 5)
+        self.assertEquals(conn.execute_command('XREADGROUP', 'GROUP', 'group', 'b', 'BLOCK', 100, 'STREAMS', 'stream', '>'), None)
+
+    def testReplication(self):
+        conn = self.conn
+        replica = standinRedis(15, replicaServer(delay = 1))
+        conn.set('key', 'v1')
+        # 从服务器每隔1秒同步一次
+        self.assertEquals(replica.get('key'), None)
+        self.clock.sleep(1)
+        self.assertEquals(replica.get('key'), 'v1')
+        self.assertRaises(redis.ReadOnlyError, replica.set, 'key', 'v2')
+
+        info = replica.info('replication')
+        self.assertEquals((info['role'], info['master_link_status']), ('slave', 'up'))
+        self.assertEquals(info['slave_repl_offset'], conn.info('replication')['master_repl_offset'])
+        self.assertTrue(replica.slaveof())
+        self.assertEquals(replica.info('replication')['role'], 'master')
+        replica.set('key', 'v2')
+        self.assertEquals(conn.get('key'), 'v1')
+
+    def testScript(self):
+        try:
+            import lupa
+        except ImportError:
+            print "lupa is not installed, skipping"
+            return
+        conn = self.conn
+        script = conn.register_script("""
+            redis.call('zadd', KEYS[1], ARGV[1], 'member')
+            return {redis.call('zscore', KEYS[1], 'member'), redis.call('get', 'missing'), 1.5}
+        """)
+        self.assertEquals(script(keys = ['zset'], args = [1.25]), ['1.25', None, 1])
+        # Lua的数字按照%.17g传给redis，时间戳不会丢失精度
+        conn.eval("redis.call('zadd', KEYS[1], ARGV[1] + 432, 'now')", 1, 'zset', '1500000000.1234567')
+        self.assertEquals(conn.zscore('zset', 'now'), 1500000432.1234567)
+
+        # 从服务器上的脚本只能读取
+        replica = standinRedis(15, replicaServer())
+        self.assertEquals(replica.eval("return redis.call('zscore', KEYS[1], 'member')", 1, 'zset'), '1.25')
+        self.assertRaises(redis.ResponseError, replica.eval, "return redis.call('del', KEYS[1])", 1, 'zset')
+        replica.slaveof()
+
+if __name__ == '__main__':
+    unittest.main()
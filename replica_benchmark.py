@@ -0,0 +1,201 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+读写分离的读取吞吐量测试
+准备好文章、会话和商品浏览数据之后，依次使用0、1、2……个从服务器，多个客户端在指定时间内不断执行：
+（1）90%读取：checkToken的HGET、canCache的ZRANK通过router.client()路由，getArticles通过router.reader()读取从服务器
+（2）10%写入：voteArticle之后立即取出文章列表，这次读取需要读到自己的投票，发送到主服务器
+每个操作模拟一个随机用户的请求，用户最后一次写入的时间保存在会话中，只有这个用户自己的读取受读己之写的限制。
+报告每秒操作数和读取数、延迟、从服务器处理的读取比例，以及因为读己之写或者延迟保护而读取主服务器的次数。
+
+从服务器可以这样启动：
+    redis-server --port 6380 --slaveof 127.0.0.1 6379
+    redis-server --port 6381 --slaveof 127.0.0.1 6379
+
+用法：python replica_benchmark.py --master localhost:6379 --replicas localhost:6380 localhost:6381 --clients 8
+      python replica_benchmark.py --standin --standin-replicas 2 --seconds 2
+替身服务器和它的从服务器都在同一个进程中，并且每次同步都复制全部数据，只能用来检查路由，不能体现吞吐量的扩展。
+"""
+
+import time
+import random
+import argparse
+import threading
+import multiprocessing
+from collections import defaultdict
+
+import redis
+
+# benchmark已经把各章节的目录加入了sys.path
+import benchmark
+import redis_standin
+import redis_replica
+import article_voted
+import shopping_website
+
+# 替身服务器和它的从服务器
+STANDIN_MASTER = None
+STANDIN_REPLICAS = []
+
+def connectTo(address, options):
+    host, port = address.rsplit(':', 1)
+    return redis.Redis(host = host, port = int(port), db = options.db)
+
+"""
+创建读写分离的路由，每个客户端一个
+
+@param {object} 命令行参数
+@param {int}    使用的从服务器数量
+
+@return {object} ReplicaRouter
+"""
+def createRouter(options, replicas):
+    if options.standin:
+        master = redis_standin.standinRedis(options.db, STANDIN_MASTER)
+        conns = [redis_standin.standinRedis(options.db, server) for server in STANDIN_REPLICAS[:replicas]]
+    else:
+        master = connectTo(options.master, options)
+        conns = [connectTo(address, options) for address in options.replicas[:replicas]]
+    return redis_replica.ReplicaRouter(master, conns, options.max_lag, options.check_interval)
+
+"""
+准备数据
+
+@return {dict} 文章ID
+"""
+def prepare(conn, options):
+    conn.flushdb()
+    article_ids = article_voted.postArticles(conn,
+        [('user%s' % i, 'title %s' % i, 'http://example.com/%s' % i) for i in xrange(options.articles)])
+    pipe = conn.pipeline(False)
+    for i in xrange(options.users):
+        pipe.hset('login:', 'token%s' % i, 'user%s' % i)
+    for i in xrange(options.items):
+        pipe.zadd('viewed:', 'item%s' % i, -i)
+    pipe.execute()
+    return {'articles': article_ids}
+
+"""
+客户端，在指定时间内不断执行操作
+
+@param {object} 命令行参数
+@param {int}    使用的从服务器数量
+@param {dict}   准备数据时得到的状态
+@param {int}    随机数种子
+@param {object} 保存结果的队列
+"""
+def runClient(options, replicas, state, seed, results):
+    router = createRouter(options, replicas)
+    conn = router.client()
+    rand = random.Random(seed)
+    zipf = benchmark.Zipf(len(state['articles']))
+    pages = max(1, len(state['articles']) // article_voted.ARTICLES_PER_PAGE)
+    latencies = defaultdict(list)
+    # 用户 => 最后一次写入的时间
+    sessions = {}
+
+    end = time.time() + options.seconds
+    while time.time() < end:
+        start = time.time()
+        user = rand.randrange(options.users)
+        router.beginRequest(sessions.get(user))
+        choice = rand.random()
+        if choice < options.writes:
+            name = 'vote'
+            article_voted.voteArticle(conn, 'user%s' % user, 'article:' + state['articles'][zipf.next(rand)])
+            article_voted.getArticles(router.reader(), 1)
+            sessions[user] = router.lastWrite()
+        elif choice < options.writes + (1 - options.writes) * .4:
+            name = 'checkToken'
+            shopping_website.checkToken(conn, 'token%s' % user)
+        elif choice < options.writes + (1 - options.writes) * .7:
+            name = 'canCache'
+            shopping_website.canCache(conn, 'http://test.com/view?item=item%s' % rand.randrange(options.items))
+        else:
+            name = 'getArticles'
+            article_voted.getArticles(router.reader(), min(pages, zipf.next(rand) + 1))
+        latencies[name].append(time.time() - start)
+    results.put((dict(latencies), router.counters))
+
+"""
+使用指定数量的从服务器运行一次测试
+
+@return {dict} 测试结果
+"""
+def run(options, replicas, state):
+    results = multiprocessing.Queue()
+    target = lambda i: (options, replicas, state, i, results)
+    # 替身服务器在本进程中，客户端使用线程；真正的redis服务器使用进程，避免受到GIL的限制
+    if options.standin:
+        clients = [threading.Thread(target = runClient, args = target(i)) for i in xrange(options.clients)]
+    else:
+        clients = [multiprocessing.Process(target = runClient, args = target(i)) for i in xrange(options.clients)]
+
+    start = time.time()
+    for client in clients:
+        client.start()
+    latencies = defaultdict(list)
+    counters = defaultdict(int)
+    for client in clients:
+        client_latencies, client_counters = results.get()
+        for name, values in client_latencies.items():
+            latencies[name].extend(values)
+        for name, value in client_counters.items():
+            counters[name] += value
+    for client in clients:
+        client.join()
+    seconds = time.time() - start
+
+    total = [latency for values in latencies.values() for latency in values]
+    result = benchmark.summarize(total, seconds)
+    reads = sum(len(values) for name, values in latencies.items() if name != 'vote')
+    result['reads_per_sec'] = reads / seconds
+    result['replica_share'] = counters['replica_reads'] / float(counters['replica_reads'] + counters['master_reads'] or 1)
+    result['read_your_writes'] = counters['read_your_writes']
+    result['lagging'] = counters['lagging']
+    return result
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'read replica routing benchmark')
+    parser.add_argument('--master', default = 'localhost:6379')
+    parser.add_argument('--replicas', nargs = '*', default = ['localhost:6380'])
+    parser.add_argument('--clients', type = int, default = 8)
+    parser.add_argument('--seconds', type = float, default = 10)
+    parser.add_argument('--writes', type = float, default = .1, help = 'fraction of operations that vote')
+    parser.add_argument('--articles', type = int, default = 10000)
+    parser.add_argument('--users', type = int, default = 100000)
+    parser.add_argument('--items', type = int, default = 10000)
+    parser.add_argument('--max-lag', type = float, default = 1)
+    parser.add_argument('--check-interval', type = float, default = .1)
+    parser.add_argument('--db', type = int, default = 15, help = 'database to use, it is flushed')
+    parser.add_argument('--standin', action = 'store_true', help = 'use the in-process redis_standin server and replicas')
+    parser.add_argument('--standin-replicas', type = int, default = 2)
+    options = parser.parse_args()
+
+    if options.standin:
+        STANDIN_MASTER = redis_standin.StandinServer()
+        for i in xrange(options.standin_replicas):
+            replica = redis_standin.StandinServer(STANDIN_MASTER.clock)
+            replica.replicate(STANDIN_MASTER, delay = .01)
+            STANDIN_REPLICAS.append(replica)
+        conn = redis_standin.standinRedis(options.db, STANDIN_MASTER)
+        count = options.standin_replicas
+    else:
+        conn = connectTo(options.master, options)
+        count = len(options.replicas)
+
+    state = prepare(conn, options)
+    # 等待从服务器同步准备好的数据
+    router = createRouter(options, count)
+    while count and any(replica['lag'] is None or replica['lag'] > options.max_lag
+            for replica in router.stats()['replicas']):
+        router.refresh(force = True)
+        time.sleep(.1)
+
+    for replicas in xrange(count + 1):
+        result = run(options, replicas, state)
+        print '%s replica(s): %8.0f ops/sec, %8.0f reads/sec, p50 %.3f ms, p99 %.3f ms, %3.0f%% reads on replicas, %s read-your-writes, %s lagging' % (
+            replicas, result['ops_per_sec'], result['reads_per_sec'], result['p50_ms'], result['p99_ms'],
+            result['replica_share'] * 100, result['read_your_writes'], result['lagging'])
+    conn.flushdb()